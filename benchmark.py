@@ -0,0 +1,720 @@
+"""
+Бенчмарки основных путей main.py без подключения к Telegram.
+
+FakeClient имитирует TelegramClient в памяти: iter_messages, get_messages, iter_dialogs, get_entity,
+get_permissions, GetForumTopicsRequest, send_message и поток обновлений для events.NewMessage,
+events.MessageEdited и events.MessageDeleted.
+Задержка каждого запроса и доля ответов FloodWaitError настраиваются.
+
+Каждый бенчмарк запускается в отдельном процессе и во временном каталоге, поэтому пиковый RSS
+относится только к нему. Результаты можно сохранить в JSON и сравнить со следующим запуском:
+
+    python benchmark.py --json baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource  # Только Unix: на Windows пиковый RSS не измеряется
+except ImportError:
+    resource = None
+
+import main
+import ratelimit
+import records
+from telethon import errors
+from rich.table import Table
+
+# Размеры данных при --scale 1
+SCALES = {
+    "messages": 1_000_000,
+    "dialogs": 10_000,
+    "filters": 1_000,
+    "events": 100_000,
+    "checks": 100_000,
+    "sends": 1_000,
+    "indexed": 100_000,
+    "queries": 1_000,
+    "records": 100_000,
+    "pooled": 20_000,
+}
+
+# Количество сессий в бенчмарке пула и число выгружаемых ими чатов
+POOL_SESSIONS = 4
+POOL_CHATS = 20
+
+# Словарь для текстов бенчмарка поиска: несколько частых слов и длинный хвост редких
+SEARCH_WORDS = ["отчёт", "привет", "вечер", "добрый", "канал", "цена", "рынок", "сделка", "сигнал", "график"] + \
+               [f"слово{index}" for index in range(5000)]
+
+BASE_TIMESTAMP = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+
+class FakeReply:
+    __slots__ = ("reply_to_msg_id", "reply_to_top_id", "forum_topic")
+
+    def __init__(self, topic_id):
+        self.reply_to_msg_id = topic_id
+        self.reply_to_top_id = topic_id
+        self.forum_topic = True
+
+class FakeMessage:
+    __slots__ = ("id", "date", "message", "sender_id", "reply_to", "edit_date")
+
+    def __init__(self, message_id, topic_id=None, edited=False):
+        self.id = message_id
+        self.date = datetime.fromtimestamp(BASE_TIMESTAMP + message_id, timezone.utc)
+        self.message = f"Edited {message_id}" if edited else f"Message {message_id}"
+        self.sender_id = 1000 + message_id % 97
+        self.reply_to = FakeReply(topic_id) if topic_id else None
+        self.edit_date = self.date + timedelta(hours=1) if edited else None
+
+    @property
+    def text(self):
+        return self.message
+
+class Channel:
+    """
+    Канал или супергруппа (имя класса попадает в поле type снимка чатов).
+    """
+
+    def __init__(self, raw_id, title, username=None, forum=False):
+        self.id = raw_id
+        self.title = title
+        self.username = username
+        self.forum = forum
+        self.megagroup = True
+        self.broadcast = False
+        self.creator = False
+        self.admin_rights = None
+
+class FakeTopic:
+    __slots__ = ("id", "title", "top_message")
+
+    def __init__(self, topic_id):
+        self.id = topic_id
+        self.title = f"Topic {topic_id}"
+        self.top_message = topic_id * 10
+
+class FakeDialog:
+    __slots__ = ("id", "name", "entity", "message", "date")
+
+    def __init__(self, entity, top_message):
+        self.id = main.normalize_chat_id(entity)
+        self.name = entity.title
+        self.entity = entity
+        self.message = FakeMessage(top_message)
+        self.date = self.message.date
+
+class FakePermissions:
+    send_messages = True
+
+class FakeEvent:
+    __slots__ = ("chat_id", "chat", "message")
+
+    def __init__(self, chat_id, chat, message):
+        self.chat_id = chat_id
+        self.chat = chat
+        self.message = message
+
+class FakeDeletedEvent:
+    __slots__ = ("chat_id", "deleted_ids")
+
+    def __init__(self, chat_id, deleted_ids):
+        self.chat_id = chat_id
+        self.deleted_ids = deleted_ids
+
+class FakeRequestIter:
+    """
+    Аналог RequestIter Telethon: отдаёт элементы страницами по 100, перед каждой страницей
+    выполняет «запрос» к FakeClient. После FloodWaitError страницу можно запросить повторно.
+
+    :param client: FakeClient.
+    :param items: Последовательность элементов (генерируется лениво).
+    :param limit: Максимальное количество элементов (None — все).
+    """
+
+    def __init__(self, client, items, limit=None):
+        self.client = client
+        self.limit = limit
+        self._items = iter(items)
+        self._page = []
+        self._done = False
+        self._count = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._page:
+            if self._done or (self.limit is not None and self._count >= self.limit):
+                raise StopAsyncIteration
+            await self.client.request()
+            size = 100 if self.limit is None else min(100, self.limit - self._count)
+            self._page = [item for _, item in zip(range(size), self._items)][::-1]
+            if len(self._page) < size:
+                self._done = True
+            if not self._page:
+                raise StopAsyncIteration
+        self._count += 1
+        return self._page.pop()
+
+class FakeClient:
+    """
+    Имитация TelegramClient в памяти.
+
+    :param dialogs: Количество чатов (5% из них — форумы).
+    :param messages: Количество сообщений в каждом чате.
+    :param topics: Количество тем в каждом форуме.
+    :param latency: Задержка каждого запроса (сек).
+    :param flood_rate: Доля запросов, завершающихся FloodWaitError.
+    :param flood_seconds: Значение seconds у FloodWaitError.
+    :param seed: Начальное значение генератора случайных чисел.
+    """
+
+    def __init__(self, dialogs=100, messages=1000, topics=150, latency=0.0, flood_rate=0.0, flood_seconds=0, seed=1):
+        self.messages = messages
+        self.topics = topics
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.random = random.Random(seed)
+
+        self.requests = 0
+        self.floods = 0
+        self.request_times = []  # Моменты запросов, из них считаются интервалы между страницами
+        self.handlers = []
+        self.events = []  # Поток обновлений для run_until_disconnected: (chat_id, message)
+        self.handler_latencies = []
+
+        self.entities = {}
+        self.usernames = {}
+        self.dialog_list = []
+        for index in range(dialogs):
+            entity = Channel(1000 + index, f"Chat {index}", username=f"chat{index}", forum=index % 20 == 0)
+            chat_id = main.normalize_chat_id(entity)
+            self.entities[chat_id] = entity
+            self.usernames[entity.username] = entity
+            self.dialog_list.append(FakeDialog(entity, messages))
+
+    async def request(self):
+        """
+        Один «запрос» к API: задержка и, возможно, FloodWaitError.
+        """
+        self.requests += 1
+        self.request_times.append(time.perf_counter())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.floods += 1
+            raise errors.FloodWaitError(request=None, capture=self.flood_seconds)
+
+    def iter_messages(self, entity, limit=None, offset_id=0, min_id=0, max_id=0, reverse=False, reply_to=None):
+        newest = self.messages if not max_id else min(self.messages, max_id - 1)
+        if reverse:
+            ids = range(max(offset_id, min_id) + 1, newest + 1)
+        else:
+            if offset_id:
+                newest = min(newest, offset_id - 1)
+            ids = range(newest, min_id, -1)
+        return FakeRequestIter(self, (FakeMessage(message_id) for message_id in ids), limit)
+
+    async def get_messages(self, entity, limit=1, reply_to=None):
+        await self.request()
+        return [FakeMessage(message_id) for message_id in range(self.messages, max(0, self.messages - limit), -1)]
+
+    def iter_dialogs(self, limit=None):
+        return FakeRequestIter(self, self.dialog_list, limit)
+
+    async def get_entity(self, chat):
+        await self.request()
+        # Как и Telethon, список чатов разрешается одним запросом
+        if isinstance(chat, list):
+            return [self._entity(item) for item in chat]
+        return self._entity(chat)
+
+    def _entity(self, chat):
+        if isinstance(chat, str):
+            entity = self.usernames.get(chat.lstrip("@"))
+        else:
+            entity = self.entities.get(chat)
+        if entity is None:
+            raise ValueError(f"Cannot find any entity corresponding to {chat}")
+        return entity
+
+    async def get_permissions(self, entity):
+        await self.request()
+        return FakePermissions()
+
+    async def send_message(self, entity, message):
+        await self.request()
+        return FakeMessage(self.messages + 1)
+
+    async def __call__(self, request):
+        # Поддерживается только GetForumTopicsRequest: темы отдаются от новых к старым страницами по limit
+        await self.request()
+        start = request.offset_topic - 1 if request.offset_topic else self.topics
+        topics = [FakeTopic(topic_id) for topic_id in range(start, max(0, start - request.limit), -1)]
+        return _TopicsResponse(topics, [FakeMessage(topic.top_message) for topic in topics], self.topics)
+
+    def add_event_handler(self, callback, event=None):
+        self.handlers.append((callback, event))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [(handler, builder) for handler, builder in self.handlers if handler is not callback]
+
+    async def run_until_disconnected(self):
+        # Доставляем обновления обработчикам с учётом белого списка чатов, как диспетчер Telethon.
+        # Событие — (chat_id, FakeMessage) для нового или отредактированного сообщения, (chat_id, [ID]) для удаления.
+        whitelists = {}
+        for chat_id, message in self.events:
+            if isinstance(message, list):
+                kind, event = "MessageDeleted", FakeDeletedEvent(chat_id, message)
+            else:
+                kind = "MessageEdited" if message.edit_date else "NewMessage"
+                event = FakeEvent(chat_id, self.entities[chat_id], message)
+            for handler, builder in list(self.handlers):
+                if builder is None or type(builder).__name__ != kind:
+                    continue
+                if builder.chats is not None:
+                    chats = whitelists.get(id(builder))
+                    if chats is None:
+                        chats = whitelists[id(builder)] = set(builder.chats)
+                    if chat_id not in chats:
+                        continue
+                started = time.perf_counter()
+                await handler(event)
+                self.handler_latencies.append(time.perf_counter() - started)
+
+    def is_connected(self):
+        return True
+
+    async def disconnect(self):
+        pass
+
+class _TopicsResponse:
+    def __init__(self, topics, messages, count):
+        self.topics = topics
+        self.messages = messages
+        self.count = count
+
+def percentiles(samples):
+    """
+    Возвращает p50/p95/p99 выборки в миллисекундах.
+
+    :param samples: Длительности в секундах.
+    :return: Словарь с перцентилями (пустой, если выборка пуста).
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 4)
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+def intervals(times):
+    return [later - earlier for earlier, later in zip(times, times[1:])]
+
+def make_client(options, **kwargs):
+    kwargs.setdefault("dialogs", options.sizes["dialogs"])
+    return FakeClient(latency=options.latency, flood_rate=options.flood_rate, seed=options.seed, **kwargs)
+
+async def bench_history(options):
+    client = make_client(options, dialogs=1, messages=options.sizes["messages"])
+    chat_id = next(iter(client.entities))
+    started = time.perf_counter()
+    fetched = await main.fetch_chat_history(client, chat_id, "history.jsonl", resume=False)
+    seconds = time.perf_counter() - started
+    return {"operations": fetched, "seconds": seconds, "samples": intervals(client.request_times), "client": client}
+
+async def bench_history_partitioned(options):
+    client = make_client(options, dialogs=1, messages=options.sizes["messages"])
+    chat_id = next(iter(client.entities))
+    started = time.perf_counter()
+    fetched = await main.fetch_chat_history_partitioned(client, chat_id, "history.jsonl", partitions=4, resume=False)
+    seconds = time.perf_counter() - started
+    return {"operations": fetched, "seconds": seconds, "client": client}
+
+async def bench_save_all_chats(options):
+    client = make_client(options)
+    started = time.perf_counter()
+    await main.save_all_chats(client, "all_chats.json", incremental=False)
+    seconds = time.perf_counter() - started
+    return {"operations": len(client.dialog_list), "seconds": seconds, "client": client}
+
+async def bench_save_all_chats_incremental(options):
+    # Первый снимок не измеряется, повторный запуск переиспользует темы неизменившихся форумов
+    await main.save_all_chats(make_client(options), "all_chats.json", incremental=False)
+    client = make_client(options)
+    started = time.perf_counter()
+    await main.save_all_chats(client, "all_chats.json", incremental=True)
+    seconds = time.perf_counter() - started
+    return {"operations": len(client.dialog_list), "seconds": seconds, "client": client}
+
+def make_filters(client, count, rng):
+    """
+    Фильтры по ID (80%), username (10%) и названию (10%), у пятой части — список топиков.
+    """
+    filters = []
+    dialogs = rng.sample(client.dialog_list, min(count, len(client.dialog_list)))
+    for index, dialog in enumerate(dialogs):
+        topics = [1, 2, 3] if index % 5 == 0 else None
+        if index % 10 == 8:
+            filters.append({"id": None, "username": dialog.entity.username, "title": None, "topics": topics})
+        elif index % 10 == 9:
+            filters.append({"id": None, "username": None, "title": dialog.name, "topics": topics})
+        else:
+            filters.append({"id": dialog.id, "username": None, "title": None, "topics": topics})
+    return filters
+
+async def bench_listener(options):
+    client = make_client(options, messages=0)
+    rng = random.Random(options.seed)
+    filters = make_filters(client, options.sizes["filters"], rng)
+    chat_ids = list(client.entities)
+    monitored = [dialog.id for dialog in client.dialog_list if dialog.name in {f["title"] for f in filters}]
+    monitored += [f["id"] for f in filters if f["id"] is not None]
+    # Половина событий приходит в отслеживаемые чаты, остальные отсеиваются белым списком
+    for message_id in range(1, options.sizes["events"] + 1):
+        chat_id = rng.choice(monitored) if message_id % 2 else rng.choice(chat_ids)
+        topic_id = rng.randint(1, 5) if client.entities[chat_id].forum else None
+        client.events.append((chat_id, FakeMessage(message_id, topic_id)))
+    started = time.perf_counter()
+    await main.listen_to_messages(client, filters, "listener.jsonl", catch_up=False)
+    seconds = time.perf_counter() - started
+    return {"operations": len(client.events), "seconds": seconds, "samples": client.handler_latencies,
+            "client": client, "notes": f"{len(client.handler_latencies)} delivered"}
+
+async def bench_listener_edits(options):
+    # Поток новых сообщений, за которым идут правки и удаления: половина — недавних сообщений (из индекса слушателя),
+    # половина — вытесненных из него (ищутся в базе SQLite по индексу message_id)
+    client = make_client(options, messages=0)
+    rng = random.Random(options.seed)
+    chat_ids = [dialog.id for dialog in client.dialog_list[:20]]
+    filters = [{"id": chat_id} for chat_id in chat_ids]
+    count = options.sizes["events"]
+    dedup_size = max(1, count // 10)
+    posted = [(rng.choice(chat_ids), message_id) for message_id in range(1, count + 1)]
+    client.events = [(chat_id, FakeMessage(message_id)) for chat_id, message_id in posted]
+    updates = max(1, count // 10)
+    for index in range(updates):
+        # Последние dedup_size сообщений ещё в индексе слушателя
+        position = rng.randrange(count - dedup_size, count) if index % 2 else rng.randrange(count - dedup_size)
+        chat_id, message_id = posted[position]
+        client.events.append((chat_id, [message_id]) if index % 4 < 2 else (chat_id, FakeMessage(message_id, edited=True)))
+    started = time.perf_counter()
+    await main.listen_to_messages(client, filters, "listener.db", catch_up=False, dedup_size=dedup_size, quiet=True)
+    seconds = time.perf_counter() - started
+    connection = sqlite3.connect("listener.db")
+    deleted, edited = connection.execute(
+        "SELECT COUNT(deleted), COUNT(edited) FROM messages").fetchone()
+    connection.close()
+    return {"operations": len(client.events), "seconds": seconds, "samples": client.handler_latencies,
+            "client": client, "notes": f"{deleted} deleted, {edited} edited"}
+
+async def bench_filter_index(options):
+    client = make_client(options, messages=0)
+    rng = random.Random(options.seed)
+    filters = make_filters(client, options.sizes["filters"], rng)
+    index = main.ChatFilterIndex(filters)
+    chats = [rng.choice(client.dialog_list).entity for _ in range(1000)]
+    checks = options.sizes["checks"]
+    samples = []
+    matched = 0
+    started = time.perf_counter()
+    # Замеряем пачками по 100 вызовов, чтобы накладные расходы таймера не исказили результат
+    for batch in range(0, checks, 100):
+        batch_started = time.perf_counter()
+        for offset in range(min(100, checks - batch)):
+            matched += main.is_monitored_chat(chats[(batch + offset) % 1000], (batch + offset) % 5 or None, index)
+        samples.append((time.perf_counter() - batch_started) / 100)
+    seconds = time.perf_counter() - started
+    return {"operations": checks, "seconds": seconds, "samples": samples, "notes": f"{matched} matched"}
+
+async def bench_filter_list(options):
+    # Старый способ вызова: список фильтров компилируется в индекс при каждой проверке
+    client = make_client(options, messages=0)
+    rng = random.Random(options.seed)
+    filters = make_filters(client, options.sizes["filters"], rng)
+    chats = [rng.choice(client.dialog_list).entity for _ in range(100)]
+    checks = max(1, options.sizes["checks"] // 100)
+    samples = []
+    started = time.perf_counter()
+    for index in range(checks):
+        call_started = time.perf_counter()
+        main.is_monitored_chat(chats[index % 100], None, filters)
+        samples.append(time.perf_counter() - call_started)
+    seconds = time.perf_counter() - started
+    return {"operations": checks, "seconds": seconds, "samples": samples}
+
+async def bench_send(options):
+    client = make_client(options, messages=0)
+    chat_ids = list(client.entities)
+    samples = []
+    sent = 0
+    started = time.perf_counter()
+    for index in range(options.sizes["sends"]):
+        call_started = time.perf_counter()
+        sent += await main.send_message_safe(client, chat_ids[index % len(chat_ids)], f"Benchmark {index}")
+        samples.append(time.perf_counter() - call_started)
+    seconds = time.perf_counter() - started
+    return {"operations": options.sizes["sends"], "seconds": seconds, "samples": samples, "client": client,
+            "notes": f"{sent} sent"}
+
+async def bench_send_bulk(options):
+    client = make_client(options, messages=0)
+    chat_ids = list(client.entities)
+    chats = [chat_ids[index % len(chat_ids)] for index in range(options.sizes["sends"])]
+    started = time.perf_counter()
+    sent = 0
+    # Повторы в списке отправляются один раз, поэтому рассылка идёт партиями по числу чатов
+    for start in range(0, len(chats), len(chat_ids)):
+        results = await main.send_messages_bulk(client, chats[start:start + len(chat_ids)], "Benchmark")
+        sent += sum(result["status"] == "sent" for result in results)
+    seconds = time.perf_counter() - started
+    return {"operations": len(chats), "seconds": seconds, "samples": [], "client": client, "notes": f"{sent} sent"}
+
+async def bench_search(options):
+    index = main.SearchIndex("search.db")
+    rng = random.Random(options.seed)
+    records = ({
+        "id": message_id,
+        "date": datetime.fromtimestamp(BASE_TIMESTAMP + message_id, timezone.utc).isoformat(),
+        "text": " ".join(rng.choice(SEARCH_WORDS[:10] if rng.random() < 0.5 else SEARCH_WORDS) for _ in range(rng.randint(3, 25))),
+        "sender_id": 1000 + message_id % 97,
+    } for message_id in range(1, options.sizes["indexed"] + 1))
+    started = time.perf_counter()
+    for start in range(0, options.sizes["indexed"], 1000):
+        index.add((next(records) for _ in range(min(1000, options.sizes["indexed"] - start))), chat_id=-1001)
+    index_seconds = time.perf_counter() - started
+
+    queries = ["слово123", '"добрый вечер"', "сигн*", "отчет", "слово42*"]
+    samples = []
+    found = 0
+    started = time.perf_counter()
+    for number in range(options.sizes["queries"]):
+        call_started = time.perf_counter()
+        found += len(index.search(queries[number % len(queries)], sender_id=1001 if number % 2 else None))
+        samples.append(time.perf_counter() - call_started)
+    seconds = time.perf_counter() - started
+    index.close()
+    return {"operations": options.sizes["queries"], "seconds": seconds, "samples": samples,
+            "notes": f"indexed {options.sizes['indexed'] / index_seconds:.0f} msg/s, {found} results"}
+
+async def bench_records(options):
+    rng = random.Random(options.seed)
+    messages = []
+    for message_id in range(1, options.sizes["records"] + 1):
+        message = FakeMessage(message_id, topic_id=rng.choice((None, 15)))
+        message.message = " ".join(rng.choice(SEARCH_WORDS) for _ in range(rng.randint(3, 25)))
+        messages.append(message)
+
+    def legacy(message):
+        # Формат записи до MessageRecord: словарь с ISO-датой и всеми полями
+        return {"id": message.id, "date": message.date.isoformat(), "text": message.text or "",
+                "sender_id": message.sender_id, "reply_to": message.reply_to.reply_to_msg_id if message.reply_to else None}
+
+    def measure(build):
+        tracemalloc.start()
+        items = [build(message) for message in messages]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return items, size / len(items)
+
+    dicts, dict_bytes = measure(legacy)
+    items, record_bytes = measure(lambda message: records.MessageRecord.from_message(message, formatted=True))
+
+    started = time.perf_counter()
+    sizes = {
+        # Исходный формат проекта: весь файл — массив JSON с indent=4
+        "json indent=4": len(json.dumps(dicts, ensure_ascii=False, indent=4).encode("utf-8")),
+        # JsonlSink до MessageRecord: json.dumps с пробелами после разделителей
+        "previous jsonl": len("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in dicts).encode("utf-8")),
+    }
+    for name, codec in (("jsonl", records.JsonCodec()), ("msgpack", records.BinaryCodec())):
+        data = codec.encode(items)
+        sizes[name] = len(data)
+        with open(f"records{codec.extension}", "wb") as f:
+            f.write(codec.header() + data)
+        decoded = sum(1 for _ in records.read_records(f"records{codec.extension}"))
+        assert decoded == len(items), f"{name}: decoded {decoded} of {len(items)}"
+    seconds = time.perf_counter() - started
+    per_message = ", ".join(f"{name} {size / len(items):.0f} B" for name, size in sizes.items())
+    return {"operations": len(items) * 2, "seconds": seconds,
+            "notes": f"memory dict {dict_bytes:.0f} B vs record {record_bytes:.0f} B; {per_message}"}
+
+async def bench_export_pool(options):
+    # Скорость задаётся на сессию, как лимиты Telegram на аккаунт; одна сессия пула получает долгий FloodWait
+    rate = options.rate or 50.0
+    per_chat = max(1, options.sizes["pooled"] // POOL_CHATS)
+    timings = {}
+    for sessions in (1, POOL_SESSIONS):
+        ratelimit.rate_limiter = main.RateLimiter(rates={"history": rate, "entity": rate})
+        main.entity_cache = main.EntityCache(None)
+        clients = {f"session{number}": make_client(options, dialogs=POOL_CHATS, messages=per_chat)
+                   for number in range(sessions)}
+        if sessions > 1:
+            flooded = clients["session1"]
+            flooded.flood_rate, flooded.flood_seconds = 0.05, 600
+        pool = main.ClientPool(clients)
+        targets = [{"id": chat_id, "name": str(chat_id)} for chat_id in next(iter(clients.values())).entities]
+        started = time.perf_counter()
+        results = await main.export_chats(pool, targets, f"exports{sessions}", concurrency=2)
+        timings[sessions] = time.perf_counter() - started
+        assert all(result["status"] == "ok" for result in results), results
+    stats = pool.stats()
+    failovers = sum(session["failovers"] for session in stats.values())
+    return {"operations": per_chat * POOL_CHATS, "seconds": timings[POOL_SESSIONS],
+            "api_calls": sum(client.requests for client in clients.values()),
+            "notes": f"1 session {timings[1]:.2f}s vs {POOL_SESSIONS} sessions {timings[POOL_SESSIONS]:.2f}s, "
+                     f"{failovers} failovers, jobs {[session['jobs'] for session in stats.values()]}"}
+
+BENCHMARKS = {
+    "history": bench_history,
+    "history_partitioned": bench_history_partitioned,
+    "save_all_chats": bench_save_all_chats,
+    "save_all_chats_incremental": bench_save_all_chats_incremental,
+    "listener": bench_listener,
+    "listener_edits": bench_listener_edits,
+    "filter_index": bench_filter_index,
+    "filter_list": bench_filter_list,
+    "send": bench_send,
+    "send_bulk": bench_send_bulk,
+    "search": bench_search,
+    "records": bench_records,
+    "export_pool": bench_export_pool,
+}
+
+def run_benchmark(name, options):
+    """
+    Выполняет один бенчмарк во временном каталоге. Вызывается в отдельном процессе.
+
+    :param name: Имя бенчмарка из BENCHMARKS.
+    :param options: Разобранные аргументы командной строки.
+    :return: Словарь с результатами.
+    """
+    main.console.quiet = True
+    # Ограничитель запросов не должен маскировать скорость самого кода, если не задано иное
+    rate = options.rate or 1_000_000
+    ratelimit.rate_limiter = main.RateLimiter(rates={method: rate for method in main.RateLimiter.DEFAULT_RATES})
+
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        os.chdir(workdir)
+        # Журнал настраивается как при обычном запуске, application.log пишется во временный каталог
+        main.configure_logging(level=options.log_level)
+        try:
+            main.entity_cache = main.EntityCache(os.path.join(workdir, "entity_cache.json"))
+            result = asyncio.run(BENCHMARKS[name](options))
+        finally:
+            main.shutdown_logging()
+            os.chdir(previous_dir)
+
+    client = result.pop("client", None)
+    samples = result.pop("samples", None)
+    seconds = result["seconds"]
+    result.update(percentiles(samples or []))
+    result.update({
+        "name": name,
+        "seconds": round(seconds, 3),
+        "throughput": round(result["operations"] / seconds, 1) if seconds and result["operations"] else 0.0,
+        "api_calls": client.requests if client else result.get("api_calls", 0),
+        "floods": client.floods if client else 0,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+def peak_rss_mb():
+    """
+    Возвращает пиковый RSS текущего процесса в МБ или None, если модуль resource недоступен (Windows).
+    """
+    if resource is None:
+        return None
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def compare(results, baseline, tolerance):
+    """
+    Сравнивает пропускную способность с базовым запуском.
+
+    :return: Список имён бенчмарков, которые замедлились больше чем на tolerance.
+    """
+    previous = {item["name"]: item for item in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["name"])
+        if old and old["throughput"] and result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append(result["name"])
+    return regressions
+
+def print_results(results, regressions=()):
+    table = Table(title="Benchmark results")
+    for column in ("Benchmark", "Operations", "Seconds", "Ops/s", "p50 ms", "p95 ms", "p99 ms",
+                   "API calls", "Floods", "Peak RSS MB", "Notes"):
+        table.add_column(column, justify="left" if column in ("Benchmark", "Notes") else "right")
+    for result in results:
+        name = f"[bold red]{result['name']}[/bold red]" if result["name"] in regressions else result["name"]
+        table.add_row(
+            name,
+            str(result["operations"]),
+            str(result["seconds"]),
+            str(result["throughput"]),
+            str(result.get("p50_ms", "-")),
+            str(result.get("p95_ms", "-")),
+            str(result.get("p99_ms", "-")),
+            str(result["api_calls"]),
+            str(result["floods"]),
+            str(result["peak_rss_mb"] if result["peak_rss_mb"] is not None else "-"),
+            result.get("notes", ""),
+        )
+    main.console.print(table)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for telegram-chat-reader.")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier for data sizes (1 = 10^6 messages, 10^4 dialogs, 10^3 filters).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of every API request, seconds.")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Fraction of API requests failing with FloodWaitError.")
+    parser.add_argument("--rate", type=float, default=None, help="Rate limiter requests/s (default: effectively unlimited).")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", help="Save results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare throughput with results saved by --json.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed throughput drop against the baseline.")
+    options = parser.parse_args(argv)
+    options.sizes = {key: max(1, int(value * options.scale)) for key, value in SCALES.items()}
+    return options
+
+def run(argv=None):
+    options = parse_args(argv)
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for name in options.only or BENCHMARKS:
+        main.console.print(f"[bold cyan]Running {name}...[/bold cyan]")
+        # Новый процесс на каждый бенчмарк: пиковый RSS не накапливается между ними
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(run_benchmark, name, options).result())
+
+    regressions = []
+    if options.baseline:
+        regressions = compare(results, main.load_json_file(options.baseline, default=[]), options.tolerance)
+    print_results(results, regressions)
+    if options.json:
+        main.write_json_atomic(options.json, results)
+    if regressions:
+        main.console.print(f"[bold red]Throughput regressions: {', '.join(regressions)}[/bold red]")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
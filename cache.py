@@ -0,0 +1,207 @@
+"""
+Кэш сведений о чатах.
+
+EntityCache хранит производные факты о чатах (нормализованный ID, название, признаки форума
+и канала, право на отправку) с вытеснением по LRU, сроком жизни и сохранением на диск,
+чтобы не повторять get_entity и get_permissions после перезапуска.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from telethon.tl import types
+
+from ratelimit import dispatch, limiter_for
+from records import normalize_chat_id
+from sinks import load_json_file, write_json_atomic
+
+logger = logging.getLogger("example")  # Журнал приложения, настраивается в main.configure_logging
+
+class EntityCache:
+    """
+    Кэш сведений о чатах с вытеснением по LRU, сроком жизни записей и сохранением на диск.
+
+    Хранит не сами объекты Telethon, а производные факты, которые используются в коде:
+    нормализованный ID, название, username, признаки форума/канала/супергруппы и право
+    на отправку сообщений. После перезапуска кэш загружается с диска, поэтому повторные
+    запросы get_entity и get_permissions не нужны, пока записи не устарели.
+
+    :param path: Путь к JSON-файлу кэша (None — без сохранения на диск).
+    :param max_size: Максимальное количество записей.
+    :param ttl: Время жизни записи в секундах.
+    """
+
+    def __init__(self, path="entity_cache.json", max_size=10000, ttl=3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # ключ -> (время записи, сведения о чате)
+        self._loaded = path is None
+
+    @staticmethod
+    def key(chat):
+        """
+        Приводит ID или username к ключу кэша.
+        """
+        if isinstance(chat, str):
+            chat = chat.strip()
+            if chat.lstrip("-").isdigit():
+                return int(chat)
+            return chat.lstrip("@").lower()
+        return chat
+
+    @staticmethod
+    def from_entity(entity):
+        """
+        Извлекает из объекта Telethon сведения, которые хранятся в кэше.
+
+        :param entity: Объект чата, канала или пользователя.
+        :return: Словарь со сведениями о чате.
+        """
+        return {
+            "id": normalize_chat_id(entity),
+            "title": getattr(entity, "title", None),
+            "username": getattr(entity, "username", None),
+            "forum": bool(getattr(entity, "forum", False)),
+            "broadcast": bool(getattr(entity, "broadcast", False)),
+            "megagroup": bool(getattr(entity, "megagroup", False)),
+            "creator": bool(getattr(entity, "creator", False)),
+            "admin": bool(getattr(entity, "admin_rights", None)),
+            "can_send": EntityCache.send_rights(entity),
+        }
+
+    @staticmethod
+    def send_rights(entity):
+        """
+        Определяет право на отправку сообщений по самому объекту чата, без get_permissions.
+
+        Для супергрупп и групп Telegram передаёт в объекте общие ограничения чата
+        (default_banned_rights) и ограничения текущего пользователя (banned_rights).
+
+        :param entity: Объект чата, канала или пользователя.
+        :return: True/False или None, если по объекту право определить нельзя.
+        """
+        if isinstance(entity, types.User):
+            return True
+        if getattr(entity, "left", False) or getattr(entity, "deactivated", False):
+            return False
+        if getattr(entity, "creator", False) or getattr(entity, "admin_rights", None):
+            return True
+        if getattr(entity, "broadcast", False):
+            return None  # Права на публикацию в канале проверяются при отправке
+        rights = [getattr(entity, name, None) for name in ("banned_rights", "default_banned_rights")]
+        rights = [item for item in rights if item is not None]
+        if not rights:
+            return None
+        return not any(item.send_messages for item in rights)
+
+    def get(self, chat):
+        """
+        Возвращает сведения о чате или None, если записи нет или она устарела.
+
+        :param chat: ID чата или username.
+        """
+        self._load()
+        key = self.key(chat)
+        item = self._entries.get(key)
+        if item is None or time.time() - item[0] > self.ttl:
+            if item is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, chat, info):
+        """
+        Сохраняет сведения о чате под ключом chat и под нормализованным ID.
+
+        :param chat: ID чата или username.
+        :param info: Словарь сведений (см. from_entity).
+        :return: info.
+        """
+        self._load()
+        now = time.time()
+        for key in {self.key(chat), info["id"]}:
+            self._entries[key] = (now, info)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return info
+
+    def put_entity(self, entity, chat=None):
+        """
+        Сохраняет сведения об объекте Telethon.
+
+        :param entity: Объект чата, канала или пользователя.
+        :param chat: Дополнительный ключ (например, исходный username).
+        :return: Сведения о чате.
+        """
+        info = self.from_entity(entity)
+        return self.put(info["id"] if chat is None else chat, info)
+
+    def __contains__(self, chat):
+        # Проверка без учёта в счётчиках попаданий и промахов
+        item = self._entries.get(self.key(chat)) if self._loaded else None
+        return item is not None and time.time() - item[0] <= self.ttl
+
+    def invalidate(self, chat):
+        """
+        Удаляет запись о чате (например, после переименования).
+        """
+        self._load()
+        info = self._entries.pop(self.key(chat), (None, None))[1]
+        if info is not None:
+            self._entries.pop(info["id"], None)
+
+    async def resolve(self, client, chat):
+        """
+        Возвращает сведения о чате из кэша или запрашивает их через get_entity.
+
+        :param client: TelegramClient, авторизованный клиент, или ClientPool.
+        :param chat: ID чата или username.
+        :return: Сведения о чате.
+        """
+        info = self.get(chat)
+        if info is None:
+            entity = await dispatch(client, "entity",
+                                    lambda session: limiter_for(session).call("entity", session.get_entity, self.key(chat)))
+            info = self.put_entity(entity, chat)
+        return info
+
+    def stats(self):
+        """
+        Возвращает счётчики попаданий и промахов.
+        """
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+    def save(self):
+        """
+        Сохраняет кэш на диск.
+        """
+        if self.path is None or not self._loaded:
+            return
+        try:
+            write_json_atomic(self.path, [[key, stored, info] for key, (stored, info) in self._entries.items()])
+        except OSError as e:
+            logger.error(f"Failed to save entity cache to {self.path}: {e}")
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        now = time.time()
+        for key, stored, info in load_json_file(self.path, default=[]):
+            if now - stored <= self.ttl:
+                self._entries[key] = (stored, info)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,500 @@
+"""
+Неинтерактивный режим для cron, systemd и скриптов.
+
+Команды вызывают те же функции, что и меню main.py, но параметры берутся из аргументов
+командной строки или из файла заданий (JSON или YAML). main.py вместе с Telethon, rich и
+настройкой журнала импортируется только тогда, когда команде нужен Telegram, поэтому --help
+и проверка файла заданий работают мгновенно. Все задания одного запуска используют один
+авторизованный клиент.
+
+    python cli.py list-chats --output all_chats.json
+    python cli.py export -1001234567890 -1001234567891:15 --output-dir exports
+    python cli.py sync --chats-file all_chats.json --storage sqlite
+    python cli.py monitor -1001234567890 @channel:3,7 --duration 3600
+    python cli.py send @channel -1001234567890 --text "Nightly export finished"
+    python cli.py index exports/ monitored_messages.jsonl
+    python cli.py search '"добрый вечер" отч*' --chat -1001234567890 --since 2024-01-01
+    python cli.py run jobs.yaml
+
+Файл заданий — список заданий или объект {"continue_on_error": ..., "jobs": [...]}. Ключи задания
+совпадают с длинными параметрами команды (дефисы можно заменять подчёркиваниями):
+
+    continue_on_error: true
+    jobs:
+      - command: list-chats
+      - command: sync
+        chats_file: all_chats.json
+        concurrency: 8
+      - command: send
+        chats: ["@channel"]
+        text: "Sync finished"
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+main = None  # Модуль main.py, загружается при первом обращении к Telegram
+
+# Команды, которым не нужен Telegram: main.py для них не импортируется
+OFFLINE_COMMANDS = ("index", "search")
+
+def load_main():
+    """
+    Импортирует main.py (Telethon, rich) при первой необходимости, загружает .env и настраивает журнал.
+
+    :return: Модуль main.
+    """
+    global main
+    if main is None:
+        import main as module
+        module.load_config()
+        module.configure_logging()
+        main = module
+    return main
+
+def log_error(message):
+    """
+    Пишет ошибку в журнал main.py, а если он не загружен (офлайн-команды) — в stderr.
+    """
+    if main is not None:
+        main.logger.error(message)
+    else:
+        print(message, file=sys.stderr)
+
+def archive_files(paths):
+    """
+    Раскрывает каталоги в список архивов (*.jsonl, *.msgpack, *.db) для индексации.
+
+    :param paths: Пути к файлам и каталогам.
+    :return: Список путей к файлам.
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            files.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.endswith((".jsonl", ".msgpack", ".db", ".sqlite", ".sqlite3")))
+    return files
+
+def parse_chat_spec(spec):
+    """
+    Разбирает описание чата вида "ID", "@username" или "название" с необязательным
+    списком топиков через двоеточие: "-1001234567890:15" или "@forum:3,7".
+
+    :param spec: Строка или число.
+    :return: Кортеж (чат, список ID топиков или None). Числовой ID возвращается как int.
+    """
+    spec = str(spec).strip()
+    topics = None
+    chat, sep, tail = spec.rpartition(":")
+    if sep and tail.replace(",", "").isdigit():
+        spec = chat
+        topics = [int(topic) for topic in tail.split(",") if topic]
+    if spec.lstrip("-").isdigit():
+        return int(spec), topics
+    return spec, topics
+
+def read_chat_lines(path):
+    """
+    Читает текстовый файл с одним описанием чата на строку (пустые строки и # пропускаются).
+
+    :param path: Путь к файлу.
+    :return: Список строк.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith("#")]
+
+def load_job_file(path):
+    """
+    Загружает файл заданий. YAML поддерживается, если установлен PyYAML.
+
+    :param path: Путь к файлу .json, .yaml или .yml.
+    :return: Кортеж (список заданий, continue_on_error).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML job files require PyYAML (pip install pyyaml); use JSON instead")
+            data = yaml.safe_load(f)
+        else:
+            data = json.load(f)
+
+    continue_on_error = False
+    if isinstance(data, dict):
+        continue_on_error = bool(data.get("continue_on_error", False))
+        data = data.get("jobs")
+    if not isinstance(data, list) or not all(isinstance(job, dict) for job in data):
+        raise ValueError("Job file must contain a list of jobs")
+    return data, continue_on_error
+
+class Runner:
+    """
+    Выполняет команды с общим клиентом Telegram.
+
+    Клиент создаётся и авторизуется при первой команде, которой он нужен, и переиспользуется
+    всеми следующими; после команды monitor с --duration он переподключается. Если в SESSIONS
+    перечислено несколько сессий, list-chats, export и sync распределяют работу по main.ClientPool,
+    а остальные команды используют его основную сессию.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._pool = None
+        self._metrics_server = None
+        self._indexes = {}
+
+    def open_index(self, path):
+        """
+        Открывает поисковый индекс один раз на весь запуск.
+
+        :param path: Путь к файлу индекса (None — без индексации).
+        :return: search.SearchIndex или None.
+        """
+        if path is None:
+            return None
+        if path not in self._indexes:
+            from search import SearchIndex
+            self._indexes[path] = SearchIndex(path)
+        return self._indexes[path]
+
+    async def client(self):
+        """
+        Возвращает подключённый авторизованный клиент.
+
+        :return: TelegramClient.
+        """
+        load_main()
+        if self._client is None:
+            if len(main.SESSIONS) > 1:
+                self._pool = await main.ClientPool.connect(interactive=sys.stdin.isatty())
+                self._client = self._pool.primary if self._pool is not None else None
+            else:
+                self._client = await main.manual_authorization(interactive=sys.stdin.isatty())
+            if self._client is None:
+                raise RuntimeError("Authorization failed")
+            if main.METRICS_PORT:
+                self._metrics_server = await main.metrics.serve(port=int(main.METRICS_PORT))
+        elif not self._client.is_connected():
+            await self._client.connect()
+        return self._client
+
+    async def pool(self):
+        """
+        Возвращает пул сессий, если их несколько, иначе клиент.
+
+        :return: main.ClientPool или TelegramClient.
+        """
+        client = await self.client()
+        return self._pool or client
+
+    async def close(self):
+        for index in self._indexes.values():
+            index.close()
+        if main is None:
+            return
+        main.entity_cache.save()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        if self._pool is not None:
+            await self._pool.close()
+        elif self._client is not None:
+            await self._client.disconnect()
+
+    async def resolve_targets(self, args):
+        """
+        Собирает цели выгрузки из аргументов chats и chats_file.
+
+        :return: Список целей {"id": ..., "topic_id": ..., "name": ...} (см. main.load_export_targets).
+        """
+        specs = list(args.chats or [])
+        targets = []
+        if args.chats_file:
+            if args.chats_file.endswith(".json"):
+                targets.extend(main.load_export_targets(args.chats_file, per_topic=args.per_topic))
+            else:
+                specs.extend(read_chat_lines(args.chats_file))
+        for spec in specs:
+            chat, topics = parse_chat_spec(spec)
+            if not isinstance(chat, int):
+                info = await main.entity_cache.resolve(await self.client(), chat)
+                chat = info["id"]
+            for topic_id in topics or [None]:
+                targets.append({"id": chat, "topic_id": topic_id, "name": str(spec)})
+        if not targets:
+            raise ValueError("No chats specified")
+        return targets
+
+    async def list_chats(self, args):
+        await main.save_all_chats(await self.pool(), output_file=args.output, concurrency=args.concurrency,
+                                  incremental=not args.full)
+        return True
+
+    async def export(self, args, incremental=False):
+        targets = await self.resolve_targets(args)
+        results = await main.export_chats(await self.pool(), targets, args.output_dir, concurrency=args.concurrency,
+                                          incremental=incremental, on_error=args.on_error, storage=args.storage,
+                                          index=self.open_index(args.index))
+        return all(result["status"] == "ok" for result in results)
+
+    async def sync(self, args):
+        return await self.export(args, incremental=True)
+
+    async def monitor(self, args):
+        monitored_chats = []
+        for spec in args.chats or []:
+            chat, topics = parse_chat_spec(spec)
+            monitored_chats.append({
+                "id": chat if isinstance(chat, int) else None,
+                "username": chat.lstrip("@") if isinstance(chat, str) and chat.startswith("@") else None,
+                "title": chat if isinstance(chat, str) and not chat.startswith("@") else None,
+                "topics": topics,
+            })
+        if not monitored_chats:
+            raise ValueError("No chats specified")
+
+        client = await self.client()
+        stop_handle = None
+        if args.duration:
+            # Отключение клиента завершает run_until_disconnected, слушатель сбрасывает данные и выходит
+            stop_handle = asyncio.get_running_loop().call_later(
+                args.duration, lambda: asyncio.ensure_future(client.disconnect()))
+        try:
+            await main.listen_to_messages(client, monitored_chats, args.output, record_file=args.record,
+                                          catch_up=not args.no_catch_up, quiet=args.quiet or None,
+                                          index=self.open_index(args.index), track_edits=not args.no_edits)
+        finally:
+            if stop_handle is not None:
+                stop_handle.cancel()
+        return True
+
+    async def send(self, args):
+        chats = [parse_chat_spec(spec)[0] for spec in args.chats or []]
+        if args.chats_file:
+            chats.extend(main.load_send_targets(args.chats_file))
+        if not chats:
+            raise ValueError("No chats specified")
+        if args.text_file:
+            with open(args.text_file, "r", encoding="utf-8") as f:
+                text = f.read().strip()
+        else:
+            text = args.text
+        if not text:
+            raise ValueError("Message text is empty")
+        results = await main.send_messages_bulk(await self.client(), chats, text, concurrency=args.concurrency,
+                                                retries=args.retries, report_file=args.report)
+        return all(result["status"] in ("sent", "duplicate") for result in results)
+
+    async def index(self, args):
+        index = self.open_index(args.index)
+        files = archive_files(args.paths)
+        if not files:
+            raise ValueError("No archives to index")
+        for path in files:
+            if os.path.abspath(path) == os.path.abspath(args.index):
+                continue
+            started = time.monotonic()
+            try:
+                count = index.index_archive(path, chat_id=args.chat_id, topic_id=args.topic_id)
+            except ValueError as e:
+                print(f"Skipping {path}: {e}", file=sys.stderr)
+                continue
+            print(f"{path}: {count} messages indexed in {time.monotonic() - started:.1f}s")
+        if args.optimize:
+            index.optimize()
+        print(f"Index {args.index}: {index.stats()}")
+        return True
+
+    async def search(self, args):
+        if not os.path.exists(args.index):
+            raise ValueError(f"Search index {args.index} not found")
+        started = time.perf_counter()
+        results = self.open_index(args.index).search(args.query, chat_id=args.chat, topic_id=args.topic,
+                                                     sender_id=args.sender, since=args.since, until=args.until,
+                                                     limit=args.limit, rank_window=args.rank_window)
+        elapsed = (time.perf_counter() - started) * 1000
+        for result in results:
+            if args.json:
+                print(json.dumps(result, ensure_ascii=False))
+            else:
+                topic = f"/{result['topic_id']}" if result["topic_id"] else ""
+                snippet = " ".join(result["snippet"].split())
+                print(f"{result['score']:>8}  {result['date']}  {result['chat_id']}{topic}#{result['message_id']}  {snippet}")
+        print(f"{len(results)} results in {elapsed:.1f} ms", file=sys.stderr)
+        return True
+
+    async def run_job(self, args):
+        """
+        Выполняет одну команду.
+
+        :param args: Разобранные параметры команды (argparse.Namespace).
+        :return: True при успехе.
+        """
+        handler = getattr(self, args.command.replace("-", "_"))
+        if args.command in OFFLINE_COMMANDS:
+            return await handler(args)
+        load_main()
+        started = time.monotonic()
+        main.logger.info(f"Starting job '{args.command}'")
+        try:
+            ok = await handler(args)
+        finally:
+            main.entity_cache.save()
+        main.logger.info(f"Job '{args.command}' {'finished' if ok else 'failed'} in {time.monotonic() - started:.1f}s")
+        return ok
+
+    async def run_jobs(self, jobs, continue_on_error=False):
+        """
+        Выполняет задания по очереди с общим клиентом.
+
+        :param jobs: Список argparse.Namespace.
+        :param continue_on_error: Продолжать после неудачного задания.
+        :return: Количество неудачных заданий.
+        """
+        failed = 0
+        try:
+            for index, args in enumerate(jobs, 1):
+                try:
+                    ok = await self.run_job(args)
+                except Exception as e:
+                    log_error(f"Job {index} '{args.command}' failed: {e}")
+                    ok = False
+                if not ok:
+                    failed += 1
+                    if not continue_on_error:
+                        break
+        finally:
+            await self.close()
+        return failed
+
+def add_target_arguments(parser, per_topic=True):
+    parser.add_argument("chats", nargs="*", help="Chat IDs or @usernames, optionally with topics: -100123:15 or @forum:3,7.")
+    parser.add_argument("--chats-file", help="Chat list: all_chats.json from list-chats or a text file with one chat per line.")
+    if per_topic:
+        parser.add_argument("--per-topic", action="store_true", help="Export each forum topic from --chats-file separately.")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Headless mode of the Telegram Monitoring Tool.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("list-chats", help="Save all chats and forum topics to a JSON file.")
+    command.add_argument("--output", default="all_chats.json")
+    command.add_argument("--concurrency", type=int, default=8)
+    command.add_argument("--full", action="store_true", help="Refetch topics of every forum, ignoring the previous snapshot.")
+
+    for name, help_text in (("export", "Export full chat history."), ("sync", "Fetch only new messages since the last run.")):
+        command = commands.add_parser(name, help=help_text)
+        add_target_arguments(command)
+        command.add_argument("--output-dir", default="exports")
+        command.add_argument("--concurrency", type=int, default=4)
+        command.add_argument("--storage", choices=("jsonl", "msgpack", "sqlite"), default="jsonl")
+        command.add_argument("--on-error", choices=("continue", "abort"), default="continue")
+        command.add_argument("--index", help="Add exported messages to this full-text search index.")
+
+    command = commands.add_parser("monitor", help="Listen to new messages in chats.")
+    command.add_argument("chats", nargs="*", help="Chat IDs, @usernames or titles, optionally with topics: -100123:15.")
+    command.add_argument("--output", default="monitored_messages.jsonl")
+    command.add_argument("--duration", type=float, help="Stop after this many seconds (default: run until stopped).")
+    command.add_argument("--record", help="Record incoming events to this file.")
+    command.add_argument("--no-catch-up", action="store_true", help="Do not backfill messages missed while offline.")
+    command.add_argument("--no-edits", action="store_true", help="Do not record message edits and deletions.")
+    command.add_argument("--quiet", action="store_true", help="Do not print every message to the console.")
+    command.add_argument("--index", help="Add received messages to this full-text search index.")
+
+    command = commands.add_parser("send", help="Send a message to one or more chats.")
+    add_target_arguments(command, per_topic=False)
+    text = command.add_mutually_exclusive_group()
+    text.add_argument("--text")
+    text.add_argument("--text-file")
+    command.add_argument("--concurrency", type=int, default=8)
+    command.add_argument("--retries", type=int, default=3)
+    command.add_argument("--report", default="send_report.json")
+
+    command = commands.add_parser("index", help="Add archived messages (JSONL, MessagePack, SQLite) to the search index.")
+    command.add_argument("paths", nargs="+", help="Archive files or directories with them.")
+    command.add_argument("--index", default="search.db")
+    command.add_argument("--chat-id", type=int, help="Chat ID for records without one (default: from the file name).")
+    command.add_argument("--topic-id", type=int)
+    command.add_argument("--optimize", action="store_true", help="Merge index segments after indexing.")
+
+    command = commands.add_parser("search", help="Search archived messages. Query: words, \"phrases\", prefix*, OR.")
+    command.add_argument("query")
+    command.add_argument("--index", default="search.db")
+    command.add_argument("--chat", type=int, help="Chat ID.")
+    command.add_argument("--topic", type=int, help="Topic ID.")
+    command.add_argument("--sender", type=int, help="Sender ID.")
+    command.add_argument("--since", help="Start date (ISO, e.g. 2024-01-01).")
+    command.add_argument("--until", help="End date (ISO, exclusive).")
+    command.add_argument("--limit", type=int, default=20)
+    command.add_argument("--rank-window", type=int,
+                         help="Rank only this many most recently indexed matches (faster for common words; default: all).")
+    command.add_argument("--json", action="store_true", help="Print results as JSON lines.")
+
+    command = commands.add_parser("run", help="Run jobs from a JSON or YAML file with one shared client.")
+    command.add_argument("job_file")
+    command.add_argument("--continue-on-error", action="store_true")
+    parser.commands = commands.choices  # Парсеры команд, по ним проверяются задания из файла
+    return parser
+
+def parse_jobs(parser, path):
+    """
+    Превращает задания из файла в argparse.Namespace с проверкой параметров.
+
+    :param parser: Парсер из build_parser.
+    :param path: Путь к файлу заданий.
+    :return: Кортеж (список заданий, continue_on_error).
+    """
+    jobs, continue_on_error = load_job_file(path)
+    parsed = []
+    for index, job in enumerate(jobs, 1):
+        job = {key.replace("-", "_"): value for key, value in job.items()}
+        command = job.pop("command", None)
+        if command not in parser.commands or command == "run":
+            raise ValueError(f"Job {index}: unknown command {command!r}")
+        actions = [action for action in parser.commands[command]._actions if action.dest != "help"]
+        args = argparse.Namespace(command=command, **{action.dest: action.default for action in actions})
+        unknown = set(job) - set(vars(args))
+        if unknown:
+            raise ValueError(f"Job {index} '{command}': unknown options {', '.join(sorted(unknown))}")
+        missing = [action.dest for action in actions
+                   if not action.option_strings and action.nargs in (None, "+") and action.dest not in job]
+        if missing:
+            raise ValueError(f"Job {index} '{command}': missing {', '.join(missing)}")
+        for key in ("chats", "paths"):
+            if isinstance(job.get(key), (str, int)):
+                job[key] = [job[key]]
+        vars(args).update(job)
+        parsed.append(args)
+    return parsed, continue_on_error
+
+def run(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        try:
+            jobs, continue_on_error = parse_jobs(parser, args.job_file)
+        except (OSError, ValueError) as e:
+            print(f"Invalid job file {args.job_file}: {e}", file=sys.stderr)
+            return 2
+        continue_on_error = continue_on_error or args.continue_on_error
+    else:
+        jobs, continue_on_error = [args], False
+
+    try:
+        failed = asyncio.run(Runner().run_jobs(jobs, continue_on_error))
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if main is not None:
+            main.shutdown_logging()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -1,49 +1,215 @@
 from telethon import TelegramClient, errors, events
 from telethon.tl.types import InputMessagesFilterPinned # Для фильтрации закрепленных сообщений
 from telethon.tl.functions.channels import GetForumTopicsRequest  # Для получения списка тем форума
+from telethon.tl import types
+from telethon.extensions import BinaryReader  # Для разбора записанных обновлений
 import asyncio
+from collections import OrderedDict
 from asyncio.exceptions import TimeoutError
 from dotenv import load_dotenv # Для загрузки конфигурации из .env
 from datetime import datetime
 import json
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import colorlog
+import hashlib
 import os
+import queue
+import shutil
+import struct
+import time
+import zlib
 from rich.console import Console
+from rich.markup import escape
+from rich.table import Table
+from cache import EntityCache
+from metrics import metrics
+from ratelimit import RateLimiter, SessionUnavailable, dispatch, failover_after, limiter_for
+from records import CHANNEL_ID_OFFSET, BinaryCodec, MessageRecord, normalize_chat_id
+from search import SearchIndex
+# MessageSink, SqliteSink и query_messages по-прежнему доступны как main.*
+from sinks import (SQLITE_EXTENSIONS, BinarySink, JsonlSink, MessageSink, SqliteSink, load_json_file, open_sink,
+                   query_messages, write_json_atomic)
 
 console = Console()
 
-# Загрузка переменных из .env
-load_dotenv()
-API_ID = int(os.getenv("API_ID"))
-API_HASH = os.getenv("API_HASH")
-PHONE_NUMBER = os.getenv("PHONE_NUMBER")
-TELEGRAM_PASSWORD = os.getenv("TELEGRAM_PASSWORD")
+# Настройки из .env. До вызова load_config() действуют значения по умолчанию, учётных данных нет
+API_ID = None
+API_HASH = None
+PHONE_NUMBER = None
+TELEGRAM_PASSWORD = None
+METRICS_PORT = None  # Порт HTTP-выдачи метрик (пусто — выключено)
+METRICS_LOG_INTERVAL = None  # Интервал (сек) строки метрик в логе (пусто — выключено)
+
+LOG_ASYNC = True  # Писать журнал из фонового потока
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Ротация application.log по размеру (0 — без ротации)
+LOG_BACKUP_COUNT = 5  # Количество старых файлов журнала
+LOG_RATE_LIMIT = 0  # Записей в секунду с одного места вызова (0 — без ограничения)
+LOG_QUIET = False  # Не выводить каждое отслеживаемое сообщение в консоль
+
+# Файлы сессий: несколько авторизованных аккаунтов объединяются в ClientPool, первая сессия — основная
+SESSIONS = ["session"]
+SESSION_MAX_FLOOD_WAIT = 30.0  # Более долгий FloodWait переключает задачу на другую сессию
+# FloodWait (сек), который Telethon пережидает сам (по умолчанию как в Telethon); более долгие получает RateLimiter
+FLOOD_SLEEP_THRESHOLD = 60
+
+def load_config():
+    """
+    Загружает настройки из .env и переменных окружения.
+
+    Вызывается точками входа, которые подключаются к Telegram (меню main.py и команды cli.py),
+    поэтому импорт main.py не читает .env и не требует API_ID.
+
+    :raises RuntimeError: Если не заданы API_ID или API_HASH.
+    """
+    global API_ID, API_HASH, PHONE_NUMBER, TELEGRAM_PASSWORD, METRICS_PORT, METRICS_LOG_INTERVAL
+    global LOG_ASYNC, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_RATE_LIMIT, LOG_QUIET
+    global SESSIONS, SESSION_MAX_FLOOD_WAIT, FLOOD_SLEEP_THRESHOLD
+    load_dotenv()
+    if not os.getenv("API_ID") or not os.getenv("API_HASH"):
+        raise RuntimeError("API_ID and API_HASH must be set in .env or in the environment")
+    API_ID = int(os.getenv("API_ID"))
+    API_HASH = os.getenv("API_HASH")
+    PHONE_NUMBER = os.getenv("PHONE_NUMBER")
+    TELEGRAM_PASSWORD = os.getenv("TELEGRAM_PASSWORD")
+    METRICS_PORT = os.getenv("METRICS_PORT")
+    METRICS_LOG_INTERVAL = os.getenv("METRICS_LOG_INTERVAL")
+
+    LOG_ASYNC = os.getenv("LOG_ASYNC", "1") != "0"
+    LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+    LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+    LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 0))
+    LOG_QUIET = os.getenv("LOG_QUIET", "0") == "1"
+
+    # Файлы сессий перечисляются через запятую
+    SESSIONS = [name.strip() for name in os.getenv("SESSIONS", "session").split(",") if name.strip()]
+    SESSION_MAX_FLOOD_WAIT = float(os.getenv("SESSION_MAX_FLOOD_WAIT", 30))
+    FLOOD_SLEEP_THRESHOLD = int(os.getenv("FLOOD_SLEEP_THRESHOLD", 60))
+
+class LogRateLimiter(logging.Filter):
+    """
+    Ограничивает количество записей журнала с одного места вызова: не больше limit в секунду.
+
+    Записи уровня ERROR и выше проходят всегда. Количество отброшенных записей
+    дописывается к первой записи с того же места в следующей секунде.
 
-# Настройка логгера
-handler = colorlog.StreamHandler()
-handler.setFormatter(colorlog.ColoredFormatter('%(log_color)s%(message)s'))
+    :param limit: Максимум записей в секунду с одного места вызова.
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self._windows = {}  # (файл, строка) -> [секунда, пропущено, отброшено]
 
-file_handler = logging.FileHandler("application.log", encoding="utf-8")
-file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        second = int(record.created)
+        window = self._windows.get(key)
+        if window is None or window[0] != second:
+            suppressed = window[2] if window else 0
+            window = self._windows[key] = [second, 0, 0]
+            if suppressed:
+                record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+                record.args = None
+        if window[1] >= self.limit:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
 
 logger = colorlog.getLogger('example')
-logger.addHandler(handler)
-logger.addHandler(file_handler)
+log_listener = None  # Фоновый поток записи журнала (QueueListener)
+
+def configure_logging(async_mode=None, max_bytes=None, backup_count=None, rate_limit=None, level=logging.INFO):
+    """
+    Настраивает журнал: цветной вывод в консоль и файл application.log с ротацией по размеру.
+
+    В асинхронном режиме logger.* только кладёт запись в очередь (QueueHandler), а в консоль
+    и файл её пишет фоновый поток QueueListener, поэтому ввод-вывод не задерживает цикл событий.
+
+    :param async_mode: Писать журнал из фонового потока (None — LOG_ASYNC).
+    :param max_bytes: Размер application.log, после которого файл ротируется (0 — без ротации, None — LOG_MAX_BYTES).
+    :param backup_count: Количество старых файлов журнала (None — LOG_BACKUP_COUNT).
+    :param rate_limit: Максимум записей в секунду с одного места вызова (0 — без ограничения, None — LOG_RATE_LIMIT).
+    :param level: Минимальный уровень журнала.
+    """
+    global log_listener
+    async_mode = LOG_ASYNC if async_mode is None else async_mode
+    max_bytes = LOG_MAX_BYTES if max_bytes is None else max_bytes
+    backup_count = LOG_BACKUP_COUNT if backup_count is None else backup_count
+    rate_limit = LOG_RATE_LIMIT if rate_limit is None else rate_limit
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        old_handler.close()
+    for old_filter in list(logger.filters):
+        logger.removeFilter(old_filter)
+
+    stream_handler = colorlog.StreamHandler()
+    stream_handler.setFormatter(colorlog.ColoredFormatter('%(log_color)s%(message)s'))
+    if max_bytes:
+        file_handler = RotatingFileHandler("application.log", maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    else:
+        file_handler = logging.FileHandler("application.log", encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    if async_mode:
+        log_queue = queue.SimpleQueue()
+        log_listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+        log_listener.start()
+        logger.addHandler(QueueHandler(log_queue))
+    else:
+        logger.addHandler(stream_handler)
+        logger.addHandler(file_handler)
+
+    if rate_limit:
+        logger.addFilter(LogRateLimiter(rate_limit))
+    logger.setLevel(level)
+
+def shutdown_logging():
+    """
+    Дописывает записи, оставшиеся в очереди журнала, и останавливает фоновый поток.
+    """
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
 
-# Устанавливаем минимальный уровень логирования
-logger.setLevel(logging.INFO)
+# Общий кэш сведений о чатах
+entity_cache = EntityCache()
 
-async def manual_authorization():
-    client = TelegramClient("session", API_ID, API_HASH)
+async def manual_authorization(interactive=True, session=None, phone=None):
+    """
+    Подключается к Telegram и при необходимости выполняет вход по коду подтверждения.
+
+    :param interactive: Разрешить запрос кода и пароля через input(). Без него неавторизованная
+        сессия считается ошибкой (режим cli.py без терминала).
+    :param session: Имя файла сессии (по умолчанию первая из SESSIONS).
+    :param phone: Номер телефона аккаунта (None — PHONE_NUMBER для сессии по умолчанию, для остальных спросить при входе).
+    :return: Авторизованный TelegramClient или None.
+    """
+    if not session:
+        session, phone = SESSIONS[0], phone or PHONE_NUMBER
+    # Короткие FloodWait пережидает сам Telethon, в том числе для запросов, которые не идут через RateLimiter
+    client = TelegramClient(session, API_ID, API_HASH, flood_sleep_threshold=FLOOD_SLEEP_THRESHOLD)
     await client.connect()
 
     # Проверяем, авторизован ли пользователь
     if not await client.is_user_authorized():
-        logger.warning(f"Not authorized. Sending code to: {PHONE_NUMBER}")
+        if not interactive:
+            logger.error(f"Session {session} is not authorized. Run main.py once in a terminal to sign in.")
+            await client.disconnect()
+            return
+        phone = phone or input(f"Enter the phone number for session {session}: ").strip()
+        logger.warning(f"Not authorized. Sending code to: {phone}")
 
         try:
-            await client.send_code_request(PHONE_NUMBER)
+            await client.send_code_request(phone)
         except errors.AuthRestartError:
             logger.warning("Telegram requested to restart the authorization process.")
             console.print("[bold yellow]Telegram is having internal issues. Please try again later.[/bold yellow]")
@@ -54,10 +220,10 @@ async def manual_authorization():
 
         code = input("Enter the code you received: ")
         try:
-            await client.sign_in(PHONE_NUMBER, code)
+            await client.sign_in(phone, code)
         except errors.SessionPasswordNeededError:
             logger.warning("Password is required for 2FA. Enter your password:")
-            password = TELEGRAM_PASSWORD or input("Enter your Telegram password: ")
+            password = (TELEGRAM_PASSWORD if phone == PHONE_NUMBER else None) or input("Enter your Telegram password: ")
             try:
                 await client.sign_in(password=password)
                 logger.info("Successfully signed in with password!")
@@ -70,7 +236,199 @@ async def manual_authorization():
 
     logger.info("Authorization successful!")
     return client
-    
+
+class ClientPool:
+    """
+    Пул авторизованных сессий Telegram для распределения выгрузки между несколькими аккаунтами.
+
+    Лимиты и FloodWait Telegram считаются на аккаунт, поэтому у каждой сессии свой RateLimiter.
+    Задача (выгрузка чата, загрузка тем форума, get_entity) отдаётся наименее загруженной доступной
+    сессии: подключённой и не заблокированной для класса методов задачи. Если FloodWait длиннее
+    max_flood_wait или соединение потеряно, сессия уходит на паузу, а задача повторяется на другой
+    (выгрузка истории продолжается с контрольной точки). Отключённые сессии переподключаются в фоне.
+
+    Все аккаунты должны состоять в выгружаемых чатах: access_hash у каждого аккаунта свой,
+    поэтому сессия должна сама знать чат (warm_up() загружает её список диалогов).
+
+    :param clients: Словарь {имя сессии: TelegramClient}; первая сессия — основная (список диалогов, отправка).
+    :param max_flood_wait: FloodWait (сек), после которого задача переходит на другую сессию (None — SESSION_MAX_FLOOD_WAIT).
+    :param reconnect_delay: Пауза (сек) между попытками переподключить отключённую сессию.
+    """
+
+    def __init__(self, clients, max_flood_wait=None, reconnect_delay=30.0):
+        if not clients:
+            raise ValueError("Client pool needs at least one session")
+        self.max_flood_wait = SESSION_MAX_FLOOD_WAIT if max_flood_wait is None else max_flood_wait
+        self.reconnect_delay = reconnect_delay
+        self.sessions = []
+        for name, client in clients.items():
+            # Базовые скорости у сессий те же, что у общего ограничителя, но FloodWait и подстройка — свои
+            client.rate_limiter = RateLimiter(rates=limiter_for(client).base_rates)
+            self.sessions.append({"name": name, "client": client, "active": 0, "jobs": 0, "failovers": 0,
+                                  "healthy": True, "reconnect": None})
+
+    @classmethod
+    async def connect(cls, names=None, interactive=True, warm_up=True, **kwargs):
+        """
+        Авторизует сессии и собирает из них пул. Недоступные сессии пропускаются.
+
+        :param names: Имена файлов сессий (по умолчанию SESSIONS).
+        :param interactive: Разрешить вход по коду через input().
+        :param warm_up: Загрузить списки диалогов дополнительных сессий (см. warm_up()).
+        :param kwargs: Параметры ClientPool.
+        :return: ClientPool или None, если не авторизована ни одна сессия.
+        """
+        clients = {}
+        for position, name in enumerate(names or SESSIONS):
+            # Номер из .env относится к основной сессии, для остальных он спрашивается при входе
+            client = await manual_authorization(interactive, session=name, phone=PHONE_NUMBER if position == 0 else None)
+            if client is None:
+                logger.error(f"Session {name} is not available. Continuing without it.")
+                continue
+            clients[name] = client
+        if not clients:
+            return None
+        pool = cls(clients, **kwargs)
+        logger.info(f"Client pool ready: {', '.join(clients)}")
+        if warm_up:
+            await pool.warm_up()
+        return pool
+
+    @property
+    def primary(self):
+        """
+        Основная сессия: её список диалогов сохраняется, через неё отправляются сообщения и работает слушатель.
+        """
+        return self.sessions[0]["client"]
+
+    async def warm_up(self):
+        """
+        Загружает списки диалогов дополнительных сессий, чтобы Telethon сохранил в них access_hash чатов
+        и get_entity(ID) работал на любой сессии. Сессии загружаются параллельно.
+        """
+        async def load(session):
+            client = session["client"]
+            count = 0
+            try:
+                async for _ in limiter_for(client).iterate("dialogs", client.iter_dialogs()):
+                    count += 1
+                logger.info(f"Session {session['name']}: {count} dialogs loaded")
+            except (SessionUnavailable, errors.RPCError, ConnectionError) as e:
+                logger.warning(f"Failed to load dialogs of session {session['name']}: {e}")
+
+        await asyncio.gather(*(load(session) for session in self.sessions[1:]))
+
+    async def run(self, method, job, *args, **kwargs):
+        """
+        Выполняет задачу job(client, *args, **kwargs) на наименее загруженной доступной сессии.
+
+        При SessionUnavailable или потере соединения задача повторяется на другой сессии.
+        Задача должна быть повторяемой (как выгрузка с контрольной точкой).
+
+        :param method: Класс методов задачи ("history", "topics", "entity"): сессии, заблокированные для него
+            дольше max_flood_wait, не выбираются.
+        :param job: Корутинная функция, первым аргументом принимающая TelegramClient.
+        :return: Результат задачи.
+        """
+        attempts = 0
+        while True:
+            session = await self._acquire(method)
+            # Пока задача выполняется, ограничитель сессии не ждёт долгий FloodWait, а отдаёт задачу пулу
+            token = failover_after.set(self.max_flood_wait)
+            try:
+                result = await job(session["client"], *args, **kwargs)
+                if result is not None or session["client"].is_connected():
+                    return result
+                # Функции выгрузки сообщают об ошибке через None; если при этом потеряно соединение, пробуем другую сессию
+                error = ConnectionError("disconnected")
+            except (SessionUnavailable, ConnectionError) as e:
+                error = e
+            finally:
+                failover_after.reset(token)
+                session["active"] -= 1
+
+            attempts += 1
+            session["failovers"] += 1
+            metrics.inc("session_failovers_total", session=session["name"])
+            if isinstance(error, ConnectionError) or not session["client"].is_connected():
+                self._mark_disconnected(session)
+            if attempts >= 3 * len(self.sessions):
+                raise error
+            logger.warning(f"Session {session['name']} is unavailable ({error}). Moving '{method}' job to another session...")
+
+    async def _acquire(self, method):
+        while True:
+            for session in self.sessions:
+                if session["healthy"] and not session["client"].is_connected():
+                    self._mark_disconnected(session)
+            connected = [session for session in self.sessions if session["healthy"]]
+            available = [session for session in connected
+                         if limiter_for(session["client"]).blocked(method) <= self.max_flood_wait]
+            if available:
+                session = min(available, key=lambda item: (item["active"], item["jobs"]))
+                session["active"] += 1
+                session["jobs"] += 1
+                return session
+
+            if connected:
+                # Все подключённые сессии на паузе: ждём, пока первая из них сможет принять задачу
+                delay = min(limiter_for(session["client"]).blocked(method) for session in connected) - self.max_flood_wait
+            elif any(session["reconnect"] is not None for session in self.sessions):
+                delay = self.reconnect_delay
+            else:
+                raise ConnectionError("No sessions in the pool can connect to Telegram")
+            logger.warning(f"All sessions are paused for '{method}'. Waiting {delay:.0f} seconds...")
+            await asyncio.sleep(max(delay, 0.1))
+
+    def _mark_disconnected(self, session):
+        if not session["healthy"]:
+            return
+        session["healthy"] = False
+        metrics.inc("session_disconnects_total", session=session["name"])
+        logger.warning(f"Session {session['name']} disconnected. Reconnecting in {self.reconnect_delay} seconds...")
+        session["reconnect"] = asyncio.ensure_future(self._reconnect(session))
+
+    async def _reconnect(self, session):
+        client = session["client"]
+        while True:
+            await asyncio.sleep(self.reconnect_delay)
+            try:
+                await client.connect()
+                if not await client.is_user_authorized():
+                    logger.error(f"Session {session['name']} is no longer authorized. Removing it from rotation.")
+                    break
+                session["healthy"] = True
+                logger.info(f"Session {session['name']} reconnected")
+                break
+            except (OSError, ConnectionError) as e:
+                logger.warning(f"Failed to reconnect session {session['name']}: {e}")
+        session["reconnect"] = None
+
+    def stats(self):
+        """
+        Возвращает состояние сессий: количество задач, переключений и статистику ограничителей.
+        """
+        return {
+            session["name"]: {
+                "healthy": session["healthy"],
+                "active": session["active"],
+                "jobs": session["jobs"],
+                "failovers": session["failovers"],
+                "rate_limiter": limiter_for(session["client"]).stats(),
+            }
+            for session in self.sessions
+        }
+
+    async def close(self):
+        """
+        Останавливает переподключения и отключает все сессии.
+        """
+        for session in self.sessions:
+            if session["reconnect"] is not None:
+                session["reconnect"].cancel()
+            await session["client"].disconnect()
+
+@metrics.timed("send_message")
 async def send_message_safe(client, chat_id, message_text):
     """
     Отправляет сообщение в чат с проверкой, что пользователь имеет права на отправку.
@@ -79,6 +437,7 @@ async def send_message_safe(client, chat_id, message_text):
     :param chat_id: ID чата или username.
     :param message_text: Текст сообщения.
     """
+    info = None
     try:
         # async for dialog in client.iter_dialogs():
         #    logger.info(f"Name: {dialog.name}, ID: {dialog.id}")
@@ -87,43 +446,63 @@ async def send_message_safe(client, chat_id, message_text):
         if isinstance(chat_id, str):
             chat_id = int(chat_id)
         
-        # Получаем Entity (сущность чата, группы или канала)
-        try:
-            entity = await client.get_entity(chat_id)
-        except ValueError as e:
-            logger.error(f"Chat {chat_id} not found: {e}")
-            return False
-            
+        # Сведения о чате и право на отправку берём из кэша, если они ещё не устарели
+        info = entity_cache.get(chat_id)
+        entity = info["id"] if info else None
+        if info is None or info["can_send"] is None:
+            # Получаем Entity (сущность чата, группы или канала)
+            try:
+                entity = await limiter_for(client).call("entity", client.get_entity, chat_id)
+            except ValueError as e:
+                logger.error(f"Chat {chat_id} not found: {e}")
+                return False
+            info = entity_cache.from_entity(entity)
+
         # Если это канал (broadcast)
-        if getattr(entity, "broadcast", False):
+        if info["broadcast"]:
+            if info["can_send"] is False:
+                logger.warning(f"No permission to send messages to channel {chat_id}")
+                return False
             logger.warning(f"Chat {chat_id} is a channel. Sending messages may require admin rights.")
-            # Просто отправляем сообщение, так как проверка разрешений недоступна
-            await client.send_message(entity, message_text)
+            # Просто отправляем сообщение, так как проверка разрешений недоступна;
+            # право на отправку запоминаем только после успешной отправки
+            await limiter_for(client).call("send", client.send_message, entity, message_text)
+            entity_cache.put(chat_id, dict(info, can_send=True))
+            metrics.inc("messages_sent_total")
             logger.info(f"Message sent to channel {chat_id}: {message_text}")
             return True
-            
+
         # Если это не канал, проверяем разрешения на отправку сообщений
-        if hasattr(entity, "creator") and entity.creator:
+        if info["can_send"] is not None:
+            can_send_messages = info["can_send"]
+        elif info["creator"]:
             logger.info(f"You are the creator of the chat: {chat_id}.")
             can_send_messages = True
-        elif hasattr(entity, "admin_rights") and entity.admin_rights:
+        elif info["admin"]:
             logger.info(f"You are an admin in the chat: {chat_id}.")
             can_send_messages = True
         else:
-            permissions = await client.get_permissions(entity)
+            permissions = await limiter_for(client).call("entity", client.get_permissions, entity)
             can_send_messages = permissions.send_messages
-            
+        entity_cache.put(chat_id, dict(info, can_send=can_send_messages))
+
         if not can_send_messages:
             logger.warning(f"No permission to send messages to {chat_id}")
             return False
 
         # Отправляем сообщение
-        await client.send_message(entity, message_text)
+        await limiter_for(client).call("send", client.send_message, entity, message_text)
+        metrics.inc("messages_sent_total")
         logger.info(f"Message sent to chat {chat_id}: {message_text}")
         return True
 
     except errors.ChatWriteForbiddenError:
         logger.error(f"Cannot send message to {chat_id}: Write permissions are forbidden.")
+        # Запоминаем запрет, как и массовая рассылка, чтобы не повторять заведомо неудачную отправку
+        if info is not None:
+            entity_cache.put(chat_id, dict(info, can_send=False))
+        else:
+            entity_cache.invalidate(chat_id)
         return False
     except errors.RPCError as e:
         logger.error(f"RPCError while sending message to {chat_id}: {e}")
@@ -135,79 +514,383 @@ async def send_message_safe(client, chat_id, message_text):
         logger.critical(f"Unexpected error while sending message to {chat_id}: {e}")
         raise
     
+# Ошибки отправки, после которых имеет смысл повторить попытку
+TRANSIENT_SEND_ERRORS = (errors.FloodWaitError, errors.SlowModeWaitError, errors.ServerError, errors.TimedOutError,
+                         ConnectionError, asyncio.TimeoutError)
+# Ошибки, означающие отсутствие права писать в чат
+FORBIDDEN_SEND_ERRORS = (errors.ChatWriteForbiddenError, errors.UserBannedInChannelError, errors.ChatAdminRequiredError,
+                         errors.ChannelPrivateError)
+
+def load_send_targets(path):
+    """
+    Загружает список чатов для массовой отправки.
+
+    Поддерживаются JSON-файл со списком чатов, созданный save_all_chats, и текстовый файл
+    с одним ID или username на строку (пустые строки и строки с # пропускаются).
+
+    :param path: Путь к файлу.
+    :return: Список ID чатов и username.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return [chat["id"] for chat in json.loads(content)]
+    lines = (line.strip() for line in content.splitlines())
+    return [line for line in lines if line and not line.startswith("#")]
+
+async def resolve_send_targets(client, chats, batch_size=100):
+    """
+    Получает сведения о чатах для массовой отправки: сначала из entity_cache, затем
+    одним запросом get_entity на пачку из batch_size чатов. Если запрос пачки не удался,
+    чаты из неё запрашиваются по одному, чтобы ненайденный чат не мешал остальным.
+
+    :param client: TelegramClient, авторизованный клиент.
+    :param chats: Список ID чатов и username.
+    :param batch_size: Количество чатов в одном запросе get_entity.
+    :return: Словарь {чат: сведения о чате или None, если чат не найден}.
+    """
+    resolved = {}
+    missing = []
+    for chat in chats:
+        info = entity_cache.get(chat)
+        if info is None:
+            missing.append(chat)
+        else:
+            resolved[chat] = info
+
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        try:
+            entities = await limiter_for(client).call("entity", client.get_entity, [EntityCache.key(chat) for chat in batch])
+        except (ValueError, errors.RPCError) as e:
+            logger.warning(f"Batch entity lookup failed ({e}), resolving {len(batch)} chats one by one")
+            entities = None
+        if entities is not None:
+            for chat, entity in zip(batch, entities):
+                resolved[chat] = entity_cache.put_entity(entity, chat)
+            continue
+        for chat in batch:
+            try:
+                resolved[chat] = await entity_cache.resolve(client, chat)
+            except (ValueError, errors.RPCError) as e:
+                logger.error(f"Chat {chat} not found: {e}")
+                resolved[chat] = None
+    return resolved
+
+async def send_messages_bulk(client, chats, message_text, concurrency=8, retries=3, report_file=None):
+    """
+    Отправляет одно сообщение во множество чатов.
+
+    Сведения о чатах и права на отправку определяются один раз на всю рассылку (см.
+    resolve_send_targets и EntityCache.send_rights); get_permissions запрашивается только
+    для чатов, право в которых нельзя определить по объекту чата. Отправка идёт параллельно,
+    не больше concurrency запросов одновременно; частоту ограничивает общий rate_limiter
+    (класс "send"), который сам ждёт после FloodWaitError. Временные ошибки повторяются
+    до retries раз с экспоненциальной задержкой.
+
+    :param client: TelegramClient, авторизованный клиент.
+    :param chats: Список ID чатов и username (повторы отправляются один раз).
+    :param message_text: Текст сообщения.
+    :param concurrency: Максимальное количество одновременных запросов.
+    :param retries: Максимальное количество повторов после временной ошибки.
+    :param report_file: Путь к JSON-файлу отчёта (None — не сохранять).
+    :return: Список результатов по каждому чату.
+    """
+    chats = list(dict.fromkeys(EntityCache.key(chat) for chat in chats))
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+    logger.info(f"Sending a message to {len(chats)} chats with concurrency {concurrency}...")
+
+    resolved = await resolve_send_targets(client, chats)
+    results = []
+
+    async def check_permission(chat, info):
+        # Права, которые нельзя определить по объекту чата, проверяются отдельным запросом
+        if info["can_send"] is not None or info["broadcast"]:
+            return info
+        async with semaphore:
+            try:
+                permissions = await limiter_for(client).call("entity", client.get_permissions, info["id"])
+            except errors.RPCError as e:
+                logger.warning(f"Failed to check permissions in chat {chat}: {e}")
+                return info
+        return entity_cache.put(chat, dict(info, can_send=permissions.send_messages))
+
+    seen = {}
+
+    async def send_one(chat, info):
+        result = {"chat": chat, "id": None, "title": None, "status": "not_found", "attempts": 0,
+                  "message_id": None, "error": None, "seconds": 0.0}
+        results.append(result)
+        if info is None:
+            return
+        result["id"], result["title"] = info["id"], info["title"]
+        # ID и username одного чата дают одну отправку
+        if info["id"] in seen:
+            result["status"], result["error"] = "duplicate", f"Same chat as {seen[info['id']]}"
+            return
+        seen[info["id"]] = chat
+        info = await check_permission(chat, info)
+        if info["can_send"] is False:
+            result["status"] = "forbidden"
+            result["error"] = "No permission to send messages"
+            return
+
+        async with semaphore:
+            call_started = time.monotonic()
+            for attempt in range(retries + 1):
+                result["attempts"] = attempt + 1
+                try:
+                    message = await limiter_for(client).call("send", client.send_message, info["id"], message_text)
+                except FORBIDDEN_SEND_ERRORS as e:
+                    entity_cache.put(chat, dict(info, can_send=False))
+                    result["status"], result["error"] = "forbidden", str(e)
+                    break
+                except TRANSIENT_SEND_ERRORS as e:
+                    result["status"], result["error"] = "failed", str(e)
+                    if attempt == retries:
+                        break
+                    delay = getattr(e, "seconds", None) or 2 ** attempt
+                    logger.warning(f"Retrying message to {chat} in {delay}s after error: {e}")
+                    await asyncio.sleep(delay)
+                except (ValueError, errors.RPCError) as e:
+                    result["status"], result["error"] = "failed", str(e)
+                    break
+                else:
+                    result["status"], result["error"] = "sent", None
+                    result["message_id"] = getattr(message, "id", None)
+                    break
+            result["seconds"] = round(time.monotonic() - call_started, 3)
+
+        metrics.inc("bulk_send_total", status=result["status"])
+        if result["status"] == "sent":
+            metrics.inc("messages_sent_total")
+        else:
+            logger.error(f"Message to {chat} {result['status']}: {result['error']}")
+
+    await asyncio.gather(*(send_one(chat, resolved[chat]) for chat in chats))
+    elapsed = time.monotonic() - started
+
+    statuses = [result["status"] for result in results]
+    summary = {
+        "chats": len(results),
+        "sent": statuses.count("sent"),
+        "forbidden": statuses.count("forbidden"),
+        "not_found": statuses.count("not_found"),
+        "failed": statuses.count("failed"),
+        "duplicate": statuses.count("duplicate"),
+        "seconds": round(elapsed, 3),
+        "rate": round(statuses.count("sent") / elapsed, 1) if elapsed else 0.0,
+        "results": results,
+        "rate_limiter": limiter_for(client).stats(),
+    }
+    if report_file:
+        write_json_atomic(report_file, summary)
+
+    table = Table(title="Bulk send summary")
+    for column in ("Chat", "Title", "Status", "Attempts", "Error"):
+        table.add_column(column)
+    for result in results:
+        if result["status"] != "sent":
+            table.add_row(str(result["chat"]), str(result["title"] or ""), result["status"], str(result["attempts"]),
+                          str(result["error"] or ""))
+    table.add_row("Total", "", f"{summary['sent']} sent / {summary['chats'] - summary['sent']} not sent", "",
+                  f"{summary['seconds']}s ({summary['rate']} msg/s)")
+    console.print(table)
+    logger.info(f"Bulk send finished: {summary['sent']} sent, {summary['forbidden']} forbidden, "
+                f"{summary['not_found']} not found, {summary['failed']} failed in {summary['seconds']}s "
+                f"({summary['rate']} msg/s)")
+    return results
+
 async def fetch_forum_topics(client, chat_id):
     """
     Получает список тем форума в указанном чате.
+
+    :param client: Авторизованный TelegramClient.
+    :param chat_id: ID чата с форумом.
+    :return: Список тем форума (при ошибке — темы, полученные до неё).
+    """
+    topics, _ = await load_forum_topics(client, chat_id)
+    return topics
+
+@metrics.timed("fetch_forum_topics")
+async def load_forum_topics(client, chat_id):
+    """
+    Получает список тем форума и признак того, что он загружен полностью.
+
+    Темы запрашиваются страницами по 100 штук; следующая страница начинается с
+    offset_date/offset_id/offset_topic последней полученной темы.
+
     :param client: Авторизованный TelegramClient.
     :param chat_id: ID чата с форумом.
-    :return: Список тем форума.
+    :return: Кортеж (список тем, True — если загрузка не прервалась ошибкой).
     """
     topics = []
+    seen = set()
+    complete = False
     try:
         logger.info(f"Fetching forum topics for chat: {chat_id}")
-        response = await client(GetForumTopicsRequest(
-            channel=chat_id,
-            offset_date=None,
-            offset_id=0,
-            offset_topic=0,
-            limit=100  # Количество тем, которое нужно получить (максимум 100 за раз)
-        ))
-
-        # Сохраняем темы в список
-        for topic in response.topics:
-            topics.append({
-                "id": topic.id,
-                "title": topic.title,
-            })
-            logger.info(f"Topic ID: {topic.id}, Title: {topic.title}")
+        offset_date, offset_id, offset_topic = None, 0, 0
+        while True:
+            response = await limiter_for(client).call("topics", client, GetForumTopicsRequest(
+                channel=chat_id,
+                offset_date=offset_date,
+                offset_id=offset_id,
+                offset_topic=offset_topic,
+                limit=100  # Количество тем, которое нужно получить (максимум 100 за раз)
+            ))
+
+            # Сохраняем темы в список
+            for topic in response.topics:
+                if topic.id in seen:
+                    continue
+                seen.add(topic.id)
+                title = getattr(topic, "title", None)  # У удалённых тем (ForumTopicDeleted) нет названия
+                topics.append({
+                    "id": topic.id,
+                    "title": title,
+                })
+                logger.info(f"Topic ID: {topic.id}, Title: {title}")
+
+            if not response.topics or len(topics) >= response.count:
+                break
+
+            # Смещение для следующей страницы берём из последней темы и её верхнего сообщения
+            last_topic = response.topics[-1]
+            top_message = getattr(last_topic, "top_message", 0)
+            dates = {message.id: message.date for message in response.messages}
+            next_offset = (dates.get(top_message), top_message, last_topic.id)
+            if next_offset == (offset_date, offset_id, offset_topic):
+                break
+            offset_date, offset_id, offset_topic = next_offset
+        complete = True
+    except SessionUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error fetching forum topics: {e}")
 
-    return topics
+    return topics, complete
     
-async def save_all_chats(client: TelegramClient, output_file: str = "chats.json"):
+def diff_chat_snapshots(old_chats, new_chats):
+    """
+    Сравнивает два снимка списка чатов (в формате save_all_chats).
+
+    :param old_chats: Предыдущий снимок.
+    :param new_chats: Новый снимок.
+    :return: Словарь с добавленными, удалёнными и переименованными чатами и изменениями тем форумов.
+    """
+    def diff_items(old_items, new_items, name_key):
+        old_by_id = {item["id"]: item for item in old_items}
+        new_by_id = {item["id"]: item for item in new_items}
+        return {
+            "added": [{"id": item_id, name_key: new_by_id[item_id].get(name_key)} for item_id in new_by_id.keys() - old_by_id.keys()],
+            "removed": [{"id": item_id, name_key: old_by_id[item_id].get(name_key)} for item_id in old_by_id.keys() - new_by_id.keys()],
+            "renamed": [{"id": item_id, "old": old_by_id[item_id].get(name_key), "new": new_by_id[item_id].get(name_key)}
+                        for item_id in old_by_id.keys() & new_by_id.keys()
+                        if old_by_id[item_id].get(name_key) != new_by_id[item_id].get(name_key)],
+        }
+
+    diff = diff_items(old_chats, new_chats, "name")
+    old_by_id = {chat["id"]: chat for chat in old_chats}
+    diff["topics"] = {}
+    for chat in new_chats:
+        old_chat = old_by_id.get(chat["id"])
+        if old_chat is None or "topics" not in chat:
+            continue
+        topics_diff = diff_items(old_chat.get("topics") or [], chat["topics"], "title")
+        if any(topics_diff.values()):
+            diff["topics"][str(chat["id"])] = topics_diff
+    return diff
+
+async def save_all_chats(client: TelegramClient, output_file: str = "chats.json", concurrency: int = 8,
+                         incremental: bool = True):
     """
     Сохраняет все чаты, включая темы, в указанный файл.
 
-    :param client: Авторизованный TelegramClient.
+    Темы всех форумов запрашиваются параллельно после обхода диалогов,
+    одновременно выполняется не больше concurrency запросов.
+
+    В инкрементальном режиме предыдущий снимок из output_file служит каталогом диалогов:
+    темы форума запрашиваются заново, только если изменились его последнее сообщение или дата
+    либо прошлая загрузка тем прервалась ошибкой (признак topics_complete в снимке).
+    Изменения относительно предыдущего снимка сохраняются в файл "<имя>.diff.json".
+
+    :param client: Авторизованный TelegramClient или ClientPool.
     :param output_file: Имя файла для сохранения данных (по умолчанию "chats.json").
+    :param concurrency: Максимальное количество форумов, темы которых загружаются одновременно.
+    :param incremental: Использовать предыдущий снимок, чтобы не загружать темы неизменившихся форумов.
+    :return: Изменения относительно предыдущего снимка (или None, если его не было).
     """
+    # Список диалогов берётся у основной сессии пула, темы форумов загружают все сессии
+    dialogs_client = client.primary if isinstance(client, ClientPool) else client
     try:
         logger.info("Fetching chats...")
+        previous_chats = load_json_file(output_file, default=None) if incremental else None
+        previous = {chat["id"]: chat for chat in previous_chats or []}
         all_chats = []
+        forums = []
 
-        async for dialog in client.iter_dialogs():
+        async for dialog in limiter_for(dialogs_client).iterate("dialogs", dialogs_client.iter_dialogs()):
             chat_data = {
                 "name": dialog.name,
                 "id": dialog.id,
                 "type": type(dialog.entity).__name__,
+                "top_message": dialog.message.id if dialog.message else None,
+                "date": dialog.date.isoformat() if dialog.date else None,
             }
-            
-            # Если это супергруппа с форумом, получаем темы
+
+            # Если это супергруппа с форумом, темы загрузим после обхода диалогов
             if getattr(dialog.entity, "forum", False):
-                logger.info(f"Chat {dialog.name} is a forum. Fetching topics...")
-                chat_data["topics"] = await fetch_forum_topics(client, dialog.id)
+                old_chat = previous.get(dialog.id)
+                if (old_chat and old_chat.get("topics_complete") and old_chat.get("top_message") == chat_data["top_message"]
+                        and old_chat.get("date") == chat_data["date"]):
+                    # В форуме ничего не изменилось, а темы в прошлый раз загружены полностью — берём их из снимка
+                    chat_data["topics"] = old_chat["topics"]
+                    chat_data["topics_complete"] = True
+                else:
+                    logger.info(f"Chat {dialog.name} is a forum. Fetching topics...")
+                    forums.append(chat_data)
 
             all_chats.append(chat_data)
 
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_topics(chat_data):
+            async with semaphore:
+                chat_data["topics"], chat_data["topics_complete"] = await dispatch(client, "topics", load_forum_topics,
+                                                                                    chat_data["id"])
+
+        await asyncio.gather(*(fetch_topics(chat_data) for chat_data in forums))
+        logger.info(f"Fetched {len(all_chats)} chats, topics refreshed for {len(forums)} forums")
+
+        diff = None
+        if previous_chats is not None:
+            diff = diff_chat_snapshots(previous_chats, all_chats)
+            logger.info(f"Chats added: {len(diff['added'])}, removed: {len(diff['removed'])}, "
+                        f"renamed: {len(diff['renamed'])}, forums with topic changes: {len(diff['topics'])}")
+
         # Сохраняем в файл
         try:
-            with open(output_file, "w", encoding="utf-8") as file:
-                json.dump(all_chats, file, ensure_ascii=False, indent=4)
+            write_json_atomic(output_file, all_chats)
+            if diff is not None:
+                diff["date"] = datetime.now().isoformat()
+                write_json_atomic(f"{os.path.splitext(output_file)[0]}.diff.json", diff)
             logger.info(f"Chats saved successfully to {output_file}")
         except Exception as e:
             logger.error(f"Failed to save chats to file: {e}")
 
+        return diff
+
     except errors.TimeoutError as e:
         logger.critical(f"Timeout error: {e}")
-        await client.disconnect()
+        await dialogs_client.disconnect()
         raise
     except errors.RPCError as e:
         logger.critical(f"Telegram API error: {e}")
         raise
     except ConnectionError as e:
         logger.critical(f"Connection error: {e}")
-        await client.disconnect()
+        await dialogs_client.disconnect()
         raise
     except Exception as e:
         logger.critical(f"Unexpected error: {e}")
@@ -272,15 +955,261 @@ async def test_send_message(client, chat_id: str, message_text: str) -> bool:
     else:
         console.print("[bold yellow]Message sending failed.[/bold yellow]")
         
-async def fetch_chat_history(client, chat_id, output_file="chat_history.json", topic_id=None, limit=None):
+class MediaDownloader:
+    """
+    Фоновая загрузка медиафайлов из сообщений с ограничением параллельности.
+
+    submit() сразу возвращает запись о файле (она сохраняется в записи сообщения), а сама загрузка
+    выполняется рабочими задачами, поэтому не задерживает загрузку истории и обработчик событий.
+    Файл хранится под ID фото или документа Telegram (<directory>/<type>_<id><ext>), поэтому повторно
+    пересланное медиа скачивается один раз. Одинаковые по содержимому файлы с разными ID (повторная
+    загрузка того же файла) определяются по SHA-256 и заменяются жёсткой ссылкой на первый.
+    Недокачанный файл (.part) дозагружается с того же места при следующей попытке.
+    Сведения о загруженных файлах дописываются в <directory>/index.jsonl.
+
+    :param client: TelegramClient.
+    :param directory: Каталог для файлов (по умолчанию "media").
+    :param concurrency: Количество одновременных загрузок.
+    :param max_size: Максимальный размер файла в байтах (None — без ограничения).
+    :param types: Загружаемые типы медиа ("photo", "video", "voice", "audio", "document", "sticker", "gif"), None — все.
+    :param queue_size: Максимальное количество ожидающих загрузок, лишние пропускаются.
+    """
+
+    REQUEST_SIZE = 512 * 1024  # Размер запроса upload.getFile (максимум Telegram)
+
+    def __init__(self, client, directory="media", concurrency=4, max_size=None, types=None, queue_size=10000):
+        self.client = client
+        self.directory = directory
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.types = set(types) if types else None
+        self.index_file = os.path.join(directory, "index.jsonl")
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+        self._pending = set()  # Ключи файлов в очереди или в загрузке
+        self._index = {}  # Ключ -> запись index.jsonl
+        self._hashes = {}  # SHA-256 -> путь к файлу
+        self._loaded = False
+
+    @staticmethod
+    def media_type(message):
+        """
+        Определяет тип медиа сообщения.
+
+        :return: Тип медиа или None, если в сообщении нет файла.
+        """
+        if isinstance(message.media, types.MessageMediaWebPage):
+            return None  # Превью ссылки — не вложение
+        if message.photo is not None:
+            return "photo"
+        for kind in ("voice", "video", "audio", "sticker", "gif"):
+            if getattr(message, kind, None) is not None:
+                return kind
+        if message.document is not None:
+            return "document"
+        return None
+
+    def start(self):
+        """
+        Загружает индекс и запускает рабочие задачи.
+        """
+        self._load()
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        return self
+
+    def submit(self, message):
+        """
+        Ставит медиа сообщения в очередь загрузки.
+
+        :param message: Объект сообщения Telethon.
+        :return: Запись о файле (type, key, path, size, mime_type, а также skipped с причиной) или None, если медиа нет.
+        """
+        kind = self.media_type(message)
+        if kind is None:
+            return None
+        media = message.photo if kind == "photo" else message.document
+        file = message.file
+        record = {
+            "type": kind,
+            "key": f"{kind}_{media.id}",
+            "path": os.path.join(self.directory, f"{kind}_{media.id}{file.ext or ''}"),
+            "size": file.size,
+            "mime_type": file.mime_type,
+        }
+        if self.types is not None and kind not in self.types:
+            return self._skip(record, "type")
+        if self.max_size is not None and file.size and file.size > self.max_size:
+            return self._skip(record, "size")
+        if record["key"] in self._index or record["key"] in self._pending:
+            # Этот файл уже скачан или скачивается
+            self.deduplicated += 1
+            metrics.inc("media_deduplicated_total", reason="id")
+            return record
+        try:
+            self._queue.put_nowait((record, message))
+        except asyncio.QueueFull:
+            return self._skip(record, "queue")
+        self._pending.add(record["key"])
+        return record
+
+    async def close(self, timeout=None):
+        """
+        Дожидается завершения поставленных загрузок и останавливает рабочие задачи.
+
+        :param timeout: Максимальное время ожидания (сек), None — без ограничения.
+        """
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except TimeoutError:
+            logger.warning(f"Media downloads not finished before shutdown: {self._queue.qsize()} pending")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        logger.info(f"Media downloader stats: {self.stats()}")
+
+    def stats(self):
+        return {
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "pending": self._queue.qsize(),
+        }
+
+    def _skip(self, record, reason):
+        self.skipped += 1
+        metrics.inc("media_skipped_total", reason=reason)
+        return dict(record, path=None, skipped=reason)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Оборванная последняя строка после сбоя
+                if os.path.exists(entry["path"]):
+                    self._index[entry["key"]] = entry
+                    self._hashes.setdefault(entry["sha256"], entry["path"])
+
+    async def _worker(self):
+        while True:
+            record, message = await self._queue.get()
+            try:
+                await self._download(record, message)
+            except Exception as e:
+                self.failed += 1
+                metrics.inc("media_failed_total")
+                logger.error(f"Failed to download {record['key']}: {e}")
+            finally:
+                self._pending.discard(record["key"])
+                self._queue.task_done()
+
+    async def _download(self, record, message):
+        path = record["path"]
+        part_path = f"{path}.part"
+        if not os.path.exists(path):
+            # Продолжаем с границы запроса, не превышающей размер уже скачанной части
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            offset -= offset % self.REQUEST_SIZE
+            try:
+                await self._fetch(record, message, part_path, offset)
+            except errors.FileReferenceExpiredError:
+                # Ссылка на файл устарела: перезапрашиваем сообщение и повторяем с того же места
+                message = await limiter_for(self.client).call("history", self.client.get_messages, message.chat_id, ids=message.id)
+                if message is None:
+                    raise
+                offset = os.path.getsize(part_path)
+                await self._fetch(record, message, part_path, offset - offset % self.REQUEST_SIZE)
+            os.replace(part_path, path)
+
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._sha256, path)
+        existing = self._hashes.get(digest)
+        if existing is not None and existing != path and os.path.exists(existing):
+            # То же содержимое уже есть под другим ID: оставляем одну копию на диске
+            try:
+                os.remove(path)
+                os.link(existing, path)
+            except OSError:
+                shutil.copyfile(existing, path)
+            self.deduplicated += 1
+            metrics.inc("media_deduplicated_total", reason="hash")
+        else:
+            self._hashes[digest] = path
+            self.downloaded += 1
+            metrics.inc("media_downloaded_total")
+            metrics.inc("media_bytes_total", os.path.getsize(path))
+
+        entry = dict(record, size=os.path.getsize(path), sha256=digest)
+        self._index[record["key"]] = entry
+        with open(self.index_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    async def _fetch(self, record, message, part_path, offset):
+        media = message.photo if record["type"] == "photo" else message.document
+        with open(part_path, "ab") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            download = self.client.iter_download(media, offset=offset, request_size=self.REQUEST_SIZE,
+                                                 file_size=message.file.size)
+            # Каждый фрагмент — отдельный запрос upload.getFile
+            async for chunk in limiter_for(self.client).iterate("download", download, chunk_size=1):
+                f.write(chunk)
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+def archive_record(message, media=None):
+    """
+    Преобразует сообщение Telethon в запись для сохранения в архив.
+
+    :param message: Объект сообщения.
+    :param media: MediaDownloader для загрузки вложений (None — вложения не сохраняются).
+    :return: MessageRecord (chat_id и topic_id задаёт хранилище).
+    """
+    record = MessageRecord.from_message(message, formatted=True)
+    if media is not None and message.media is not None:
+        record.media = media.submit(message)
+    return record
+
+async def fetch_chat_history(client, chat_id, output_file="chat_history.jsonl", topic_id=None, limit=None, resume=True,
+                             media=None, index=None):
     """
     Скачивает историю сообщений из указанного чата или топика форума.
 
+    Каждая пачка сообщений сразу записывается в хранилище (JSONL-файл или SQLite), после чего в файл
+    контрольной точки (output_file + ".checkpoint") записываются offset_id, количество сообщений и размер файла.
+    Прерванная загрузка продолжается с последней сохранённой пачки.
+
     :param client: TelegramClient, авторизованный клиент.
     :param chat_id: ID чата или username.
-    :param output_file: Имя файла для сохранения истории (по умолчанию "chat_history.json").
+    :param output_file: Имя файла для сохранения истории: JSONL или база SQLite (.db), см. open_sink
+        (по умолчанию "chat_history.jsonl").
     :param topic_id: ID топика форума (если указан, загружаются сообщения только из этого топика).
     :param limit: Максимальное количество сообщений для загрузки (по умолчанию None).
+    :param resume: Продолжить загрузку с контрольной точки, если она есть (по умолчанию True).
+    :param media: MediaDownloader для загрузки вложений (None — вложения не сохраняются).
+    :param index: SearchIndex для полнотекстового поиска по сохранённым сообщениям (None — без индексации).
+    :return: Количество сообщений, загруженных за этот запуск, или None при ошибке.
     """
     try:
         logger.info(f"Fetching history for chat ID {chat_id} with topic ID {topic_id}...")
@@ -289,254 +1218,1653 @@ async def fetch_chat_history(client, chat_id, output_file="chat_history.json", t
         if isinstance(chat_id, str):
             chat_id = int(chat_id)
 
-        # Получаем Entity чата
-        entity = await client.get_entity(chat_id)
-        logger.info(f"Entity fetched: {entity.title if hasattr(entity, 'title') else entity.id}")
-
-        # Итерируем сообщения
-        messages = []
-        
-        offset_id = 0  # Начинаем с самого нового сообщения
-        remaining_limit = limit  # Начинаем с указанного лимита (или None)
-        
-        while True:
-            try:
-                
-                # Если лимит не задан, запрашиваем максимум 100 сообщений за раз
-                fetch_limit = 100 if remaining_limit is None else min(100, remaining_limit)
-                batch_messages = []  # Сообщения за текущую итерацию
-                
-                async for message in client.iter_messages(entity, limit=fetch_limit, offset_id=offset_id, reply_to=topic_id):
-                    batch_messages.append({
-                        "id": message.id,
-                        "date": message.date.isoformat(),
-                        "text": message.text or "",
-                        "sender_id": message.sender_id,
-                        "reply_to": message.reply_to.reply_to_msg_id if message.reply_to else None,
-                    })
-                    offset_id = message.id  # Устанавливаем новый offset_id
+        # Получаем сведения о чате (из кэша, если они уже известны)
+        info = await entity_cache.resolve(client, chat_id)
+        entity = info["id"]
+        logger.info(f"Entity fetched: {info['title'] or info['id']}")
+
+        sink = open_sink(output_file, chat_id=info["id"], topic_id=topic_id, fsync="batch", index=index)
+        # JSONL-файл только дописывается, поэтому хвост после контрольной точки нужно обрезать.
+        # SQLite обновляет строки по ключу, повторная запись пачки не создаёт дубликатов,
+        # а одна база может хранить много чатов, поэтому контрольная точка ведётся на каждый чат.
+        append_only = isinstance(sink, JsonlSink)
+
+        checkpoint_file = f"{output_file}.checkpoint" if append_only else f"{output_file}.{info['id']}_{topic_id or 0}.checkpoint"
+        checkpoint = load_json_file(checkpoint_file) if resume else None
+        if checkpoint and (checkpoint.get("chat_id") != chat_id or checkpoint.get("topic_id") != topic_id):
+            logger.warning(f"Checkpoint {checkpoint_file} belongs to another chat or topic. Starting from scratch.")
+            checkpoint = None
+
+        if checkpoint and os.path.exists(output_file):
+            # Отбрасываем всё, что было записано после последней контрольной точки
+            offset_id = checkpoint["offset_id"]
+            total_fetched = checkpoint["count"]
+            if append_only and checkpoint.get("bytes") is not None:
+                with open(output_file, "r+b") as f:
+                    f.truncate(checkpoint["bytes"])
+            logger.info(f"Resuming export from message ID {offset_id}. Already fetched: {total_fetched}")
+        else:
+            offset_id = 0  # Начинаем с самого нового сообщения
+            total_fetched = 0
+            if append_only:
+                open(output_file, "w").close()
 
-                messages.extend(batch_messages)
-                if batch_messages:
-                    logger.info(f"Fetched {len(batch_messages)} messages. Total fetched: {len(messages)}. Last message ID: {offset_id}")
+        resumed_count = total_fetched
+        remaining_limit = None if limit is None else limit - total_fetched  # Оставшийся лимит (или None)
 
-                # Если сервер больше не возвращает сообщений, завершаем
-                if not batch_messages:
-                    break
-                    
-                # Уменьшаем лимит, если он задан
-                if remaining_limit is not None:
-                    remaining_limit -= len(messages)
-                    if remaining_limit <= 0:
+        try:
+            while remaining_limit is None or remaining_limit > 0:
+                try:
+                    # Если лимит не задан, запрашиваем максимум 100 сообщений за раз
+                    fetch_limit = 100 if remaining_limit is None else min(100, remaining_limit)
+                    batch_messages = []  # Сообщения за текущую итерацию
+                    batch_offset_id = offset_id
+                    batch_started = time.perf_counter()
+
+                    history = client.iter_messages(entity, limit=fetch_limit, offset_id=offset_id, reply_to=topic_id)
+                    async for message in limiter_for(client).iterate("history", history):
+                        batch_messages.append(archive_record(message, media))
+                        batch_offset_id = message.id  # Новый offset_id для следующей пачки
+
+                    # Если сервер больше не возвращает сообщений, завершаем
+                    if not batch_messages:
                         break
-                        
-                # Задержка между запросами
-                await asyncio.sleep(2)
-
-            except errors.FloodWaitError as e:
-                logger.warning(f"Rate limit exceeded. Waiting for {e.seconds} seconds...")
-                await asyncio.sleep(e.seconds)
-            except Exception as e:
-                logger.error(f"Unexpected error: {e}")
-                raise  # Пробрасываем неиспользуемое исключение
 
-        # Сохраняем историю сообщений в файл
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(messages, f, ensure_ascii=False, indent=4)
-        logger.info(f"Chat history saved to {output_file}")
+                    # Записываем пачку на диск и только после этого фиксируем контрольную точку
+                    sink.write_many(batch_messages)
+                    await sink.flush()
+                    offset_id = batch_offset_id
+                    total_fetched += len(batch_messages)
+                    metrics.inc("history_messages_total", len(batch_messages))
+                    metrics.observe("history_batch_seconds", time.perf_counter() - batch_started)
+                    write_json_atomic(checkpoint_file, {
+                        "chat_id": chat_id,
+                        "topic_id": topic_id,
+                        "offset_id": offset_id,
+                        "count": total_fetched,
+                        "bytes": os.path.getsize(output_file) if append_only else None,
+                    })
+                    logger.info(f"Fetched {len(batch_messages)} messages. Total fetched: {total_fetched}. Last message ID: {offset_id}")
+
+                    # Уменьшаем лимит, если он задан
+                    if remaining_limit is not None:
+                        remaining_limit -= len(batch_messages)
+
+                except errors.FloodWaitError as e:
+                    # RateLimiter уже заблокировал запросы истории на нужное время, повторяем пачку
+                    logger.warning(f"Rate limit exceeded {e.seconds} seconds after retries. Retrying batch...")
+                except SessionUnavailable:
+                    raise  # ClientPool продолжит выгрузку с контрольной точки на другой сессии
+                except Exception as e:
+                    logger.error(f"Unexpected error: {e}")
+                    raise  # Пробрасываем неиспользуемое исключение
+        finally:
+            await sink.close()
+
+        # Загрузка завершена, контрольная точка больше не нужна
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        logger.info(f"Chat history saved to {output_file}. Rate limiter stats: {limiter_for(client).stats()}")
 
         console.print(f"[bold green]Chat history successfully saved to {output_file}[/bold green]")
+        return total_fetched - resumed_count
 
     except errors.FloodWaitError as e:
         logger.warning(f"Rate limit exceeded. Waiting for {e.seconds} seconds...")
         await asyncio.sleep(e.seconds)
+    except SessionUnavailable:
+        raise
     except ValueError as e:
         logger.error(f"Chat {chat_id} not found: {e}")
     except errors.RPCError as e:
         logger.error(f"Telegram API error while fetching history: {e}")
     except Exception as e:
         logger.critical(f"Unexpected error while fetching history: {e}")
-        
-async def save_event_to_file(event, file_name="event_debug.jsonl"):
+
+async def fetch_chat_history_partitioned(client, chat_id, output_file="chat_history.jsonl", topic_id=None,
+                                         partitions=4, resume=True, media=None, index=None):
     """
-    Преобразует событие в сериализуемую структуру и сохраняет его в JSON-файл.
+    Скачивает историю большого чата параллельно, разбивая диапазон ID сообщений на части.
+
+    Диапазон [1, max_id], где max_id — ID самого нового сообщения, делится на partitions частей,
+    и каждая часть загружается своим курсором iter_messages(min_id, max_id) по возрастанию ID.
+    Курсоры делят общий лимит запросов "history" (см. RateLimiter), поэтому ускорение достигается
+    за счёт перекрытия сетевых задержек, а не за счёт превышения лимитов Telegram.
 
-    :param event: Событие, которое нужно преобразовать.
-    :param file_name: Имя файла для записи (по умолчанию "event_debug.jsonl").
+    Для JSONL каждая часть пишется во временный файл output_file + ".partN", а в конце части склеиваются
+    по порядку, так что итоговый файл упорядочен по возрастанию ID. В SQLite сообщения пишутся сразу.
+    Прогресс частей хранится в output_file + ".partitions", прерванная загрузка продолжается с него.
+
+    :param client: TelegramClient, авторизованный клиент.
+    :param chat_id: ID чата или username.
+    :param output_file: Имя файла для сохранения истории: JSONL или база SQLite (.db), см. open_sink.
+    :param topic_id: ID топика форума (если указан, загружаются сообщения только из этого топика).
+    :param partitions: Количество частей, загружаемых параллельно.
+    :param resume: Продолжить загрузку с сохранённого прогресса, если он есть (по умолчанию True).
+    :param media: MediaDownloader для загрузки вложений (None — вложения не сохраняются).
+    :param index: SearchIndex для полнотекстового поиска по сохранённым сообщениям (None — без индексации).
+    :return: Количество сообщений, загруженных за этот запуск, или None при ошибке.
     """
     try:
-        # Преобразуем событие в словарь
-        event_dict = event.to_dict()
-
-        # Рекурсивно обрабатываем словарь, конвертируя datetime в строку
-        def convert_to_serializable(obj):
-            if isinstance(obj, dict):
-                return {key: convert_to_serializable(value) for key, value in obj.items()}
-            elif isinstance(obj, list):
-                return [convert_to_serializable(item) for item in obj]
-            elif isinstance(obj, datetime):
-                return obj.isoformat()  # Преобразуем datetime в строку
-            elif hasattr(obj, "to_dict"):
-                return convert_to_serializable(obj.to_dict())  # Рекурсивно обрабатываем вложенные объекты
-            return obj  # Для всех других типов возвращаем как есть
-
-        serializable_event = convert_to_serializable(event_dict)
-
-        # Открываем файл в режиме дозаписи
-        with open(file_name, "a", encoding="utf-8") as f:
-            # Записываем объект как строку JSON
-            f.write(json.dumps(serializable_event, ensure_ascii=False, indent=4) + "\n")
-        logger.info(f"Event structure saved to {file_name}")
+        logger.info(f"Fetching history for chat ID {chat_id} with topic ID {topic_id} in {partitions} partitions...")
+
+        if isinstance(chat_id, str):
+            chat_id = int(chat_id)
+
+        info = await entity_cache.resolve(client, chat_id)
+        entity = info["id"]
+
+        plan_file = f"{output_file}.partitions"
+        plan = load_json_file(plan_file) if resume else None
+        if plan and (plan.get("chat_id") != chat_id or plan.get("topic_id") != topic_id):
+            logger.warning(f"Partition plan {plan_file} belongs to another chat or topic. Starting from scratch.")
+            plan = None
+
+        if plan is None:
+            # Самое новое сообщение задаёт верхнюю границу диапазона
+            newest = await limiter_for(client).call("history", client.get_messages, entity, limit=1, reply_to=topic_id)
+            max_id = newest[0].id if newest else 0
+            step = max(1, -(-max_id // max(1, partitions)))
+            ranges = [[low, min(low + step - 1, max_id)] for low in range(1, max_id + 1, step)]
+            plan = {
+                "chat_id": chat_id,
+                "topic_id": topic_id,
+                "max_id": max_id,
+                "ranges": ranges,
+                # last_id — ID последнего записанного сообщения части, bytes — размер её файла
+                "progress": [{"last_id": low - 1, "count": 0, "bytes": 0} for low, _ in ranges],
+            }
+            write_json_atomic(plan_file, plan)
+        else:
+            logger.info(f"Resuming partitioned export up to message ID {plan['max_id']}")
+
+        append_only = not output_file.lower().endswith(SQLITE_EXTENSIONS)
+        part_files = [f"{output_file}.part{part}" for part in range(len(plan["ranges"]))]
+        if append_only:
+            # Отбрасываем всё, что было записано в части после сохранённого прогресса
+            for part_file, progress in zip(part_files, plan["progress"]):
+                with open(part_file, "ab") as f:
+                    f.truncate(progress["bytes"])
+            sink_class = BinarySink if output_file.lower().endswith(BinaryCodec.extension) else JsonlSink
+            sinks = [sink_class(part_file, fsync="batch", chat_id=info["id"], topic_id=topic_id, index=index)
+                     for part_file in part_files]
+        else:
+            # Запись в SQLite сериализуется блокировкой хранилища, поэтому все части пишут в одно
+            shared_sink = open_sink(output_file, chat_id=info["id"], topic_id=topic_id, index=index)
+            sinks = [shared_sink] * len(plan["ranges"])
+
+        resumed_count = sum(progress["count"] for progress in plan["progress"])
 
+        async def fetch_range(part):
+            high = plan["ranges"][part][1]
+            progress = plan["progress"][part]
+            sink = sinks[part]
+            if progress["last_id"] >= high:
+                return
+            batch = []
+
+            async def commit():
+                # Сначала данные на диск, затем прогресс части
+                sink.write_many(batch)
+                await sink.flush()
+                progress["last_id"] = batch[-1]["id"]
+                progress["count"] += len(batch)
+                metrics.inc("history_messages_total", len(batch))
+                if append_only:
+                    progress["bytes"] = os.path.getsize(sink.path)
+                write_json_atomic(plan_file, plan)
+                batch.clear()
+
+            history = client.iter_messages(entity, min_id=progress["last_id"], max_id=high + 1,
+                                           reply_to=topic_id, reverse=True)
+            async for message in limiter_for(client).iterate("history", history):
+                batch.append(archive_record(message, media))
+                if len(batch) >= 100:
+                    await commit()
+            if batch:
+                await commit()
+            progress["last_id"] = high
+            write_json_atomic(plan_file, plan)
+            logger.info(f"Partition {part + 1}/{len(plan['ranges'])} done: {progress['count']} messages")
+
+        try:
+            results = await asyncio.gather(*(fetch_range(part) for part in range(len(plan["ranges"]))),
+                                           return_exceptions=True)
+        finally:
+            for sink in set(sinks):
+                await sink.close()
+
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            if isinstance(error, SessionUnavailable):
+                raise error  # Прогресс частей сохранён в плане, другая сессия пула продолжит с него
+        if failed:
+            for error in failed:
+                logger.error(f"Partition failed: {error}")
+            logger.warning(f"{len(failed)} partitions failed. Run again to resume from {plan_file}.")
+            return None
+
+        if append_only:
+            # Части не пересекаются и идут по возрастанию ID, поэтому склейка по порядку даёт упорядоченный файл
+            tmp_path = f"{output_file}.tmp"
+            with open(tmp_path, "wb") as out:
+                for part_file in part_files:
+                    with open(part_file, "rb") as part:
+                        shutil.copyfileobj(part, out)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, output_file)
+            for part_file in part_files:
+                os.remove(part_file)
+        os.remove(plan_file)
+
+        total_fetched = sum(progress["count"] for progress in plan["progress"])
+        logger.info(f"Chat history saved to {output_file}: {total_fetched} messages. Rate limiter stats: {limiter_for(client).stats()}")
+        console.print(f"[bold green]Chat history successfully saved to {output_file}[/bold green]")
+        return total_fetched - resumed_count
+
+    except SessionUnavailable:
+        raise
+    except ValueError as e:
+        logger.error(f"Chat {chat_id} not found: {e}")
+    except errors.RPCError as e:
+        logger.error(f"Telegram API error while fetching history: {e}")
     except Exception as e:
-        logger.error(f"Error while serializing event: {e}")
+        logger.critical(f"Unexpected error while fetching history: {e}")
+
+class SyncState:
+    """
+    Постоянное состояние инкрементальной синхронизации истории.
+
+    Для каждой пары (chat_id, topic_id) хранит ID самого нового и самого старого
+    уже заархивированных сообщений, их количество и признак того, что история
+    выгружена до самого начала.
+
+    :param path: Путь к JSON-файлу состояния (по умолчанию "sync_state.json").
+    """
+
+    def __init__(self, path="sync_state.json"):
+        self.path = path
+        self.chats = load_json_file(path, default={})
+
+    @staticmethod
+    def key(chat_id, topic_id=None):
+        return f"{chat_id}/{topic_id or 0}"
+
+    def get(self, chat_id, topic_id=None):
+        """
+        Возвращает состояние чата или топика (или None, если чат ещё не синхронизировался).
+        """
+        return self.chats.get(self.key(chat_id, topic_id))
+
+    def update(self, chat_id, topic_id=None, **fields):
+        """
+        Обновляет состояние чата или топика и сохраняет файл.
+        """
+        entry = self.chats.setdefault(self.key(chat_id, topic_id), {
+            "newest_id": None,
+            "oldest_id": None,
+            "count": 0,
+            "complete": False,
+        })
+        entry.update(fields)
+        write_json_atomic(self.path, self.chats)
+        return entry
+
+async def sync_chat_history(client, chat_id, output_file="chat_history.jsonl", topic_id=None, backfill=False,
+                            limit=None, state=None, media=None, index=None):
+    """
+    Инкрементальная синхронизация истории чата или топика форума.
+
+    Загружает только сообщения новее уже заархивированных (min_id = newest_id) и дописывает их
+    в хранилище. При первом запуске или при backfill=True дополнительно продолжает загрузку
+    истории вниз от самого старого заархивированного сообщения. Состояние сохраняется после
+    каждой записанной пачки, поэтому при сбое повторно загружается не больше одной пачки.
+
+    :param client: TelegramClient, авторизованный клиент.
+    :param chat_id: ID чата или username.
+    :param output_file: Имя файла архива: JSONL или база SQLite (.db) (по умолчанию "chat_history.jsonl").
+    :param topic_id: ID топика форума (или None).
+    :param backfill: Продолжить загрузку истории ниже самого старого заархивированного сообщения.
+    :param limit: Максимальное количество сообщений за запуск (по умолчанию None).
+    :param state: Объект SyncState (по умолчанию загружается из "sync_state.json").
+    :param media: MediaDownloader для загрузки вложений (None — вложения не сохраняются).
+    :param index: SearchIndex для полнотекстового поиска по сохранённым сообщениям (None — без индексации).
+    :return: Количество загруженных сообщений или None при ошибке.
+    """
+    if isinstance(chat_id, str):
+        chat_id = int(chat_id)
+    state = state or SyncState()
+    entry = state.get(chat_id, topic_id)
+    fetched = 0
+
+    try:
+        logger.info(f"Syncing history for chat ID {chat_id} with topic ID {topic_id}. State: {entry}")
+        entity = (await entity_cache.resolve(client, chat_id))["id"]
+        sink = open_sink(output_file, chat_id=entity, topic_id=topic_id, fsync="batch", index=index)
+
+        async def fetch_batch(**kwargs):
+            nonlocal fetched
+            fetch_limit = 100 if limit is None else min(100, limit - fetched)
+            if fetch_limit <= 0:
+                return []
+            history = client.iter_messages(entity, limit=fetch_limit, reply_to=topic_id, **kwargs)
+            batch = [archive_record(message, media) async for message in limiter_for(client).iterate("history", history)]
+            if batch:
+                sink.write_many(batch)
+                await sink.flush()
+                fetched += len(batch)
+                metrics.inc("history_messages_total", len(batch))
+            return batch
+
+        try:
+            if entry and entry["newest_id"]:
+                # Догружаем новые сообщения от старых к новым, сдвигая верхнюю границу после каждой пачки
+                while True:
+                    batch = await fetch_batch(min_id=entry["newest_id"], reverse=True)
+                    if not batch:
+                        break
+                    entry = state.update(chat_id, topic_id, newest_id=batch[-1]["id"], count=entry["count"] + len(batch))
+                    logger.info(f"Fetched {len(batch)} new messages. Newest archived ID: {entry['newest_id']}")
+
+            if not entry or not entry["newest_id"] or (backfill and not entry["complete"]):
+                # Загружаем историю вниз от самого старого заархивированного сообщения
+                while True:
+                    batch = await fetch_batch(offset_id=entry["oldest_id"] if entry else 0)
+                    if not batch:
+                        if limit is None or fetched < limit:
+                            entry = state.update(chat_id, topic_id, complete=True)
+                        break
+                    newest_id = entry["newest_id"] if entry and entry["newest_id"] else batch[0]["id"]
+                    count = (entry["count"] if entry else 0) + len(batch)
+                    entry = state.update(chat_id, topic_id, newest_id=newest_id, oldest_id=batch[-1]["id"], count=count)
+                    logger.info(f"Backfilled {len(batch)} messages. Oldest archived ID: {entry['oldest_id']}")
+        finally:
+            await sink.close()
+
+        logger.info(f"Sync finished for chat ID {chat_id} with topic ID {topic_id}. New messages: {fetched}")
+        console.print(f"[bold green]Synced {fetched} messages to {output_file}[/bold green]")
+        return fetched
+
+    except SessionUnavailable:
+        raise
+    except ValueError as e:
+        logger.error(f"Chat {chat_id} not found: {e}")
+    except errors.RPCError as e:
+        logger.error(f"Telegram API error while syncing history: {e}")
+    except Exception as e:
+        logger.critical(f"Unexpected error while syncing history: {e}")
+
+def load_export_targets(path="all_chats.json", per_topic=False):
+    """
+    Загружает список чатов для массовой выгрузки из файла, созданного save_all_chats.
+
+    :param path: Путь к JSON-файлу со списком чатов (по умолчанию "all_chats.json").
+    :param per_topic: Выгружать каждый топик форума в отдельный файл.
+    :return: Список целей вида {"id": ..., "topic_id": ..., "name": ...}.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        chats = json.load(f)
+
+    targets = []
+    for chat in chats:
+        if per_topic and chat.get("topics"):
+            for topic in chat["topics"]:
+                targets.append({"id": chat["id"], "topic_id": topic["id"], "name": f"{chat.get('name')} / {topic.get('title')}"})
+        else:
+            targets.append({"id": chat["id"], "topic_id": chat.get("topic_id"), "name": chat.get("name")})
+    return targets
+
+async def export_chats(client, targets, output_dir="exports", concurrency=4, incremental=False, on_error="continue",
+                       storage="jsonl", index=None):
+    """
+    Параллельно выгружает историю нескольких чатов и топиков.
+
+    Каждая цель выгружается отдельной задачей asyncio, одновременно работает не больше
+    concurrency задач. Запросы всех задач проходят через общий rate_limiter. Если передан ClientPool,
+    чаты распределяются между его сессиями, а concurrency задаёт число задач на одну сессию.
+
+    :param client: TelegramClient, авторизованный клиент, или ClientPool.
+    :param targets: Список целей {"id": ..., "topic_id": ..., "name": ...} (см. load_export_targets).
+    :param output_dir: Каталог для файлов выгрузки (по умолчанию "exports").
+    :param concurrency: Максимальное количество одновременно выгружаемых чатов.
+    :param incremental: Использовать инкрементальную синхронизацию (sync_chat_history).
+    :param on_error: Политика при ошибке: "continue" — продолжать остальные чаты, "abort" — не запускать новые.
+    :param storage: "jsonl" или "msgpack" — отдельный файл на каждый чат, "sqlite" — общая база "messages.db".
+    :param index: SearchIndex для полнотекстового поиска по сохранённым сообщениям (None — без индексации).
+    :return: Список результатов по каждой цели.
+    """
+    if on_error not in ("continue", "abort"):
+        raise ValueError(f"Unknown error policy: {on_error}")
+    if storage not in ("jsonl", "msgpack", "sqlite"):
+        raise ValueError(f"Unknown storage backend: {storage}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    if isinstance(client, ClientPool):
+        concurrency *= len(client.sessions)
+    semaphore = asyncio.Semaphore(concurrency)
+    aborted = asyncio.Event()
+    state = SyncState(os.path.join(output_dir, "sync_state.json")) if incremental else None
+    results = []
+    done = 0
+
+    async def export_one(target):
+        nonlocal done
+        chat_id = int(target["id"])
+        topic_id = target.get("topic_id")
+        name = target.get("name") or chat_id
+        if storage == "sqlite":
+            output_file = os.path.join(output_dir, "messages.db")
+        else:
+            file_name = f"{chat_id}_{topic_id}.{storage}" if topic_id else f"{chat_id}.{storage}"
+            output_file = os.path.join(output_dir, file_name)
+        result = {"id": chat_id, "topic_id": topic_id, "name": name, "file": output_file,
+                  "status": "skipped", "messages": 0, "seconds": 0.0, "rate": 0.0}
+        results.append(result)
+
+        async with semaphore:
+            if aborted.is_set():
+                return result
+
+            started = time.monotonic()
+            try:
+                if incremental:
+                    count = await dispatch(client, "history", sync_chat_history, chat_id, output_file, topic_id,
+                                           state=state, index=index)
+                else:
+                    count = await dispatch(client, "history", fetch_chat_history, chat_id, output_file, topic_id,
+                                           index=index)
+            except (SessionUnavailable, ConnectionError) as e:
+                logger.error(f"Failed to export chat {name}: {e}")
+                count = None
+            result["seconds"] = round(time.monotonic() - started, 3)
+
+            if count is None:
+                result["status"] = "failed"
+                if on_error == "abort":
+                    aborted.set()
+            else:
+                result["status"] = "ok"
+                result["messages"] = count
+                result["rate"] = round(count / result["seconds"], 1) if result["seconds"] else 0.0
+
+            done += 1
+            console.print(f"[bold cyan][{done}/{len(targets)}][/bold cyan] {name}: {result['status']}, "
+                          f"{result['messages']} messages in {result['seconds']}s ({result['rate']} msg/s)")
+        return result
+
+    logger.info(f"Exporting {len(targets)} chats to {output_dir} with concurrency {concurrency}...")
+    started = time.monotonic()
+    await asyncio.gather(*(export_one(target) for target in targets))
+    elapsed = time.monotonic() - started
+
+    total = sum(result["messages"] for result in results)
+    summary = {
+        "chats": len(results),
+        "ok": sum(result["status"] == "ok" for result in results),
+        "failed": sum(result["status"] == "failed" for result in results),
+        "skipped": sum(result["status"] == "skipped" for result in results),
+        "messages": total,
+        "seconds": round(elapsed, 3),
+        "rate": round(total / elapsed, 1) if elapsed else 0.0,
+        "results": results,
+        "rate_limiter": client.stats() if isinstance(client, ClientPool) else limiter_for(client).stats(),
+    }
+    write_json_atomic(os.path.join(output_dir, "export_summary.json"), summary)
+
+    table = Table(title="Export summary")
+    for column in ("Chat", "Topic", "Status", "Messages", "Seconds", "msg/s"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(str(result["name"]), str(result["topic_id"] or ""), result["status"], str(result["messages"]),
+                      str(result["seconds"]), str(result["rate"]))
+    table.add_row("Total", "", f"{summary['ok']} ok / {summary['failed']} failed", str(total),
+                  str(summary["seconds"]), str(summary["rate"]))
+    console.print(table)
+    logger.info(f"Export finished: {summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} skipped, "
+                f"{total} messages in {summary['seconds']}s ({summary['rate']} msg/s)")
+    return results
         
-def normalize_chat_id(chat):
+# Типы кадров файла записи событий
+RECORD_FRAME = 1  # JSON-запись слушателя (см. message_record, MessageRecord.to_dict)
+UPDATE_FRAME = 2  # Сырые байты обновления Telegram (TL)
+FRAME_HEADER = struct.Struct("<BdI")  # Тип кадра, время записи (unix), длина нагрузки
+BLOCK_HEADER = struct.Struct("<II")  # Длина сжатого блока, длина исходного блока
+
+def message_record(chat_id, message):
     """
-    Преобразует идентификатор чата в формат с -100, если это супергруппа, форум или канал.
+    Собирает лёгкую запись о новом сообщении для очереди слушателя.
 
-    :param chat: Объект чата (например, из event.get_chat()).
-    :return: Преобразованный идентификатор чата в строковом формате.
+    :param chat_id: ID чата в формате Telethon (с -100 для каналов и супергрупп).
+    :param message: Объект сообщения.
+    :return: MessageRecord с временем получения.
     """
-    if getattr(chat, "megagroup", False) or getattr(chat, "broadcast", False) or getattr(chat, "forum", False):
-        # Если ID уже имеет формат с -100, возвращаем его как есть
-        if str(chat.id).startswith("-100"):
-            return chat.id
-        # Добавляем -100 перед ID
-        return int(f"-100{abs(chat.id)}")
-    return chat.id
-    
+    return MessageRecord.from_message(message, chat_id=chat_id, received=time.monotonic())
+
+def tombstone_record(chat_id, message_id, deleted=None):
+    """
+    Собирает отметку об удалении сообщения для очереди слушателя.
+
+    :param chat_id: ID чата из события (None для личных чатов и обычных групп).
+    :param message_id: ID удалённого сообщения.
+    :param deleted: Время удаления, секунды Unix (None — текущее).
+    :return: MessageRecord с полем deleted.
+    """
+    return MessageRecord(message_id, chat_id=chat_id, deleted=int(deleted or time.time()), received=time.monotonic())
+
+class RecentMessageIndex:
+    """
+    Ограниченный LRU-индекс недавно обработанных сообщений слушателя.
+
+    Ключ — (chat_id из события, ID сообщения), значение — версия сообщения (edited или 0) и место записи
+    в хранилище: (chat_id, topic_id) или None, если сообщение не прошло фильтры. Индекс отсеивает
+    дубликаты догрузки и живых событий, а правки и удаления недавних сообщений разрешает за O(1)
+    без обращения к хранилищу. Вытесненные сообщения ищутся через MessageSink.locate.
+
+    В личных чатах и обычных группах Telegram присылает удаления без ID чата (ID сообщений там
+    сквозные для аккаунта), поэтому для них хранится дополнительный указатель по ID сообщения.
+
+    :param max_size: Сколько сообщений помнить.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._by_message = {}
+
+    def add(self, chat_id, message_id, version=0, location=None):
+        """
+        Добавляет или обновляет сообщение и делает его самым свежим.
+
+        :param chat_id: ID чата из события.
+        :param message_id: ID сообщения.
+        :param version: Дата последней правки (секунды Unix), 0 — не редактировалось.
+        :param location: (chat_id, topic_id) записи в хранилище или None, если сообщение не записано.
+        """
+        key = (chat_id, message_id)
+        self._entries[key] = (version, location)
+        self._entries.move_to_end(key)
+        if chat_id is not None and chat_id > CHANNEL_ID_OFFSET:
+            self._by_message[message_id] = key
+        while len(self._entries) > self.max_size:
+            old_key, _ = self._entries.popitem(last=False)
+            if self._by_message.get(old_key[1]) == old_key:
+                del self._by_message[old_key[1]]
+
+    def get(self, chat_id, message_id):
+        """
+        Ищет сообщение. Без chat_id поиск идёт среди личных чатов и обычных групп.
+
+        :return: Кортеж (ключ, версия, место записи) или None, если сообщения нет в индексе.
+        """
+        key = (chat_id, message_id) if chat_id is not None else self._by_message.get(message_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return (key,) + entry
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class EventRecorder:
+    """
+    Запись событий в компактный двоичный файл для отладки и последующего воспроизведения.
+
+    Каждое событие — кадр: заголовок FRAME_HEADER и нагрузка (JSON-запись слушателя или сырые байты
+    обновления Telegram). Кадры копятся в памяти и записываются блоками по block_size байт,
+    каждый блок сжимается zlib и предваряется заголовком BLOCK_HEADER. Мелкие записи плохо сжимаются
+    поодиночке, а в блоке повторяющиеся ключи и ID сжимаются в несколько раз.
+
+    :param path: Путь к файлу записи (по умолчанию "events.bin").
+    :param block_size: Размер блока (байт) до сжатия.
+    :param level: Уровень сжатия zlib.
+    """
+
+    def __init__(self, path="events.bin", block_size=1 << 16, level=3):
+        self.path = path
+        self.block_size = block_size
+        self.level = level
+        self.frames = 0
+        self.bytes = 0  # Записано в файл после сжатия
+        self._block = bytearray()
+        self._file = open(path, "ab")
+
+    def write_record(self, record):
+        """
+        Записывает запись слушателя.
+
+        :param record: MessageRecord.
+        """
+        self._write_frame(RECORD_FRAME, json.dumps(record.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    def write_update(self, update):
+        """
+        Записывает сырое обновление Telegram (например, event.original_update).
+
+        :param update: Объект TL.
+        """
+        self._write_frame(UPDATE_FRAME, bytes(update))
+
+    def flush(self):
+        """
+        Сжимает и записывает в файл накопленный блок.
+        """
+        if not self._block:
+            return
+        compressed = zlib.compress(self._block, self.level)
+        self._file.write(BLOCK_HEADER.pack(len(compressed), len(self._block)))
+        self._file.write(compressed)
+        self._file.flush()
+        self.bytes += BLOCK_HEADER.size + len(compressed)
+        self._block.clear()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+            logger.info(f"Event recorder {self.path} closed. Frames: {self.frames}, bytes: {self.bytes}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write_frame(self, kind, payload):
+        self._block += FRAME_HEADER.pack(kind, time.time(), len(payload))
+        self._block += payload
+        self.frames += 1
+        if len(self._block) >= self.block_size:
+            self.flush()
+
+def read_event_frames(path):
+    """
+    Читает кадры из файла записи событий. Оборванный последний блок (после сбоя) пропускается.
+
+    :param path: Путь к файлу записи.
+    :return: Генератор кортежей (тип кадра, время записи, нагрузка).
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if not header:
+                return
+            if len(header) < BLOCK_HEADER.size:
+                logger.warning(f"Truncated block header at the end of {path}")
+                return
+            compressed_size, size = BLOCK_HEADER.unpack(header)
+            compressed = f.read(compressed_size)
+            if len(compressed) < compressed_size:
+                logger.warning(f"Truncated block at the end of {path}")
+                return
+            block = memoryview(zlib.decompress(compressed, bufsize=size))
+            offset = 0
+            while offset < len(block):
+                kind, timestamp, length = FRAME_HEADER.unpack_from(block, offset)
+                offset += FRAME_HEADER.size
+                yield kind, timestamp, bytes(block[offset:offset + length])
+                offset += length
+
+def read_recorded_messages(path):
+    """
+    Читает записи о сообщениях из файла записи событий.
+
+    Сырые обновления с новыми и отредактированными сообщениями преобразуются в записи слушателя,
+    удаления — в отметки об удалении, остальные обновления пропускаются.
+
+    :param path: Путь к файлу записи.
+    :return: Генератор кортежей (время записи, запись слушателя).
+    """
+    for kind, timestamp, payload in read_event_frames(path):
+        if kind == RECORD_FRAME:
+            # Записи старых версий хранят message_id, reply_to_msg_id и дату строкой, from_dict понимает оба формата
+            yield timestamp, MessageRecord.from_dict(json.loads(payload))
+        elif kind == UPDATE_FRAME:
+            update = BinaryReader(payload).tgread_object()
+            message = getattr(update, "message", None)
+            if isinstance(message, types.Message):
+                yield timestamp, message_record(message.chat_id, message)
+            elif isinstance(update, types.UpdateDeleteChannelMessages):
+                chat_id = CHANNEL_ID_OFFSET - update.channel_id
+                for message_id in update.messages:
+                    yield timestamp, tombstone_record(chat_id, message_id, timestamp)
+            elif isinstance(update, types.UpdateDeleteMessages):
+                for message_id in update.messages:
+                    yield timestamp, tombstone_record(None, message_id, timestamp)
+
+async def replay_events(path, put, speed=None):
+    """
+    Воспроизводит записанные события, передавая записи в конвейер слушателя.
+
+    :param path: Путь к файлу записи.
+    :param put: Корутина, принимающая запись (например, IngestQueue.put).
+    :param speed: None — с максимальной скоростью, 1.0 — в реальном темпе, 2.0 — вдвое быстрее и т. д.
+    :return: Количество воспроизведённых событий.
+    """
+    count = 0
+    started = time.monotonic()
+    first_timestamp = None
+    for timestamp, record in read_recorded_messages(path):
+        if speed:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        record.received = time.monotonic()
+        await put(record)
+        count += 1
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {count} events from {path} in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} events/s)")
+    return count
+
+class ChatFilterIndex:
+    """
+    Скомпилированный индекс фильтров отслеживаемых чатов.
+
+    Фильтры раскладываются по словарям с ключами по нормализованному ID, username (без учёта
+    регистра) и title, поэтому проверка события — поиск по словарю вместо перебора всего списка.
+    Для каждого ключа хранится признак "любой топик" и frozenset разрешённых топиков.
+    Фильтры, задающие сразу несколько полей, проверяются по оставшимся полям после поиска.
+
+    :param monitored_chats: Список фильтров вида {"id": ..., "username": ..., "title": ..., "topics": [...]}.
+    """
+
+    def __init__(self, monitored_chats=()):
+        self.rebuild(monitored_chats)
+
+    def rebuild(self, monitored_chats):
+        """
+        Перестраивает индекс. Новые таблицы собираются отдельно и подменяются одним присваиванием,
+        поэтому обработчики событий никогда не видят индекс в промежуточном состоянии.
+
+        :param monitored_chats: Новый список фильтров.
+        """
+        by_id, by_username, by_title = {}, {}, {}
+        compound = []  # Фильтры с несколькими полями или без полей вообще
+        for chat_filter in monitored_chats:
+            chat_id = chat_filter.get("id")
+            username = chat_filter.get("username")
+            title = chat_filter.get("title")
+            topics = frozenset(chat_filter.get("topics") or ())
+            keys = [(table, value) for table, value in ((by_id, int(chat_id) if chat_id else None),
+                                                        (by_username, username.lstrip("@").lower() if username else None),
+                                                        (by_title, title)) if value]
+            if len(keys) == 1:
+                table, value = keys[0]
+                entry = table.get(value)
+                if entry is None:
+                    table[value] = (not topics, topics)
+                elif not entry[0]:
+                    table[value] = (not topics, entry[1] | topics)
+            else:
+                compound.append((int(chat_id) if chat_id else None,
+                                 username.lstrip("@").lower() if username else None, title, topics))
+        self._tables = (by_id, by_username, by_title, tuple(compound))
+        self.monitored_chats = list(monitored_chats)
+        self.version = getattr(self, "version", 0) + 1
+
+    def match(self, event_chat, event_topic):
+        """
+        Проверяет, соответствует ли чат и топик события какому-либо фильтру.
+
+        :param event_chat: Чат события (объект чата).
+        :param event_topic: ID топика события (или None).
+        :return: True, если событие соответствует фильтру.
+        """
+        return self.match_values(normalize_chat_id(event_chat), getattr(event_chat, "username", None),
+                                 getattr(event_chat, "title", None), event_topic)
+
+    def match_values(self, chat_id, username, title, event_topic):
+        """
+        То же, что match(), но по уже известным нормализованному ID, username и title чата
+        (например, из EntityCache).
+        """
+        by_id, by_username, by_title, compound = self._tables
+        username = username.lower() if username else None
+
+        for table, value in ((by_id, chat_id), (by_username, username), (by_title, title)):
+            entry = table.get(value)
+            if entry is not None and (entry[0] or event_topic in entry[1]):
+                return True
+
+        for rule_id, rule_username, rule_title, topics in compound:
+            if rule_id and rule_id != chat_id:
+                continue
+            if rule_username and rule_username != username:
+                continue
+            if rule_title and rule_title != title:
+                continue
+            if topics and event_topic not in topics:
+                continue
+            return True
+        return False
+
+    def __len__(self):
+        return len(self.monitored_chats)
+
 def is_monitored_chat(event_chat, event_topic, monitored_chats):
     """
     Проверяет, принадлежит ли событие отслеживаемому чату или топику.
 
     :param event_chat: Чат события (объект чата).
     :param event_topic: ID топика события (или None).
-    :param monitored_chats: Список фильтров чатов.
+    :param monitored_chats: ChatFilterIndex или список фильтров чатов (список компилируется в индекс при каждом вызове).
     :return: True, если событие соответствует какому-либо фильтру, иначе False.
     """
-    normalized_chat_id = str(normalize_chat_id(event_chat))
-    chat_title = getattr(event_chat, "title", None)
-    chat_username = getattr(event_chat, "username", None)
-
-    for chat_filter in monitored_chats:
-        # Проверяем ID чата
-        if "id" in chat_filter and str(chat_filter["id"]) != normalized_chat_id:
-            continue
-        
-        # Проверяем title чата
-        if "title" in chat_filter and chat_filter["title"] and chat_filter["title"] != chat_title:
-            continue
+    if not isinstance(monitored_chats, ChatFilterIndex):
+        monitored_chats = ChatFilterIndex(monitored_chats)
+    return monitored_chats.match(event_chat, event_topic)
         
-        # Проверяем username чата
-        if "username" in chat_filter and chat_filter["username"] and chat_filter["username"] != chat_username:
-            continue
+class IngestQueue:
+    """
+    Ограниченная очередь между обработчиком событий и рабочими задачами.
 
-        # Проверяем топики
-        if "topics" in chat_filter and chat_filter["topics"]:
-            if event_topic not in chat_filter["topics"]:
-                continue
+    Обработчик только кладёт в очередь лёгкую запись, вся обработка выполняется рабочими задачами.
+    При переполнении действует политика overflow:
+    "block" — обработчик ждёт свободного места, "drop-oldest" — вытесняется самая старая запись,
+    "spill" — записи временно сбрасываются в JSONL-файл и читаются из него, когда очередь освободится.
 
-        # Если всё совпало
+    :param maxsize: Максимальное количество записей в памяти.
+    :param overflow: Политика переполнения ("block", "drop-oldest", "spill").
+    :param spill_file: Файл для политики "spill".
+    :param on_drop: Функция, которой передаётся каждая вытесненная запись (политика "drop-oldest").
+    """
+
+    OVERFLOW_POLICIES = ("block", "drop-oldest", "spill")
+
+    def __init__(self, maxsize=10000, overflow="block", spill_file="ingest_spill.jsonl", on_drop=None):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.on_drop = on_drop
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._spill_writer = None
+        self._spill_reader = None
+        self._spill_pending = 0
+        self._in_progress = 0
+
+    @property
+    def depth(self):
+        """
+        Количество записей, ожидающих обработки (в памяти и в файле).
+        """
+        return self._queue.qsize() + self._spill_pending
+
+    async def put(self, record, wait=False):
+        """
+        Добавляет запись в очередь с учётом политики переполнения.
+
+        :param record: MessageRecord с заполненным полем received (time.monotonic()).
+        :param wait: Ждать свободного места вместо вытеснения при политике "drop-oldest".
+        """
+        self.received += 1
+        # Пока в файле есть записи, новые тоже пишем в файл, чтобы сохранить порядок
+        if self.overflow == "spill" and (self._spill_pending or self._queue.full()):
+            self._spill(record)
+        elif self.overflow == "drop-oldest" and self._queue.full() and not wait:
+            dropped = self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped += 1
+            self._queue.put_nowait(record)
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+        else:
+            await self._queue.put(record)
+        self.max_depth = max(self.max_depth, self.depth)
+
+    async def get(self):
+        """
+        Возвращает следующую запись: из памяти, а когда она пуста — из файла переполнения.
+        """
+        if self._queue.empty() and self._spill_pending:
+            record = self._unspill()
+        else:
+            record = await self._queue.get()
+            self._queue.task_done()
+        self._in_progress += 1
+        return record
+
+    def done(self, record):
+        """
+        Отмечает запись обработанной и учитывает задержку от получения до конца обработки.
+        """
+        self._in_progress -= 1
+        self.processed += 1
+        self.last_lag = time.monotonic() - record.received
+        self.max_lag = max(self.max_lag, self.last_lag)
+        metrics.observe("ingest_lag_seconds", self.last_lag)
+
+    async def drain(self, timeout=10.0):
+        """
+        Ждёт, пока все записи будут обработаны (не дольше timeout секунд).
+
+        :return: True, если очередь опустела.
+        """
+        deadline = time.monotonic() + timeout
+        while self.depth or self._in_progress:
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
         return True
 
-    return False
-        
-async def listen_to_messages(client, monitored_chats, output_file="monitored_messages.json"):
+    def stats(self):
+        """
+        Возвращает глубину очереди, задержку и счётчики.
+        """
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "received": self.received,
+            "processed": self.processed,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
+
+    def close(self):
+        """
+        Закрывает и удаляет файл переполнения, если он был создан.
+        """
+        for handle in (self._spill_writer, self._spill_reader):
+            if handle is not None:
+                handle.close()
+        self._spill_writer = self._spill_reader = None
+        if self._spill_pending:
+            logger.warning(f"{self._spill_pending} spilled records left unprocessed in {self.spill_file}")
+        elif os.path.exists(self.spill_file):
+            os.remove(self.spill_file)
+
+    def _spill(self, record):
+        if self._spill_writer is None:
+            self._spill_writer = open(self.spill_file, "w", encoding="utf-8")
+            self._spill_reader = open(self.spill_file, "r", encoding="utf-8")
+        # Время получения нужно для расчёта задержки, поэтому сохраняется вместе с записью
+        self._spill_writer.write(json.dumps(dict(record.to_dict(), received=record.received), ensure_ascii=False) + "\n")
+        self._spill_writer.flush()
+        self._spill_pending += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        record = MessageRecord.from_dict(json.loads(self._spill_reader.readline()))
+        self._spill_pending -= 1
+        if not self._spill_pending:
+            # Файл прочитан целиком, начинаем его заново
+            self._spill_writer.seek(0)
+            self._spill_writer.truncate()
+            self._spill_reader.seek(0)
+        return record
+
+async def resolve_monitored_chats(client, monitored_chats):
+    """
+    Преобразует фильтры чатов (ID, @username, title) в набор ID для белого списка обработчика.
+
+    Названия и username ищутся за один проход по диалогам, оставшиеся username
+    разрешаются через get_entity.
+
+    :param client: TelegramClient, авторизованный клиент.
+    :param monitored_chats: Список фильтров чатов.
+    :return: Множество ID чатов или None, если есть фильтр без ID, username и title (подходит любой чат).
+    """
+    chat_ids = set()
+    usernames = {}
+    titles = set()
+    for chat_filter in monitored_chats:
+        if chat_filter.get("id"):
+            chat_ids.add(int(chat_filter["id"]))
+        elif chat_filter.get("username"):
+            usernames[chat_filter["username"].lstrip("@").lower()] = chat_filter["username"]
+        elif chat_filter.get("title"):
+            titles.add(chat_filter["title"])
+        else:
+            return None
+
+    if usernames or titles:
+        async for dialog in limiter_for(client).iterate("dialogs", client.iter_dialogs()):
+            entity_cache.put_entity(dialog.entity)
+            username = getattr(dialog.entity, "username", None)
+            if dialog.name in titles or getattr(dialog.entity, "title", None) in titles:
+                chat_ids.add(dialog.id)
+            if username and username.lower() in usernames:
+                chat_ids.add(dialog.id)
+                usernames.pop(username.lower())
+
+    # Username чатов, которых нет в диалогах (например, публичные каналы без подписки)
+    for username in usernames.values():
+        try:
+            chat_ids.add((await entity_cache.resolve(client, username))["id"])
+        except (ValueError, errors.RPCError) as e:
+            logger.warning(f"Failed to resolve chat @{username}: {e}")
+
+    logger.info(f"Resolved {len(monitored_chats)} chat filters to {len(chat_ids)} chats")
+    return chat_ids
+
+async def listen_to_messages(client, monitored_chats, output_file="monitored_messages.jsonl", batch_size=100,
+                             flush_interval=1.0, fsync="batch", max_bytes=None, rotate_daily=False,
+                             refresh_interval=5.0, workers=4, queue_size=10000, overflow="block",
+                             catch_up=True, backfill_limit=None, backfill_concurrency=4, dedup_size=10000,
+                             record_file=None, record_raw=False, replay_file=None, replay_speed=None, quiet=None,
+                             media=None, index=None, track_edits=True):
     """
     Режим прослушивания сообщений из указанных чатов, включая топики форумов.
 
+    Сообщения записываются в хранилище пачками (см. MessageSink), поэтому память не растёт
+    со временем работы, а обработчик событий не блокируется записью на диск.
+
+    Фильтры заранее разрешаются в белый список ID чатов, который передаётся в events.NewMessage(chats=...),
+    поэтому сообщения из остальных чатов отбрасываются диспетчером Telethon до вызова обработчика.
+    Белый список обновляется при переименовании чатов, вступлении в чаты и при изменении фильтров.
+
+    Обработчик событий только кладёт лёгкую запись в ограниченную очередь (см. IngestQueue),
+    фильтрацию, вывод и запись выполняют workers рабочих задач.
+
+    Правки и удаления сообщений (track_edits) записываются в то же хранилище: правка — новой версией
+    сообщения (в SQLite — обновлением строки), удаление — отметкой с полем deleted. Место записи недавних
+    сообщений берётся из RecentMessageIndex, более старые сообщения ищутся в хранилище (MessageSink.locate),
+    без перечитывания архива.
+
     :param client: TelegramClient, авторизованный клиент.
-    :param monitored_chats: Список ID чатов или username, которые нужно мониторить.
-    :param output_file: Имя файла для записи новых сообщений.
+    :param monitored_chats: Список фильтров чатов или ChatFilterIndex (его можно перестроить через rebuild() во время работы).
+    :param output_file: Имя файла для записи новых сообщений: JSONL или база SQLite (.db).
+    :param batch_size: Размер пачки для сброса на диск.
+    :param flush_interval: Максимальный интервал (сек) между сбросами на диск.
+    :param fsync: Политика fsync ("batch", "rotate", "never").
+    :param max_bytes: Ротация файла по размеру (None — без ротации).
+    :param rotate_daily: Ротация файла при смене суток.
+    :param refresh_interval: Как часто (сек) проверять, не изменились ли фильтры.
+    :param workers: Количество рабочих задач, обрабатывающих сообщения.
+    :param queue_size: Максимальное количество сообщений в очереди.
+    :param overflow: Политика переполнения очереди ("block", "drop-oldest", "spill").
+    :param catch_up: Догружать сообщения, пропущенные во время простоя и обрывов соединения.
+    :param backfill_limit: Максимальное количество догружаемых сообщений на чат (None — без ограничения).
+    :param backfill_concurrency: Сколько чатов догружается одновременно.
+    :param dedup_size: Сколько последних сообщений помнить для отсева дубликатов, правок и удалений (см. RecentMessageIndex),
+                       а также сколько вытесненных из очереди сообщений ждать для перезапроса.
+    :param record_file: Файл для записи входящих событий (см. EventRecorder), None — без записи.
+    :param record_raw: Записывать сырые обновления Telegram вместо компактных записей.
+    :param replay_file: Воспроизвести события из файла записи вместо прослушивания (см. replay_events).
+    :param replay_speed: Темп воспроизведения: None — максимальный, 1.0 — реальный.
+    :param quiet: Не выводить каждое сообщение в консоль (None — значение LOG_QUIET из .env).
+    :param media: MediaDownloader для загрузки вложений (None — вложения не сохраняются).
+    :param index: SearchIndex для полнотекстового поиска по сохранённым сообщениям (None — без индексации).
+    :param track_edits: Отслеживать правки и удаления сообщений.
     """
+    if quiet is None:
+        quiet = LOG_QUIET
     console.print("[bold cyan]Listening to messages... Press Ctrl+C to stop.[/bold cyan]")
     logger.info("Starting message listener...")
 
-    monitored_messages = []
+    # Компилируем фильтры один раз, а не при каждом событии
+    if not isinstance(monitored_chats, ChatFilterIndex):
+        monitored_chats = ChatFilterIndex(monitored_chats)
+
+    sink = open_sink(output_file, batch_size=batch_size, flush_interval=flush_interval, fsync=fsync,
+                     max_bytes=max_bytes, rotate_daily=rotate_daily, index=index).start()
+
+    # Последний обработанный ID сообщения по каждому чату. ID сообщений сквозные в пределах чата,
+    # поэтому одна отметка покрывает все его топики: догрузка идёт по чату целиком, а топики отсеивает фильтр.
+    state_file = f"{output_file}.state"
+    last_ids = {int(chat_id): message_id for chat_id, message_id in load_json_file(state_file, default={}).items()}
+    state_dirty = False
+    # Новые сообщения выше отметки, которые ещё в очереди или в обработке: chat_id -> {ID сообщения: количество копий}.
+    # Сохранённая отметка не обгоняет самое раннее из них, иначе после сбоя догрузка его пропустит
+    queued = {}
+    # Наименьший ID сообщения, которое не удалось обработать: отметка не поднимается выше него до перезапуска
+    failed_ids = {}
+    # Новые сообщения, вытесненные из переполненной очереди и ожидающие перезапроса по ID:
+    # (chat_id, ID сообщения) -> None, не больше dedup_size. Отметка чата не обгоняет их, пока они не перезапрошены
+    dropped = OrderedDict()
+    # Сообщения, которые сейчас обрабатывают рабочие задачи: (chat_id, ID) -> версия
+    processing = {}
+    recorder = EventRecorder(record_file) if record_file else None
+    # Недавно обработанные сообщения: догрузка и живые события могут принести одно и то же сообщение,
+    # а правки и удаления ссылаются на уже записанные
+    recent = RecentMessageIndex(dedup_size)
+
+    async def save_state():
+        nonlocal state_dirty
+        if not state_dirty:
+            return
+        state_dirty = False
+        snapshot = {str(chat_id): message_id for chat_id, message_id in committed_marks().items()}
+        # Отметка не должна опережать данные на диске, поэтому сначала сбрасываем буфер записи
+        await sink.flush()
+        write_json_atomic(state_file, snapshot)
+
+    def committed_marks():
+        # Отметка чата — последний записанный ID, но не выше сообщений, которые ещё не записаны
+        marks = {}
+        for chat_id, message_id in last_ids.items():
+            pending = queued.get(chat_id)
+            if pending:
+                message_id = min(message_id, min(pending) - 1)
+            if chat_id in failed_ids:
+                message_id = min(message_id, failed_ids[chat_id] - 1)
+            marks[chat_id] = message_id
+        for chat_id, message_id in dropped:
+            if chat_id in marks:
+                marks[chat_id] = min(marks[chat_id], message_id - 1)
+        return marks
+
+    async def enqueue(record, refetched=False):
+        # Удаления и правки старых сообщений отметку не задерживают. Перезапрошенное сообщение задерживает,
+        # даже если отметку уже подняли более новые сообщения
+        if record.deleted is None and (refetched or record.id > last_ids.get(record.chat_id, 0)):
+            pending = queued.setdefault(record.chat_id, {})
+            pending[record.id] = pending.get(record.id, 0) + 1
+        # Перезапрошенные записи ждут места в очереди, а не вытесняют другие
+        await ingest.put(record, wait=refetched)
+
+    def release(chat_id, message_id):
+        nonlocal state_dirty
+        pending = queued.get(chat_id)
+        if not pending or message_id not in pending:
+            return
+        pending[message_id] -= 1
+        if not pending[message_id]:
+            del pending[message_id]
+            if not pending:
+                del queued[chat_id]
+        state_dirty = True
+
+    def drop_record(record):
+        # Вытесненная запись больше не задерживает отметку через queued: новое сообщение перезапрашивается по ID
+        # (см. refetch_dropped), удаление восстановить нельзя
+        held = record.id in queued.get(record.chat_id, ())
+        release(record.chat_id, record.id)
+        if record.deleted is not None:
+            metrics.inc("messages_deleted_dropped_total")
+            return
+        if replay_file is not None or not held:
+            return
+        dropped[(record.chat_id, record.id)] = None
+        while len(dropped) > dedup_size:
+            chat_id, message_id = dropped.popitem(last=False)[0]
+            logger.warning(f"Dropped message {message_id} in chat {chat_id} will not be refetched")
+
+    ingest = IngestQueue(maxsize=queue_size, overflow=overflow, spill_file=f"{output_file}.spill", on_drop=drop_record)
 
-    @client.on(events.NewMessage())
+    # Сообщения с вложениями из чатов, которых не было в кэше: фильтр для них проверит рабочая задача.
+    # (chat_id из события, ID сообщения) -> сообщение, не больше queue_size записей
+    pending_media = OrderedDict()
+
+    def attach_media(record, message):
+        # Вложения скачиваются только для сообщений, которые проходят фильтры (сведения о чате обычно уже в кэше)
+        if media is None or message.media is None:
+            return
+        chat = entity_cache.get(record.chat_id)
+        if chat is None:
+            pending_media[(record.chat_id, record.id)] = message
+            while len(pending_media) > queue_size:
+                pending_media.popitem(last=False)
+            return
+        topic_id = (record.reply_to_top_id or record.reply_to) if chat["forum"] else None
+        if monitored_chats.match_values(chat["id"], chat["username"], chat["title"], topic_id):
+            record.media = media.submit(message)
+
+    @metrics.timed("message_handler")
     async def new_message_handler(event):
+        metrics.inc("messages_received_total")
         try:
-            chat = await event.get_chat()
-            chat_name = getattr(chat, "title", None) or getattr(chat, "username", None) or "Private Chat/User"
-            
-            # Нормализуем идентификатор чата для проверки
-            normalized_chat_id = normalize_chat_id(chat)
-
-            # Логируем информацию о новом событии
-            logger.info(f"New event detected in chat {chat_name} (ID={normalized_chat_id}): Message ID={event.message.id}")
-            # logger.info(f"Normalized chat ID: {chat.id} ({type(chat.id)}), Monitored chats: {monitored_chats} ({[type(chat) for chat in monitored_chats]})")
-
-            # Проверяем, является ли сообщение из форума
-            forum_id = None
-            topic_id = None
-            if getattr(chat, "forum", False):  # Проверка, является ли чат форумом
-                forum_id = normalized_chat_id
-                topic_id = (
-                    getattr(event.message.reply_to, "reply_to_top_id", None)  # ID топика
-                    or getattr(event.message.reply_to, "reply_to_msg_id", None)  # Иногда используется как замена
-                )
-                
-                logger.info(f"Forum detected: Forum ID={forum_id}, Topic ID={topic_id}")
-
-            # Проверяем, принадлежит ли событие одному из отслеживаемых чатов
-            if not is_monitored_chat(chat, topic_id, monitored_chats):
+            message = event.message
+            if isinstance(event, events.MessageEdited.Event) and message.edit_date is None:
+                # Обновление реакций или просмотров без правки текста
                 return
+            # Если чат есть в самом обновлении, сразу кладём его в кэш, чтобы рабочей задаче не пришлось его запрашивать
+            if event.chat_id not in entity_cache and event.chat is not None:
+                entity_cache.put_entity(event.chat, event.chat_id)
+
+            record = message_record(event.chat_id, message)
+            attach_media(record, message)
+            if recorder is not None:
+                if record_raw:
+                    recorder.write_update(event.original_update)
+                else:
+                    recorder.write_record(record)
+            await enqueue(record)
+        except Exception as e:
+            logger.error(f"Error while queueing new message: {e}")
 
-            # Логируем сообщение в консоль
-            console.print(f"[bold green]New message in chat {chat_name}:[/bold green] {event.message.message}")
-
-            # Если сообщение в топике форума, логируем ID топика
-            if topic_id:
-                logger.info(f"Message is in topic ID: {topic_id}")
-
-            # Сохраняем сообщение в список
-            monitored_messages.append({
-                "chat_id": normalized_chat_id,
-                "chat_name": chat_name,
-                "message_id": event.message.id,
-                "date": event.message.date.isoformat(),
-                "text": event.message.message,
-                "sender_id": event.message.sender_id,
-                "forum_id": forum_id,
-                "topic_id": topic_id,
-            })
+    async def deleted_message_handler(event):
+        try:
+            if recorder is not None and record_raw:
+                recorder.write_update(event.original_update)
+            for message_id in event.deleted_ids:
+                record = tombstone_record(event.chat_id, message_id)
+                if recorder is not None and not record_raw:
+                    recorder.write_record(record)
+                await enqueue(record)
+        except Exception as e:
+            logger.error(f"Error while queueing deleted messages: {e}")
 
-            # Периодически сохраняем сообщения в файл
-            if len(monitored_messages) % 10 == 0:
-                with open(output_file, "w", encoding="utf-8") as f:
-                    json.dump(monitored_messages, f, ensure_ascii=False, indent=4)
-                logger.info(f"Saved monitored messages to {output_file}")
+    async def process_deletion(record):
+        try:
+            known = recent.get(record.chat_id, record.id)
+            if known is not None:
+                location = known[2]
+                if location is None:
+                    # Сообщение не прошло фильтры и не записывалось
+                    return
+            else:
+                location = await sink.locate(record.id, record.chat_id)
+            if location is None:
+                # Сообщения нет ни в индексе, ни в хранилище (JSONL не ищется): отметку пишем,
+                # только если известен отслеживаемый чат
+                if record.chat_id is None or (whitelist is not None and record.chat_id not in whitelist):
+                    logger.debug(f"Skipping deletion of unknown message {record.id} in chat {record.chat_id}")
+                    metrics.inc("messages_deleted_unresolved_total")
+                    return
+                location = ((await entity_cache.resolve(client, record.chat_id))["id"], None)
+
+            record.chat_id, record.topic_id = location
+            logger.info(f"Deleted message in chat {record.chat_id}: Message ID={record.id}, Topic ID={record.topic_id}")
+            if not quiet:
+                console.print(f"[bold red]Deleted message {record.id} in chat {record.chat_id}[/bold red]")
+            sink.write(record)
+            metrics.inc("messages_deleted_total")
+        except Exception as e:
+            logger.error(f"Error while handling deleted message: {e}")
 
+    async def process_message(record):
+        if record.deleted is not None:
+            await process_deletion(record)
+            return
+        event_chat_id = record.chat_id
+        message_id = record.id
+        try:
+            await process_new_message(record, event_chat_id, message_id)
+        finally:
+            release(event_chat_id, message_id)
+
+    async def process_new_message(record, event_chat_id, message_id):
+        nonlocal state_dirty
+        # Повтор той же или более старой версии сообщения (догрузка, обновление реакций) пропускаем,
+        # в том числе если эту версию прямо сейчас обрабатывает другая рабочая задача
+        key = (event_chat_id, message_id)
+        version = record.edited or 0
+        known = recent.get(event_chat_id, message_id)
+        if (known is not None and version <= known[1]) or version <= processing.get(key, -1):
+            logger.debug(f"Skipping duplicate message {message_id} in chat {event_chat_id}")
+            metrics.inc("messages_duplicate_total")
+            return
+        processing[key] = version
+        try:
+            location = await store_message(record)
         except Exception as e:
             logger.error(f"Error while handling new message: {e}")
+            # Сообщение не записано: отметка не должна его пропустить, а повторная доставка — считаться дубликатом
+            if message_id > last_ids.get(event_chat_id, 0):
+                failed_ids[event_chat_id] = min(failed_ids.get(event_chat_id, message_id), message_id)
+            return
+        finally:
+            if processing.get(key) == version:
+                del processing[key]
+        # Сообщение записано (или отсеяно фильтром): только теперь оно считается обработанным
+        if location is None and known is not None:
+            location = known[2]
+        recent.add(event_chat_id, message_id, version, location)
+        if message_id > last_ids.get(event_chat_id, 0):
+            last_ids[event_chat_id] = message_id
+            state_dirty = True
+
+    async def store_message(record):
+        # Проверяет фильтры и передаёт запись в буфер хранилища.
+        # Возвращает место записи (chat_id, topic_id) или None, если сообщение отсеяно фильтром.
+        media_message = pending_media.pop((record.chat_id, record.id), None)
+        # Сведения о чате берём из кэша, get_entity() вызывается только при промахе
+        chat = await entity_cache.resolve(client, record.chat_id)
+        chat_name = chat["title"] or chat["username"] or "Private Chat/User"
+
+        # Нормализованный идентификатор чата для проверки
+        normalized_chat_id = chat["id"]
+
+        # Проверяем, является ли сообщение из форума
+        forum_id = None
+        topic_id = None
+        if chat["forum"]:  # Проверка, является ли чат форумом
+            forum_id = normalized_chat_id
+            topic_id = (
+                record.reply_to_top_id  # ID топика
+                or record.reply_to  # Иногда используется как замена
+            )
+
+        # Проверяем, принадлежит ли событие одному из отслеживаемых чатов
+        if not monitored_chats.match_values(normalized_chat_id, chat["username"], chat["title"], topic_id):
+            return None
+        metrics.inc("messages_matched_total")
+        if media_message is not None:
+            # Вложение из чата, которого не было в кэше, ставится в загрузку только после проверки фильтра
+            record.media = media.submit(media_message)
+        kind = "Edited" if record.edited else "New"
+
+        # В журнал попадают только подходящие сообщения, одна строка на сообщение
+        logger.info(f"{kind} message in chat {chat_name} (ID={normalized_chat_id}): Message ID={record.id}, Topic ID={topic_id}")
+
+        # Выводим сообщение в консоль, если не включён тихий режим
+        if not quiet:
+            console.print(f"[bold green]{kind} message in chat {chat_name}:[/bold green] {record.text}")
+
+        # Дополняем запись сведениями о чате и передаём в буфер записи, на диск её сбросит фоновая задача.
+        # Ключи дедупликации и last_ids считаются по исходному chat_id, поэтому запись можно менять.
+        record.chat_id = normalized_chat_id
+        record.chat_name = chat_name
+        record.forum_id = forum_id
+        record.topic_id = topic_id
+        sink.write(record)
+        if record.edited:
+            metrics.inc("messages_edited_total")
+        return normalized_chat_id, topic_id
+
+    async def worker():
+        while True:
+            record = await ingest.get()
+            try:
+                await process_message(record)
+            finally:
+                ingest.done(record)
+
+    refresh_needed = asyncio.Event()
+
+    async def chat_action_handler(event):
+        # Переименование чата или вступление в чат может изменить белый список
+        if event.new_title or event.user_joined or event.user_added or event.created:
+            entity_cache.invalidate(event.chat_id)
+            refresh_needed.set()
+
+    async def register_handler():
+        if replay_file is not None:
+            # При воспроизведении события берутся из файла, фильтры применяются рабочими задачами
+            return None
+        whitelist = await resolve_monitored_chats(client, monitored_chats.monitored_chats)
+        client.remove_event_handler(new_message_handler)
+        client.remove_event_handler(deleted_message_handler)
+        if whitelist is None:
+            client.add_event_handler(new_message_handler, events.NewMessage())
+        elif whitelist:
+            client.add_event_handler(new_message_handler, events.NewMessage(chats=list(whitelist)))
+        if whitelist is None or whitelist:
+            if track_edits:
+                client.add_event_handler(new_message_handler, events.MessageEdited(
+                    chats=list(whitelist) if whitelist is not None else None))
+                # Удаления в личных чатах и обычных группах приходят без ID чата, поэтому фильтр по чатам
+                # к ним не применить: их разрешает process_deletion
+                client.add_event_handler(deleted_message_handler, events.MessageDeleted())
+        else:
+            logger.warning("None of the monitored chats could be resolved. Waiting for chat updates...")
+        return whitelist
+
+    async def backfill_chat(chat_id, min_id, semaphore):
+        count = 0
+        async with semaphore:
+            history = client.iter_messages(chat_id, min_id=min_id, limit=backfill_limit, reverse=True)
+            async for message in limiter_for(client).iterate("history", history):
+                record = message_record(chat_id, message)
+                attach_media(record, message)
+                await enqueue(record)
+                count += 1
+        return count
+
+    async def backfill(reason, marks):
+        # Догружаем только чаты, которые сейчас под наблюдением
+        chat_ids = [chat_id for chat_id in marks if whitelist is None or chat_id in whitelist]
+        if not chat_ids:
+            return
+        logger.info(f"Catching up {len(chat_ids)} chats after {reason}...")
+        semaphore = asyncio.Semaphore(backfill_concurrency)
+        results = await asyncio.gather(*(backfill_chat(chat_id, marks[chat_id], semaphore) for chat_id in chat_ids),
+                                       return_exceptions=True)
+        total = 0
+        for chat_id, result in zip(chat_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to catch up chat {chat_id}: {result}")
+            else:
+                total += result
+        logger.info(f"Catch-up after {reason} queued {total} missed messages")
+
+    backfill_tasks = set()
+
+    def start_backfill(reason):
+        if not catch_up or stopping or replay_file is not None:
+            return
+        # Отметки фиксируем сразу: живые события, пришедшие позже, не должны сдвинуть начало пропуска
+        task = asyncio.ensure_future(backfill(reason, committed_marks()))
+        backfill_tasks.add(task)
+        task.add_done_callback(backfill_tasks.discard)
+
+    async def refetch_dropped():
+        nonlocal state_dirty
+        # Перезапрашиваем вытесненные сообщения пачками по 100 ID на чат (ограничение get_messages)
+        by_chat = {}
+        for chat_id, message_id in list(dropped):
+            ids = by_chat.setdefault(chat_id, [])
+            if len(ids) < 100:
+                ids.append(message_id)
+        for chat_id, ids in by_chat.items():
+            try:
+                messages = await limiter_for(client).call("history", client.get_messages, chat_id, ids=ids)
+            except Exception as e:
+                logger.error(f"Failed to refetch dropped messages in chat {chat_id}: {e}")
+                continue
+            count = 0
+            for message_id, message in zip(ids, messages):
+                if message is not None:
+                    record = message_record(chat_id, message)
+                    attach_media(record, message)
+                    await enqueue(record, refetched=True)
+                    count += 1
+                # Запись снова в очереди (или сообщение уже удалено), отметку теперь держит queued
+                dropped.pop((chat_id, message_id), None)
+            state_dirty = True
+            logger.info(f"Refetched {count} messages dropped by the ingest queue in chat {chat_id}")
+
+    refetch_task = None
+
+    def start_refetch():
+        nonlocal refetch_task
+        # Ждём, пока очередь освободится хотя бы наполовину, иначе перезапрошенные записи вытеснят другие
+        if (not dropped or stopping or ingest.depth > queue_size // 2
+                or (refetch_task is not None and not refetch_task.done())):
+            return
+        refetch_task = asyncio.ensure_future(refetch_dropped())
+        backfill_tasks.add(refetch_task)
+        refetch_task.add_done_callback(backfill_tasks.discard)
+
+    # Переподключение после обрыва замечает refresh_loop по смене client.is_connected(). Автоматическое
+    # переподключение Telethon is_connected() не меняет, о нём сообщает только колбэк отправителя. Это внутренний
+    # API (проверен с версией Telethon из requirements.txt), поэтому без колбэка слушатель работает, но предупреждает
+    sender = getattr(client, "_sender", None)
+    reconnect_callback = getattr(sender, "_auto_reconnect_callback", None)
+    reconnect_hook = sender is not None and hasattr(sender, "_auto_reconnect_callback")
+
+    async def handle_reconnect():
+        if reconnect_callback is not None:
+            await reconnect_callback()
+        start_backfill("reconnect")
+
+    stopping = False
+    whitelist = None
+
+    async def refresh_loop(version):
+        nonlocal whitelist
+        connected = replay_file is not None or client.is_connected()
+        while not stopping:
+            try:
+                await asyncio.wait_for(refresh_needed.wait(), timeout=refresh_interval)
+            except TimeoutError:
+                pass
+            if stopping:
+                break
+            if replay_file is None:
+                if client.is_connected() and not connected:
+                    start_backfill("reconnect")
+                connected = client.is_connected()
+            try:
+                await save_state()
+            except Exception as e:
+                logger.error(f"Failed to save listener state: {e}")
+            if recorder is not None:
+                recorder.flush()
+            start_refetch()
+            if refresh_needed.is_set() or monitored_chats.version != version:
+                refresh_needed.clear()
+                version = monitored_chats.version
+                try:
+                    whitelist = await register_handler()
+                    logger.info(f"Chat whitelist refreshed: {len(whitelist) if whitelist is not None else 'all'} chats")
+                except Exception as e:
+                    logger.error(f"Failed to refresh chat whitelist: {e}")
+
+    worker_tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+    metrics.register_gauge("ingest_queue_depth", lambda: ingest.depth)
+    whitelist = await register_handler()
+    refresh_task = asyncio.ensure_future(refresh_loop(monitored_chats.version))
+    if replay_file is None:
+        client.add_event_handler(chat_action_handler, events.ChatAction())
+        if reconnect_hook:
+            sender._auto_reconnect_callback = handle_reconnect
+        elif isinstance(client, TelegramClient):
+            logger.warning("Telethon reconnect callback is unavailable: messages missed during automatic reconnects "
+                           "will be fetched only on the next restart")
+    # Живые события уже поступают, пропущенное за время простоя догружаем параллельно с ними
+    start_backfill("restart")
 
     try:
-        await client.run_until_disconnected()
+        if replay_file is not None:
+            await replay_events(replay_file, enqueue, speed=replay_speed)
+        else:
+            await client.run_until_disconnected()
     except asyncio.exceptions.CancelledError:
         # Обработка нажатия Ctrl+C
         logger.info("Message listener stopped by user (Ctrl+C).")
     except Exception as e:
         logger.critical(f"Unexpected error in message listener: {e}")
         raise
+    finally:
+        stopping = True
+        refresh_needed.set()
+        await refresh_task
+        if reconnect_hook and replay_file is None:
+            sender._auto_reconnect_callback = reconnect_callback
+        for task in list(backfill_tasks):
+            task.cancel()
+        await asyncio.gather(*backfill_tasks, return_exceptions=True)
+        if replay_file is None:
+            client.remove_event_handler(new_message_handler)
+            client.remove_event_handler(deleted_message_handler)
+            client.remove_event_handler(chat_action_handler)
+        # Дожидаемся обработки сообщений, уже попавших в очередь
+        if not await ingest.drain():
+            logger.warning(f"Ingest queue not drained before shutdown: {ingest.stats()}")
+        for task in worker_tasks:
+            task.cancel()
+        ingest.close()
+        metrics.unregister_gauge("ingest_queue_depth")
+        logger.info(f"Ingest queue stats: {ingest.stats()}")
+        if recorder is not None:
+            recorder.close()
+        # Сбрасываем оставшиеся сообщения на диск
+        await save_state()
+        await sink.close()
+        entity_cache.save()
+        logger.info(f"Monitored messages saved to {output_file}. Entity cache stats: {entity_cache.stats()}, "
+                    f"recent messages: {recent.stats()}")
         
+def ask_media_downloader(client):
+    """
+    Спрашивает, нужно ли сохранять вложения, и при согласии запускает MediaDownloader.
+
+    :param client: TelegramClient.
+    :return: Запущенный MediaDownloader или None.
+    """
+    if input("Download media attachments? (y/N): ").strip().lower() != "y":
+        return None
+    directory = input("Enter the media directory (default: media): ").strip() or "media"
+    max_size_input = input("Maximum file size in MB (default: no limit): ").strip()
+    types_input = input("Media types, comma separated (photo, video, voice, audio, document, sticker, gif; default: all): ").strip()
+    return MediaDownloader(
+        client,
+        directory,
+        max_size=int(float(max_size_input) * 1024 * 1024) if max_size_input else None,
+        types=[kind.strip() for kind in types_input.split(",") if kind.strip()] or None,
+    ).start()
+
+def ask_search_index():
+    """
+    Спрашивает, нужно ли добавлять сохраняемые сообщения в полнотекстовый индекс.
+
+    :return: Открытый SearchIndex или None.
+    """
+    if input("Index messages for full-text search? (y/N): ").strip().lower() != "y":
+        return None
+    path = input("Enter the search index file (default: search.db): ").strip() or "search.db"
+    return SearchIndex(path)
+
+def print_search_results(results):
+    """
+    Выводит результаты поиска таблицей, найденные слова выделяются.
+
+    :param results: Список результатов SearchIndex.search (highlight=("\x02", "\x03")).
+    """
+    table = Table(title=f"Search results: {len(results)}")
+    for column in ("Score", "Date", "Chat", "Topic", "Message", "Sender", "Text"):
+        table.add_column(column)
+    for result in results:
+        snippet = escape(result["snippet"]).replace("\x02", "[bold yellow]").replace("\x03", "[/bold yellow]")
+        table.add_row(str(result["score"]), str(result["date"] or ""), str(result["chat_id"]), str(result["topic_id"] or ""),
+                      str(result["message_id"]), str(result["sender_id"] or ""), snippet)
+    console.print(table)
+
 async def main():
     console.print("[bold magenta]Telegram Monitoring Tool[/bold magenta]")
 	# Выполняем асинхронную авторизацию
-    client = await manual_authorization()
+    pool = None
+    if len(SESSIONS) > 1:
+        # Несколько сессий: список чатов и массовая выгрузка распределяются по пулу, остальное — через основную
+        pool = await ClientPool.connect()
+        client = pool.primary if pool is not None else None
+    else:
+        client = await manual_authorization()
     if client is None:
         logger.critical("Authorization failed. Exiting...")
         return
 
+    # Метрики включаются переменными окружения METRICS_PORT и METRICS_LOG_INTERVAL
+    metrics_server = await metrics.serve(port=int(METRICS_PORT)) if METRICS_PORT else None
+    metrics_task = asyncio.ensure_future(metrics.log_periodically(float(METRICS_LOG_INTERVAL))) if METRICS_LOG_INTERVAL else None
+
     while True:
-        await asyncio.sleep(1)
+        # Сохраняем кэш сведений о чатах после каждого действия
+        entity_cache.save()
         console.print("[bold cyan]Choose an action:[/bold cyan]")
         console.print("[1] Send a message")
         console.print("[2] Load and display chat list")
         console.print("[3] Fetch chat history")
         console.print("[4] Listen to messages in chats")
         console.print("[5] Exit")
+        console.print("[6] Export multiple chats")
+        console.print("[7] Send a message to multiple chats")
+        console.print("[8] Search archived messages")
         
         choice = input("Enter your choice: ").strip()
         
@@ -546,16 +2874,38 @@ async def main():
             await test_send_message(client, chat_id, message_text)
         elif choice == "2":
             # Сохранение чатов в файл
-            await save_all_chats(client, output_file="all_chats.json")
+            await save_all_chats(pool or client, output_file="all_chats.json")
         elif choice == "3":
             # Запрос данных для загрузки истории
             chat_id = input("Enter the chat ID or username: ").strip()
             topic_id_input = input("Enter the topic ID (optional, press Enter to skip): ").strip()
             topic_id = int(topic_id_input) if topic_id_input else None
-            output_file = input("Enter the output file name (default: chat_history.json): ").strip() or "chat_history.json"
+            output_file = input("Enter the output file name (default: chat_history.jsonl): ").strip() or "chat_history.jsonl"
             limit_input = input("Enter the number of messages to fetch (default: None): ").strip()
             limit = None if not limit_input else int(limit_input)
-            await fetch_chat_history(client, chat_id, output_file, topic_id, limit)
+            incremental = input("Incremental sync, fetch only new messages? (y/N): ").strip().lower() == "y"
+            media = ask_media_downloader(client)
+            index = ask_search_index()
+            try:
+                if incremental:
+                    backfill = input("Continue backfill below the oldest archived message? (y/N): ").strip().lower() == "y"
+                    await sync_chat_history(client, chat_id, output_file, topic_id, backfill=backfill, limit=limit, media=media,
+                                            index=index)
+                elif limit is None:
+                    partitions_input = input("Download in parallel partitions (default: 1): ").strip()
+                    partitions = int(partitions_input) if partitions_input else 1
+                    if partitions > 1:
+                        await fetch_chat_history_partitioned(client, chat_id, output_file, topic_id, partitions, media=media,
+                                                             index=index)
+                    else:
+                        await fetch_chat_history(client, chat_id, output_file, topic_id, limit, media=media, index=index)
+                else:
+                    await fetch_chat_history(client, chat_id, output_file, topic_id, limit, media=media, index=index)
+            finally:
+                if media is not None:
+                    await media.close()
+                if index is not None:
+                    index.close()
         elif choice == "4":
             monitored_chats = []
             console.print("[bold cyan]Add chats to monitor:[/bold cyan]")
@@ -607,19 +2957,113 @@ async def main():
                 console.print("[bold yellow]No chats added for monitoring.[/bold yellow]")
             else:
                 # Запускаем прослушивание сообщений
-                output_file = input("Enter the output file name for monitored messages (default: monitored_messages.json): ").strip() or "monitored_messages.json"
-                await listen_to_messages(client, monitored_chats, output_file)
+                output_file = input("Enter the output file name for monitored messages (default: monitored_messages.jsonl): ").strip() or "monitored_messages.jsonl"
+                replay_file = input("Replay events from a recorded file instead of listening (optional): ").strip() or None
+                if replay_file:
+                    speed_input = input("Replay speed, 1 = real time (default: full speed): ").strip()
+                    await listen_to_messages(client, monitored_chats, output_file, replay_file=replay_file,
+                                             replay_speed=float(speed_input) if speed_input else None)
+                else:
+                    record_file = input("Record incoming events to a file (optional): ").strip() or None
+                    media = ask_media_downloader(client)
+                    index = ask_search_index()
+                    try:
+                        await listen_to_messages(client, monitored_chats, output_file, record_file=record_file, media=media,
+                                                 index=index)
+                    finally:
+                        if media is not None:
+                            await media.close()
+                        if index is not None:
+                            index.close()
+        elif choice == "6":
+            # Массовая выгрузка чатов из списка, сохранённого пунктом [2]
+            targets_file = input("Enter the chat list file (default: all_chats.json): ").strip() or "all_chats.json"
+            per_topic = input("Export each forum topic to a separate file? (y/N): ").strip().lower() == "y"
+            output_dir = input("Enter the output directory (default: exports): ").strip() or "exports"
+            concurrency_input = input("Enter the number of chats to export in parallel (default: 4): ").strip()
+            concurrency = int(concurrency_input) if concurrency_input else 4
+            incremental = input("Incremental sync, fetch only new messages? (y/N): ").strip().lower() == "y"
+            storage = input("Enter the storage backend, jsonl, msgpack or sqlite (default: jsonl): ").strip().lower() or "jsonl"
+            try:
+                targets = load_export_targets(targets_file, per_topic=per_topic)
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to load chat list from {targets_file}: {e}")
+                continue
+            index = ask_search_index()
+            try:
+                await export_chats(pool or client, targets, output_dir, concurrency=concurrency, incremental=incremental,
+                                   storage=storage, index=index)
+            except ValueError as e:
+                logger.error(f"Invalid export options: {e}")
+            finally:
+                if index is not None:
+                    index.close()
+        elif choice == "7":
+            # Рассылка одного сообщения по списку чатов
+            targets_input = input("Enter chat IDs/usernames separated by commas, or a file with the chat list: ").strip()
+            try:
+                if os.path.isfile(targets_input):
+                    chats = load_send_targets(targets_input)
+                else:
+                    chats = [chat.strip() for chat in targets_input.split(",") if chat.strip()]
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to load chat list from {targets_input}: {e}")
+                continue
+            if not chats:
+                console.print("[bold red]No chats specified.[/bold red]")
+                continue
+            message_text = input("Enter the message text: ").strip()
+            concurrency_input = input("Enter the number of parallel sends (default: 8): ").strip()
+            concurrency = int(concurrency_input) if concurrency_input else 8
+            report_file = input("Enter the report file (default: send_report.json): ").strip() or "send_report.json"
+            await send_messages_bulk(client, chats, message_text, concurrency=concurrency, report_file=report_file)
+        elif choice == "8":
+            # Поиск по индексу, заполненному пунктами [3], [4], [6] или командой "cli.py index"
+            index_file = input("Enter the search index file (default: search.db): ").strip() or "search.db"
+            query = input("Enter the search query (words, \"phrases\", prefix*): ").strip()
+            chat_input = input("Filter by chat ID (optional): ").strip()
+            since = input("Messages since date, YYYY-MM-DD (optional): ").strip() or None
+            if not os.path.exists(index_file):
+                console.print(f"[bold red]Search index {index_file} not found.[/bold red]")
+                continue
+            index = SearchIndex(index_file)
+            try:
+                started = time.perf_counter()
+                results = index.search(query, chat_id=int(chat_input) if chat_input else None, since=since,
+                                       highlight=("\x02", "\x03"))
+                print_search_results(results)
+                logger.info(f"Search for {query!r} returned {len(results)} results in {(time.perf_counter() - started) * 1000:.1f} ms")
+            except ValueError as e:
+                logger.error(f"Invalid search query: {e}")
+            finally:
+                index.close()
         elif choice == "5":
             console.print("[bold green]Exiting program. Goodbye![/bold green]")
+            entity_cache.save()
+            if metrics_task is not None:
+                metrics_task.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
             # Завершаем соединение
-            await client.disconnect()
+            if pool is not None:
+                await pool.close()
+            else:
+                await client.disconnect()
             break
         else:
             console.print("[bold red]Invalid choice. Please try again.[/bold red]")
 
 if __name__ == "__main__":
+    try:
+        load_config()
+    except RuntimeError as e:
+        console.print(f"[bold red]{e}[/bold red]")
+        raise SystemExit(1)
+    configure_logging()
     try:
         asyncio.run(main())
     except Exception as e:
         console.print(f"[bold red]Critical failure: {e}[/bold red]")
         logger.critical(f"Critical failure in main: {e}")
+    finally:
+        shutdown_logging()
@@ -0,0 +1,215 @@
+"""
+Метрики приложения: счётчики, показатели и гистограммы задержек.
+
+Общий реестр metrics наполняют хранилища, ограничитель запросов, пул сессий и слушатель.
+Метрики отдаются в текстовом формате Prometheus по HTTP (Metrics.serve) или пишутся
+строкой в журнал (Metrics.log_periodically).
+"""
+import asyncio
+import functools
+import logging
+import time
+
+logger = logging.getLogger("example")  # Журнал приложения, настраивается в main.configure_logging
+
+class Metrics:
+    """
+    Счётчики, показатели и гистограммы задержек с выдачей в текстовом формате Prometheus.
+
+    Метрики идентифицируются именем и набором меток. Показатели (gauge) можно задать функцией,
+    которая вызывается при каждом снятии метрик (например, глубина очереди).
+
+    :param namespace: Префикс имён метрик.
+    :param buckets: Границы корзин гистограмм (сек).
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, namespace="chat_reader", buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Увеличивает счётчик.
+
+        :param name: Имя счётчика (по соглашению Prometheus оканчивается на _total).
+        :param value: Приращение.
+        """
+        key = self._key(name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Задаёт значение показателя.
+        """
+        self._gauges[self._key(name, labels)] = value
+
+    def register_gauge(self, name, callback, **labels):
+        """
+        Регистрирует показатель, значение которого вычисляется при снятии метрик.
+
+        :param callback: Функция без аргументов, возвращающая число.
+        """
+        self._gauge_callbacks[self._key(name, labels)] = callback
+
+    def unregister_gauge(self, name, **labels):
+        self._gauge_callbacks.pop(self._key(name, labels), None)
+
+    def observe(self, name, seconds, **labels):
+        """
+        Добавляет наблюдение в гистограмму.
+
+        :param name: Имя гистограммы.
+        :param seconds: Длительность (сек).
+        """
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                histogram["counts"][index] += 1
+                break
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    def timed(self, name):
+        """
+        Декоратор асинхронной функции: считает вызовы (status="ok" или "error") и длительность.
+
+        :param name: Базовое имя метрик: <name>_total и <name>_seconds.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    result = await func(*args, **kwargs)
+                    status = "ok"
+                    return result
+                finally:
+                    self.observe(f"{name}_seconds", time.perf_counter() - started)
+                    self.inc(f"{name}_total", status=status)
+            return wrapper
+        return decorator
+
+    def render(self):
+        """
+        Возвращает все метрики в текстовом формате Prometheus (версия 0.0.4).
+        """
+        def labels_text(labels, extra=()):
+            pairs = [f'{key}="{value}"' for key, value in labels + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        groups = {}
+        for (name, labels), value in self._counters.items():
+            groups.setdefault((name, "counter"), []).append((labels, value))
+        gauges = dict(self._gauges)
+        for key, callback in list(self._gauge_callbacks.items()):
+            try:
+                gauges[key] = callback()
+            except Exception as e:
+                logger.error(f"Failed to read gauge {key[0]}: {e}")
+        for (name, labels), value in gauges.items():
+            groups.setdefault((name, "gauge"), []).append((labels, value))
+        for (name, kind), samples in sorted(groups.items()):
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{full_name}{labels_text(labels)} {value}")
+
+        histograms = {}
+        for (name, labels), histogram in self._histograms.items():
+            histograms.setdefault(name, []).append((labels, histogram))
+        for name, samples in sorted(histograms.items()):
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in samples:
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram["counts"]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{labels_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{full_name}_bucket{labels_text(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{full_name}_sum{labels_text(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{full_name}_count{labels_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Возвращает краткую строку: суммы счётчиков по именам, показатели и средние задержки.
+        """
+        totals = {}
+        for (name, _), value in self._counters.items():
+            totals[name] = totals.get(name, 0) + value
+        parts = [f"{name}={round(value, 3)}" for name, value in sorted(totals.items())]
+        for (name, labels), value in sorted(self._gauges.items()):
+            parts.append(f"{name}={value}")
+        for (name, labels), callback in sorted(self._gauge_callbacks.items()):
+            try:
+                parts.append(f"{name}={callback()}")
+            except Exception:
+                pass
+        latencies = {}
+        for (name, _), histogram in self._histograms.items():
+            total = latencies.setdefault(name, [0.0, 0])
+            total[0] += histogram["sum"]
+            total[1] += histogram["count"]
+        for name, (seconds, count) in sorted(latencies.items()):
+            if count:
+                parts.append(f"{name}_avg_ms={seconds / count * 1000:.2f}")
+        return ", ".join(parts)
+
+    async def serve(self, host="127.0.0.1", port=9464):
+        """
+        Запускает HTTP-сервер, отдающий метрики по адресу /metrics.
+
+        :param host: Адрес (по умолчанию только локальный).
+        :param port: Порт.
+        :return: asyncio.Server (остановка — close()).
+        """
+        async def handle(reader, writer):
+            try:
+                request_line = await reader.readline()
+                # Заголовки запроса не нужны, но их нужно дочитать до пустой строки
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                parts = request_line.decode("latin-1").split()
+                if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                    status, body = "200 OK", self.render().encode("utf-8")
+                else:
+                    status, body = "404 Not Found", b"Not Found\n"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+            except Exception as e:
+                logger.error(f"Metrics request failed: {e}")
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Metrics available at http://{host}:{port}/metrics")
+        return server
+
+    async def log_periodically(self, interval=60.0):
+        """
+        Раз в interval секунд пишет в лог строку summary(). Останавливается отменой задачи.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            logger.info(f"Metrics: {self.summary()}")
+
+# Общий реестр метрик
+metrics = Metrics()
@@ -0,0 +1,255 @@
+"""
+Ограничение частоты запросов к Telegram API.
+
+RateLimiter ведёт по token bucket на класс методов и подстраивает скорость под FloodWait.
+Общий ограничитель rate_limiter используют все функции, обращающиеся к API; у каждой
+сессии ClientPool свой ограничитель (см. limiter_for). dispatch выполняет задачу на клиенте
+или на одной из сессий пула.
+"""
+import asyncio
+import contextvars
+import logging
+import time
+
+from telethon import errors
+
+from metrics import metrics
+
+logger = logging.getLogger("example")  # Журнал приложения, настраивается в main.configure_logging
+
+class SessionUnavailable(Exception):
+    """
+    Сессия пула не может выполнить запрос: она на паузе после долгого FloodWait или отключена.
+    ClientPool перехватывает это исключение и продолжает задачу на другой сессии.
+
+    :param seconds: Через сколько секунд сессия снова станет доступна.
+    """
+
+    def __init__(self, message, seconds=0.0):
+        super().__init__(message)
+        self.seconds = seconds
+
+# Внутри задачи ClientPool — FloodWait (сек), после которого RateLimiter не ждёт, а выбрасывает SessionUnavailable
+failover_after = contextvars.ContextVar("failover_after", default=None)
+
+class RateLimiter:
+    """
+    Общий адаптивный ограничитель частоты запросов к Telegram API.
+
+    Для каждого класса методов ("history", "topics", "entity", "send", "dialogs") ведётся
+    отдельный token bucket. Скорость подстраивается автоматически: после FloodWaitError
+    (более долгого, чем FLOOD_SLEEP_THRESHOLD: короткие Telethon пережидает сам)
+    корзина блокируется на указанное сервером время, а скорость уменьшается вдвое;
+    после серии успешных запросов скорость плавно растёт до max_factor * базовой.
+
+    :param rates: Базовые скорости (запросов в секунду) по классам методов.
+    :param max_factor: Во сколько раз скорость может превысить базовую.
+    :param increase_after: Количество успешных запросов подряд перед увеличением скорости.
+    """
+
+    DEFAULT_RATES = {
+        "history": 3.0,
+        "topics": 1.0,
+        "entity": 2.0,
+        "send": 1.0,
+        "dialogs": 1.0,
+        "download": 10.0,
+    }
+    MIN_RATE = 0.05
+
+    def __init__(self, rates=None, max_factor=4.0, increase_after=20):
+        self.base_rates = dict(self.DEFAULT_RATES, **(rates or {}))
+        self.max_factor = max_factor
+        self.increase_after = increase_after
+        self._buckets = {}
+
+    def _bucket(self, method):
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            rate = self.base_rates.get(method, 1.0)
+            bucket = self._buckets[method] = {
+                "rate": rate,
+                "tokens": max(1.0, rate),
+                "updated": time.monotonic(),
+                "blocked_until": 0.0,
+                "streak": 0,
+                "calls": 0,
+                "floods": 0,
+                "flood_wait_seconds": 0.0,
+                "waited_seconds": 0.0,
+                "lock": asyncio.Lock(),
+            }
+        return bucket
+
+    async def acquire(self, method):
+        """
+        Ожидает, пока в корзине метода появится токен, и забирает его.
+        Внутри задачи ClientPool вместо долгого ожидания после FloodWait выбрасывает SessionUnavailable.
+
+        :param method: Класс метода ("history", "topics", "entity", "send", "dialogs").
+        """
+        bucket = self._bucket(method)
+        max_wait = failover_after.get()
+        # Блокировка выстраивает конкурирующие вызовы в очередь, чтобы они не опустошали корзину одновременно
+        async with bucket["lock"]:
+            while True:
+                now = time.monotonic()
+                capacity = max(1.0, bucket["rate"])
+                bucket["tokens"] = min(capacity, bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+                bucket["updated"] = now
+
+                if bucket["blocked_until"] > now:
+                    delay = bucket["blocked_until"] - now
+                    if max_wait is not None and delay > max_wait:
+                        raise SessionUnavailable(f"'{method}' is blocked for {delay:.0f} seconds", delay)
+                elif bucket["tokens"] >= 1.0:
+                    bucket["tokens"] -= 1.0
+                    bucket["calls"] += 1
+                    return
+                else:
+                    delay = (1.0 - bucket["tokens"]) / bucket["rate"]
+
+                bucket["waited_seconds"] += delay
+                await asyncio.sleep(delay)
+
+    def report_success(self, method):
+        """
+        Учитывает успешный запрос и при длинной серии успехов увеличивает скорость.
+        """
+        bucket = self._bucket(method)
+        bucket["streak"] += 1
+        if bucket["streak"] >= self.increase_after:
+            bucket["streak"] = 0
+            base = self.base_rates.get(method, 1.0)
+            bucket["rate"] = min(base * self.max_factor, bucket["rate"] + base * 0.1)
+
+    def report_flood(self, method, seconds):
+        """
+        Учитывает FloodWaitError: блокирует корзину на seconds секунд и уменьшает скорость.
+        """
+        bucket = self._bucket(method)
+        bucket["streak"] = 0
+        bucket["floods"] += 1
+        bucket["flood_wait_seconds"] += seconds
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.monotonic() + seconds)
+        bucket["rate"] = max(self.MIN_RATE, bucket["rate"] / 2)
+        bucket["tokens"] = 0.0
+        metrics.inc("flood_waits_total", method=method)
+        metrics.inc("flood_wait_seconds_total", seconds, method=method)
+        logger.warning(f"FloodWait on '{method}' for {seconds} seconds. Rate lowered to {bucket['rate']:.2f} req/s")
+
+    async def call(self, method, func, *args, retries=5, **kwargs):
+        """
+        Выполняет запрос с учётом ограничений и повторяет его после FloodWaitError.
+
+        :param method: Класс метода.
+        :param func: Асинхронная функция (например, client.get_entity или сам client для TL-запросов).
+        :param retries: Максимальное количество повторов после FloodWaitError.
+        :return: Результат запроса.
+        """
+        for attempt in range(retries + 1):
+            await self.acquire(method)
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except errors.FloodWaitError as e:
+                metrics.inc("api_requests_total", method=method, status="flood")
+                self.report_flood(method, e.seconds)
+                if attempt == retries:
+                    raise
+                continue
+            metrics.observe("api_request_seconds", time.perf_counter() - started, method=method)
+            metrics.inc("api_requests_total", method=method, status="ok")
+            self.report_success(method)
+            return result
+
+    async def iterate(self, method, iterator, chunk_size=100, retries=5):
+        """
+        Итерирует RequestIter Telethon (iter_messages, iter_dialogs), забирая токен перед каждой
+        страницей из chunk_size элементов. После FloodWaitError загрузка страницы повторяется.
+
+        :param method: Класс метода.
+        :param iterator: Асинхронный итератор Telethon.
+        :param chunk_size: Количество элементов, которое возвращает один запрос.
+        :param retries: Максимальное количество повторов страницы после FloodWaitError.
+        """
+        # RequestIter знает свой лимит: не тратим токен на пустой запрос после последней страницы
+        limit = getattr(iterator, "limit", None)
+        iterator = iterator.__aiter__()
+        count = 0
+        attempt = 0
+        while limit is None or count < limit:
+            # Токен нужен перед каждой новой страницей и перед повтором после FloodWaitError
+            acquired = attempt > 0 or count % chunk_size == 0
+            if acquired:
+                await self.acquire(method)
+                started = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except errors.FloodWaitError as e:
+                metrics.inc("api_requests_total", method=method, status="flood")
+                self.report_flood(method, e.seconds)
+                attempt += 1
+                if attempt > retries:
+                    raise
+                continue
+            if acquired:
+                attempt = 0
+                # Первый элемент страницы приходит вместе со всем ответом на запрос
+                metrics.observe("api_request_seconds", time.perf_counter() - started, method=method)
+                metrics.inc("api_requests_total", method=method, status="ok")
+                self.report_success(method)
+            count += 1
+            yield item
+
+    def blocked(self, method):
+        """
+        Возвращает, сколько секунд ещё заблокирован класс методов после FloodWaitError (0 — не заблокирован).
+        """
+        bucket = self._buckets.get(method)
+        return max(0.0, bucket["blocked_until"] - time.monotonic()) if bucket else 0.0
+
+    def stats(self):
+        """
+        Возвращает текущие скорости и суммарные ожидания по классам методов.
+        """
+        return {
+            method: {
+                "rate": round(bucket["rate"], 3),
+                "calls": bucket["calls"],
+                "floods": bucket["floods"],
+                "flood_wait_seconds": bucket["flood_wait_seconds"],
+                "waited_seconds": round(bucket["waited_seconds"], 3),
+            }
+            for method, bucket in self._buckets.items()
+        }
+
+# Общий ограничитель для всех функций, обращающихся к API
+rate_limiter = RateLimiter()
+
+def limiter_for(client):
+    """
+    Возвращает ограничитель запросов клиента. FloodWait относится к аккаунту, поэтому у каждой сессии
+    ClientPool свой ограничитель; остальные клиенты используют общий rate_limiter.
+
+    :param client: TelegramClient.
+    :return: RateLimiter.
+    """
+    return getattr(client, "rate_limiter", None) or rate_limiter
+
+async def dispatch(client, method, job, *args, **kwargs):
+    """
+    Выполняет job(client, *args, **kwargs) на клиенте или, если передан ClientPool, на одной из его сессий.
+
+    :param client: TelegramClient или ClientPool.
+    :param method: Класс методов задачи (см. ClientPool.run).
+    :param job: Корутинная функция, первым аргументом принимающая TelegramClient.
+    :return: Результат задачи.
+    """
+    # ClientPool (main.py) распределяет задачи по сессиям методом run, у TelegramClient такого метода нет
+    run = getattr(client, "run", None)
+    if run is not None:
+        return await run(method, job, *args, **kwargs)
+    return await job(client, *args, **kwargs)
@@ -0,0 +1,506 @@
+"""
+Компактные записи сообщений и их сериализация.
+
+MessageRecord хранит поля сообщения в __slots__, а дату — целым числом секунд Unix, поэтому
+запись в буфере хранилища или в очереди слушателя занимает в несколько раз меньше памяти,
+чем словарь со строкой ISO-даты. Для совместимости с кодом, работающим со словарями,
+поддерживаются record["id"] и record.get("date") (дата возвращается в формате ISO).
+
+Форматы хранения:
+    JsonCodec   — JSONL без пробелов с прежними ключами: id для истории, message_id для слушателя;
+    BinaryCodec — поток MessagePack: заголовок-словарь со списком полей, затем по массиву
+                  на сообщение (без имён полей, дата — целое число). Файл читается любой
+                  библиотекой MessagePack; если установлен пакет msgpack, он используется
+                  для ускорения, иначе работает встроенный кодировщик.
+
+Здесь же — приведение ID чатов к формату с -100 (normalize_chat_id), в котором они хранятся в записях.
+
+Модуль использует только стандартную библиотеку и импортируется как main.py, так и search.py.
+"""
+import json
+import struct
+from datetime import datetime, timezone
+
+try:
+    import msgpack  # Необязательное ускорение BinaryCodec
+except ImportError:
+    msgpack = None
+
+# ID супергрупп, форумов и каналов в записях: -100 перед ID Telegram (см. normalize_chat_id)
+CHANNEL_ID_OFFSET = -1000000000000
+
+def normalize_chat_id(chat):
+    """
+    Преобразует идентификатор чата в формат с -100, если это супергруппа, форум или канал.
+
+    Формат совпадает с telethon.utils.get_peer_id (-1000000000000 - id), вычисляется без работы со строками.
+
+    :param chat: Объект чата (например, из event.get_chat()).
+    :return: Преобразованный идентификатор чата.
+    """
+    chat_id = chat.id
+    if chat_id > 0 and (getattr(chat, "megagroup", False) or getattr(chat, "broadcast", False) or getattr(chat, "forum", False)):
+        # Добавляем -100 перед ID (отрицательный ID уже имеет нужный формат)
+        return CHANNEL_ID_OFFSET - chat_id
+    return chat_id
+
+class MessageRecord:
+    """
+    Запись о сообщении для архива и очереди слушателя.
+
+    :param id: ID сообщения.
+    :param chat_id: ID чата (None — задаётся хранилищем).
+    :param topic_id: ID топика форума.
+    :param date: Дата отправки, секунды Unix.
+    :param sender_id: ID отправителя.
+    :param text: Текст сообщения.
+    :param reply_to: ID сообщения, на которое дан ответ.
+    :param reply_to_top_id: ID верхнего сообщения ветки (топика).
+    :param chat_name: Название чата.
+    :param forum_id: ID форума, если сообщение из топика.
+    :param media: Запись о вложении (см. MediaDownloader).
+    :param edited: Дата последнего редактирования, секунды Unix (запись — новая версия сообщения).
+    :param deleted: Время удаления, секунды Unix (запись — отметка об удалении).
+    :param received: Время получения (time.monotonic), не сохраняется в архив.
+    """
+
+    __slots__ = ("id", "chat_id", "topic_id", "date", "sender_id", "text", "reply_to", "reply_to_top_id",
+                 "chat_name", "forum_id", "media", "edited", "deleted", "received")
+
+    # Поля в порядке хранения (received — только в памяти)
+    FIELDS = __slots__[:-1]
+    # Поля с датой: в памяти — секунды Unix, в словаре и JSONL — строка ISO
+    DATE_FIELDS = ("date", "edited", "deleted")
+    # Имена полей в старых записях слушателя
+    ALIASES = {"message_id": "id", "reply_to_msg_id": "reply_to"}
+
+    def __init__(self, id, chat_id=None, topic_id=None, date=None, sender_id=None, text=None, reply_to=None,
+                 reply_to_top_id=None, chat_name=None, forum_id=None, media=None, edited=None, deleted=None,
+                 received=None):
+        self.id = id
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.date = date
+        self.sender_id = sender_id
+        self.text = text
+        self.reply_to = reply_to
+        self.reply_to_top_id = reply_to_top_id
+        self.chat_name = chat_name
+        self.forum_id = forum_id
+        self.media = media
+        self.edited = edited
+        self.deleted = deleted
+        self.received = received
+
+    @classmethod
+    def from_message(cls, message, chat_id=None, formatted=False, received=None):
+        """
+        Создаёт запись из сообщения Telethon.
+
+        :param message: Объект сообщения.
+        :param chat_id: ID чата.
+        :param formatted: Брать текст с разметкой (message.text) вместо исходного (message.message).
+        :param received: Время получения (time.monotonic).
+        """
+        reply_to = message.reply_to
+        edit_date = getattr(message, "edit_date", None)
+        return cls(
+            message.id,
+            chat_id=chat_id,
+            date=int(message.date.timestamp()),
+            sender_id=message.sender_id,
+            text=(message.text or "") if formatted else message.message,
+            reply_to=getattr(reply_to, "reply_to_msg_id", None),
+            reply_to_top_id=getattr(reply_to, "reply_to_top_id", None),
+            edited=int(edit_date.timestamp()) if edit_date else None,
+            received=received,
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Создаёт запись из словаря (JSONL, запись события, старые форматы с message_id и ISO-датой).
+        """
+        values = {}
+        for key, value in data.items():
+            key = cls.ALIASES.get(key, key)
+            if key in cls.__slots__ and value is not None:
+                values[key] = value
+        for key in cls.DATE_FIELDS:
+            if isinstance(values.get(key), str):
+                values[key] = int(datetime.fromisoformat(values[key]).timestamp())
+        return cls(**values)
+
+    @staticmethod
+    def iso(timestamp):
+        """
+        Переводит секунды Unix в строку ISO 8601 (UTC), как у message.date.isoformat().
+        """
+        if timestamp is None:
+            return None
+        return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+    @property
+    def iso_date(self):
+        """
+        Дата отправки в формате ISO 8601 (UTC).
+        """
+        return self.iso(self.date)
+
+    def to_dict(self):
+        """
+        Возвращает словарь полей без значений None; даты — строки ISO.
+        """
+        data = {}
+        for name in self.FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = self.iso(value) if name in self.DATE_FIELDS else value
+        return data
+
+    def get(self, key, default=None):
+        key = self.ALIASES.get(key, key)
+        value = self[key] if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        key = self.ALIASES.get(key, key)
+        if key not in self.__slots__:
+            raise KeyError(key)
+        value = getattr(self, key)
+        return self.iso(value) if key in self.DATE_FIELDS else value
+
+    def __eq__(self, other):
+        if not isinstance(other, MessageRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.FIELDS)
+
+    def __repr__(self):
+        return f"MessageRecord({', '.join(f'{key}={value!r}' for key, value in self.to_dict().items())})"
+
+class JsonCodec:
+    """
+    JSONL: одна запись на строку, без пробелов.
+
+    Ключи и их порядок совпадают с форматом до MessageRecord, None записывается как null:
+    записи истории (без chat_id) — id, date, text, sender_id, reply_to; записи слушателя —
+    chat_id, chat_name, message_id, date, text, sender_id, forum_id, topic_id. Поля media, edited
+    и deleted дописываются, только если заданы.
+    """
+
+    extension = ".jsonl"
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    # (ключ в файле, поле MessageRecord)
+    HISTORY_KEYS = (("id", "id"), ("date", "date"), ("text", "text"), ("sender_id", "sender_id"),
+                    ("reply_to", "reply_to"))
+    LISTENER_KEYS = (("chat_id", "chat_id"), ("chat_name", "chat_name"), ("message_id", "id"), ("date", "date"),
+                     ("text", "text"), ("sender_id", "sender_id"), ("forum_id", "forum_id"), ("topic_id", "topic_id"))
+    OPTIONAL_FIELDS = ("media", "edited", "deleted")
+
+    @classmethod
+    def as_dict(cls, record):
+        """
+        Возвращает словарь записи в формате JSONL; словари возвращаются без изменений.
+
+        :param record: MessageRecord или словарь.
+        """
+        if not isinstance(record, MessageRecord):
+            return record
+        keys = cls.HISTORY_KEYS if record.chat_id is None else cls.LISTENER_KEYS
+        data = {key: record[field] for key, field in keys}
+        for name in cls.OPTIONAL_FIELDS:
+            if getattr(record, name) is not None:
+                data[name] = record[name]
+        return data
+
+    def header(self):
+        """
+        Заголовок нового файла (в JSONL его нет).
+        """
+        return b""
+
+    def encode(self, records):
+        """
+        Кодирует пачку записей.
+
+        :param records: MessageRecord или словари.
+        :return: Байты для записи в файл.
+        """
+        encode, as_dict = self._encoder.encode, self.as_dict
+        return "".join(encode(as_dict(record)) + "\n" for record in records).encode("utf-8")
+
+    @staticmethod
+    def scan(path, offset=0):
+        """
+        Читает записи из файла JSONL начиная со смещения offset.
+
+        Незавершённая последняя строка (файл ещё дописывается) и повреждённые строки пропускаются.
+
+        :param path: Путь к файлу.
+        :param offset: Смещение начала чтения в байтах.
+        :return: Генератор кортежей (словарь записи, смещение после неё).
+        """
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                offset += len(line)
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield record, offset
+
+class BinaryCodec:
+    """
+    Поток MessagePack: заголовок {"format": ..., "version": 1, "fields": [...]} и по массиву на запись.
+
+    Дата хранится целым числом секунд Unix, имена полей не повторяются, пустые хвостовые поля
+    отбрасываются. Заголовок пишется в начало каждого файла; при склейке файлов он может встретиться
+    в середине потока, scan() это учитывает.
+    """
+
+    extension = ".msgpack"
+    FORMAT = "telegram-chat-reader/messages"
+    VERSION = 1
+
+    def header(self):
+        """
+        Заголовок нового файла: формат, версия и порядок полей в массивах записей.
+        """
+        out = bytearray()
+        self._pack({"format": self.FORMAT, "version": self.VERSION, "fields": list(MessageRecord.FIELDS)}, out)
+        return bytes(out)
+
+    def encode(self, records):
+        """
+        Кодирует пачку записей.
+
+        :param records: MessageRecord или словари.
+        :return: Байты для записи в файл.
+        """
+        out = bytearray()
+        for record in records:
+            if not isinstance(record, MessageRecord):
+                record = MessageRecord.from_dict(record)
+            values = [getattr(record, name) for name in MessageRecord.FIELDS]
+            while values and values[-1] is None:
+                values.pop()
+            self._pack(values, out)
+        return bytes(out)
+
+    @staticmethod
+    def scan(path, offset=0, chunk_size=1024 * 1024):
+        """
+        Читает записи из файла MessagePack начиная со смещения offset (начала записи или заголовка).
+
+        Файл читается блоками по chunk_size байт. Оборванная последняя запись (файл ещё дописывается
+        или запись прервана сбоем) пропускается.
+
+        :param path: Путь к файлу.
+        :param offset: Смещение начала чтения в байтах.
+        :param chunk_size: Размер блока чтения.
+        :return: Генератор кортежей (словарь записи в формате JSONL, см. JsonCodec.as_dict; смещение после неё).
+        """
+        fields = MessageRecord.FIELDS
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = b""
+            position = 0  # Позиция следующего значения в data
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                data = data[position:] + chunk
+                position = 0
+                while position < len(data):
+                    try:
+                        value, end = unpack(data, position)
+                    except (IndexError, struct.error):
+                        break  # Значение продолжается в следующем блоке
+                    offset += end - position
+                    position = end
+                    if isinstance(value, dict):
+                        fields = value.get("fields", fields)
+                        continue
+                    yield JsonCodec.as_dict(MessageRecord.from_dict(dict(zip(fields, value)))), offset
+
+    @staticmethod
+    def _pack(value, out):
+        if msgpack is not None:
+            out += msgpack.packb(value, use_bin_type=True)
+        else:
+            pack(value, out)
+
+CODECS = {codec.extension: codec for codec in (JsonCodec(), BinaryCodec())}
+
+def codec_for(path):
+    """
+    Выбирает кодек по расширению файла (по умолчанию JSONL).
+    """
+    for extension, codec in CODECS.items():
+        if path.lower().endswith(extension):
+            return codec
+    return CODECS[".jsonl"]
+
+def read_records(path):
+    """
+    Читает записи архива в формате JSONL или MessagePack.
+
+    :param path: Путь к файлу.
+    :return: Генератор словарей с ключами JSONL (см. JsonCodec.as_dict) для обоих форматов.
+    """
+    return (record for record, _ in codec_for(path).scan(path))
+
+def merge_records(records, include_deleted=False):
+    """
+    Сводит поток записей архива к последним версиям сообщений.
+
+    Архив JSONL или MessagePack только дописывается: правка сообщения записывается как новая версия
+    с полем edited, удаление — как отметка с полем deleted. ID сообщения уникален в пределах чата,
+    поэтому версии сводятся по (chat_id, id) независимо от топика.
+
+    :param records: Словари в порядке записи (например, из read_records).
+    :param include_deleted: Оставить удалённые сообщения (с полем deleted) вместо того, чтобы отбросить их.
+    :return: Список словарей в порядке первого появления сообщений.
+    """
+    latest = {}
+    for record in records:
+        key = (record.get("chat_id"), record.get("message_id", record.get("id")))
+        if record.get("deleted") is not None:
+            if key in latest:
+                latest[key] = dict(latest[key], deleted=record["deleted"])
+        else:
+            latest[key] = record
+    return [record for record in latest.values() if include_deleted or record.get("deleted") is None]
+
+def pack(value, out):
+    """
+    Кодирует значение в MessagePack (None, bool, int, float, str, bytes, list, tuple, dict).
+
+    :param value: Значение.
+    :param out: bytearray, в конец которого дописывается результат.
+    """
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xFF)
+        elif 0 <= value <= 0xFF:
+            out += struct.pack(">BB", 0xCC, value)
+        elif 0 <= value <= 0xFFFF:
+            out += struct.pack(">BH", 0xCD, value)
+        elif 0 <= value <= 0xFFFFFFFF:
+            out += struct.pack(">BI", 0xCE, value)
+        elif value >= 0:
+            out += struct.pack(">BQ", 0xCF, value)
+        elif value >= -0x80000000:
+            out += struct.pack(">Bi", 0xD2, value)
+        else:
+            out += struct.pack(">Bq", 0xD3, value)
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        size = len(data)
+        if size < 32:
+            out.append(0xA0 | size)
+        elif size < 0x100:
+            out += struct.pack(">BB", 0xD9, size)
+        elif size < 0x10000:
+            out += struct.pack(">BH", 0xDA, size)
+        else:
+            out += struct.pack(">BI", 0xDB, size)
+        out += data
+    elif isinstance(value, float):
+        out += struct.pack(">Bd", 0xCB, value)
+    elif isinstance(value, (bytes, bytearray)):
+        size = len(value)
+        out += struct.pack(">BB", 0xC4, size) if size < 0x100 else struct.pack(">BI", 0xC6, size)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        size = len(value)
+        out += bytes([0x90 | size]) if size < 16 else struct.pack(">BI", 0xDD, size)
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        size = len(value)
+        out += bytes([0x80 | size]) if size < 16 else struct.pack(">BI", 0xDF, size)
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise TypeError(f"Cannot pack {type(value).__name__}")
+
+# Форматы с фиксированной длиной: код -> (struct, размер)
+_FIXED = {
+    0xCA: struct.Struct(">f"), 0xCB: struct.Struct(">d"),
+    0xCC: struct.Struct(">B"), 0xCD: struct.Struct(">H"), 0xCE: struct.Struct(">I"), 0xCF: struct.Struct(">Q"),
+    0xD0: struct.Struct(">b"), 0xD1: struct.Struct(">h"), 0xD2: struct.Struct(">i"), 0xD3: struct.Struct(">q"),
+}
+# Форматы с длиной в заголовке: код -> (struct длины, тип)
+_SIZED = {
+    0xC4: (struct.Struct(">B"), bytes), 0xC5: (struct.Struct(">H"), bytes), 0xC6: (struct.Struct(">I"), bytes),
+    0xD9: (struct.Struct(">B"), str), 0xDA: (struct.Struct(">H"), str), 0xDB: (struct.Struct(">I"), str),
+    0xDC: (struct.Struct(">H"), list), 0xDD: (struct.Struct(">I"), list),
+    0xDE: (struct.Struct(">H"), dict), 0xDF: (struct.Struct(">I"), dict),
+}
+
+def unpack(data, offset=0):
+    """
+    Декодирует одно значение MessagePack.
+
+    :param data: Байты.
+    :param offset: Смещение начала значения.
+    :return: Кортеж (значение, смещение следующего значения).
+    """
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xE0:
+        return code - 0x100, offset
+    if code <= 0x8F:
+        kind, size = dict, code & 0x0F
+    elif code <= 0x9F:
+        kind, size = list, code & 0x0F
+    elif code <= 0xBF:
+        kind, size = str, code & 0x1F
+    elif code == 0xC0:
+        return None, offset
+    elif code in (0xC2, 0xC3):
+        return code == 0xC3, offset
+    elif code in _FIXED:
+        fmt = _FIXED[code]
+        return fmt.unpack_from(data, offset)[0], offset + fmt.size
+    elif code in _SIZED:
+        fmt, kind = _SIZED[code]
+        size = fmt.unpack_from(data, offset)[0]
+        offset += fmt.size
+    else:
+        raise ValueError(f"Unsupported MessagePack type 0x{code:02x}")
+
+    if kind is str or kind is bytes:
+        end = offset + size
+        if end > len(data):
+            raise IndexError("Truncated value")
+        chunk = data[offset:end]
+        return (chunk.decode("utf-8") if kind is str else bytes(chunk)), end
+    if kind is list:
+        items = []
+        for _ in range(size):
+            item, offset = unpack(data, offset)
+            items.append(item)
+        return items, offset
+    result = {}
+    for _ in range(size):
+        key, offset = unpack(data, offset)
+        result[key], offset = unpack(data, offset)
+    return result, offset
@@ -0,0 +1,326 @@
+"""
+Полнотекстовый поиск по архиву сообщений.
+
+Индекс хранится в отдельной базе SQLite (по умолчанию "search.db") в таблице FTS5:
+это инвертированный индекс с позициями слов, поэтому поддерживаются поиск по словам,
+фразам и префиксам, а результаты ранжируются по BM25. Текст и метаданные сообщений (чат,
+топик, отправитель, дата) лежат в обычной таблице с индексами и используются как фильтры;
+FTS5 хранит только сам индекс и берёт текст для фрагментов оттуда же.
+
+Индекс пополняется по мере записи сообщений (MessageSink с параметром index) или
+из уже сохранённых архивов JSONL, MessagePack и SQLite (index_archive). Модуль использует только
+стандартную библиотеку, поэтому поиск из cli.py не загружает Telethon.
+
+Синтаксис запроса:
+    привет мир       — сообщения, содержащие оба слова;
+    "добрый вечер"   — точная фраза;
+    сообщ*           — слова, начинающиеся с «сообщ»;
+    кот OR пёс       — любое из слов.
+Регистр и буква «ё» не учитываются.
+"""
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+from records import codec_for
+
+WORD_RE = re.compile(r"\w+")
+QUERY_RE = re.compile(r'"([^"]*)"?|(\S+)')
+
+def normalize_text(text):
+    """
+    Приводит текст к виду, в котором он попадает в индекс: «ё» заменяется на «е».
+    Регистр приводит сам токенизатор unicode61 (в том числе для кириллицы).
+    """
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+def build_match(query):
+    """
+    Переводит пользовательский запрос в выражение MATCH для FTS5.
+
+    Слова экранируются кавычками, поэтому символы запроса не могут сломать синтаксис FTS5.
+
+    :param query: Строка запроса (см. описание модуля).
+    :return: Выражение FTS5.
+    """
+    parts = []
+    for phrase, term in QUERY_RE.findall(normalize_text(query)):
+        if term == "OR":
+            if parts and parts[-1] != "OR":
+                parts.append("OR")
+            continue
+        prefix = term.endswith("*")
+        words = WORD_RE.findall(phrase if phrase else term)
+        if not words:
+            continue
+        parts.append(f'"{" ".join(words)}"' + ("*" if prefix else ""))
+    while parts and parts[-1] == "OR":
+        parts.pop()
+    if not parts:
+        raise ValueError(f"Empty search query: {query!r}")
+    return " ".join(parts)
+
+class SearchIndex:
+    """
+    Инкрементальный полнотекстовый индекс сообщений на SQLite FTS5.
+
+    Ключ документа — (chat_id, topic_id, message_id), повторное добавление сообщения
+    заменяет его текст в индексе, а отметка об удалении (запись с полем deleted) убирает его. Методы можно вызывать из пула потоков: соединение
+    защищено блокировкой.
+
+    По умолчанию ранжируются все совпадения. Подсчёт BM25 для всех совпадений частого слова занимает
+    сотни миллисекунд на миллионах сообщений; rank_window ограничивает ранжирование последними
+    добавленными совпадениями, и более старые в результаты не попадают.
+
+    :param path: Путь к файлу индекса.
+    :param rank_window: Сколько последних совпадений ранжировать (None — все).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL DEFAULT 0,
+            message_id INTEGER NOT NULL,
+            date TEXT,
+            sender_id INTEGER,
+            text TEXT,
+            UNIQUE (chat_id, topic_id, message_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_documents_date ON documents (chat_id, date);
+        CREATE INDEX IF NOT EXISTS idx_documents_sender ON documents (sender_id, date);
+        CREATE INDEX IF NOT EXISTS idx_documents_message ON documents (message_id, chat_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5 (
+            text,
+            content = 'documents',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 0',
+            prefix = '2 3 4'
+        );
+        CREATE TABLE IF NOT EXISTS sources (
+            path TEXT PRIMARY KEY,
+            inode INTEGER,
+            offset INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path="search.db", rank_window=None):
+        self.path = path
+        self.rank_window = rank_window
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self._connection.executescript(self.SCHEMA)
+        except sqlite3.OperationalError as e:
+            self._connection.close()
+            raise RuntimeError(f"SQLite build without FTS5 support: {e}")
+
+    def add(self, records, chat_id=None, topic_id=None):
+        """
+        Добавляет или обновляет сообщения в индексе.
+
+        Поддерживаются записи fetch_chat_history (id, без chat_id) и слушателя (chat_id, message_id, topic_id).
+        Правки заменяют текст сообщения, отметки об удалении убирают сообщение из индекса.
+
+        :param records: Итерируемый набор записей.
+        :param chat_id: ID чата для записей без поля chat_id.
+        :param topic_id: ID топика для записей без поля topic_id.
+        :return: Количество проиндексированных записей.
+        """
+        count = 0
+        with self._lock, self._connection:
+            for record in records:
+                self._add(record, chat_id, topic_id)
+                count += 1
+        return count
+
+    def _add(self, record, chat_id, topic_id):
+        message_id = record.get("message_id", record.get("id"))
+        if message_id is None:
+            return
+        key = (record.get("chat_id", chat_id) or 0, record.get("topic_id", topic_id) or 0, message_id)
+        if record.get("deleted") is not None:
+            self._remove(key[0], message_id)
+            return
+        text = record.get("text") or None
+        row = self._connection.execute(
+            "SELECT id, text FROM documents WHERE chat_id = ? AND topic_id = ? AND message_id = ?", key).fetchone()
+        if row is None:
+            document_id = self._connection.execute(
+                "INSERT INTO documents (chat_id, topic_id, message_id, date, sender_id, text) VALUES (?, ?, ?, ?, ?, ?)",
+                key + (record.get("date"), record.get("sender_id"), text)).lastrowid
+        else:
+            document_id, old_text = row
+            self._connection.execute("UPDATE documents SET date = ?, sender_id = ?, text = ? WHERE id = ?",
+                                     (record.get("date"), record.get("sender_id"), text, document_id))
+            if old_text == text:
+                return
+            if old_text:
+                # Из внешнего индекса FTS5 удаляется ровно то, что было в него добавлено
+                self._connection.execute("INSERT INTO documents_fts (documents_fts, rowid, text) VALUES ('delete', ?, ?)",
+                                         (document_id, normalize_text(old_text)))
+        if text:
+            # «ё» заменяется на «е» без изменения границ слов, поэтому фрагменты строятся по исходному тексту
+            self._connection.execute("INSERT INTO documents_fts (rowid, text) VALUES (?, ?)",
+                                     (document_id, normalize_text(text)))
+
+    def _remove(self, chat_id, message_id):
+        # Отметка об удалении может не знать топик сообщения, а ID сообщений уникальны в пределах чата
+        rows = self._connection.execute("SELECT id, text FROM documents WHERE message_id = ? AND chat_id = ?",
+                                        (message_id, chat_id)).fetchall()
+        for document_id, text in rows:
+            if text:
+                self._connection.execute("INSERT INTO documents_fts (documents_fts, rowid, text) VALUES ('delete', ?, ?)",
+                                         (document_id, normalize_text(text)))
+            self._connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def index_archive(self, path, chat_id=None, topic_id=None, batch_size=1000):
+        """
+        Индексирует сохранённый архив: JSONL, MessagePack (.msgpack) или базу SQLite (.db/.sqlite/.sqlite3).
+
+        JSONL и MessagePack индексируются с места, где остановился прошлый запуск (смещение хранится в индексе);
+        если файл заменён или укорочен, он индексируется заново. База SQLite просматривается целиком.
+        Для файлов выгрузки вида "<chat_id>.jsonl" и "<chat_id>_<topic_id>.jsonl" (и .msgpack) чат и топик
+        определяются по имени, если не заданы.
+
+        :param path: Путь к архиву.
+        :param chat_id: ID чата для записей без поля chat_id.
+        :param topic_id: ID топика для записей без поля topic_id.
+        :param batch_size: Количество записей в одной транзакции.
+        :return: Количество проиндексированных записей.
+        """
+        if path.lower().endswith((".db", ".sqlite", ".sqlite3")):
+            return self._index_sqlite(path, batch_size)
+
+        if chat_id is None:
+            match = re.fullmatch(r"(-?\d+)(?:_(\d+))?", os.path.basename(path).split(".")[0])
+            if match:
+                chat_id = int(match.group(1))
+                topic_id = int(match.group(2)) if match.group(2) else topic_id
+
+        source = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._connection.execute("SELECT inode, offset FROM sources WHERE path = ?", (source,)).fetchone()
+        offset = row[1] if row and row[0] == stat.st_ino and row[1] <= stat.st_size else 0
+
+        count = 0
+        batch = []
+        # Незавершённая последняя запись ещё дописывается, её возьмёт следующий запуск
+        for record, offset in codec_for(path).scan(path, offset):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                count += self._add_with_offset(batch, chat_id, topic_id, source, stat.st_ino, offset)
+                batch = []
+        count += self._add_with_offset(batch, chat_id, topic_id, source, stat.st_ino, offset)
+        return count
+
+    def _add_with_offset(self, batch, chat_id, topic_id, source, inode, offset):
+        # Записи и смещение фиксируются одной транзакцией, поэтому прерванный запуск не теряет и не дублирует строки
+        with self._lock, self._connection:
+            for record in batch:
+                self._add(record, chat_id, topic_id)
+            self._connection.execute("INSERT OR REPLACE INTO sources (path, inode, offset) VALUES (?, ?, ?)",
+                                     (source, inode, offset))
+        return len(batch)
+
+    def _index_sqlite(self, path, batch_size):
+        count = 0
+        archive = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        archive.row_factory = sqlite3.Row
+        try:
+            if archive.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'").fetchone() is None:
+                raise ValueError(f"{path} is not a message archive")
+            # Удалённые сообщения помечены в архиве столбцом deleted (в старых базах его нет)
+            columns = {row[1] for row in archive.execute("PRAGMA table_info(messages)")}
+            deleted = ", deleted" if "deleted" in columns else ""
+            cursor = archive.execute(f"SELECT chat_id, topic_id, message_id, date, sender_id, text{deleted} FROM messages")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                count += self.add(dict(row) for row in rows)
+        finally:
+            archive.close()
+        return count
+
+    def search(self, query, chat_id=None, topic_id=None, sender_id=None, since=None, until=None, limit=20,
+               highlight=("[", "]"), rank_window=None):
+        """
+        Ищет сообщения по запросу с фильтрами.
+
+        :param query: Строка запроса (см. описание модуля).
+        :param chat_id: ID чата (или None — любой).
+        :param topic_id: ID топика (или None — любой).
+        :param sender_id: ID отправителя (или None — любой).
+        :param since: Начало периода (datetime или ISO-строка).
+        :param until: Конец периода (datetime или ISO-строка).
+        :param limit: Максимальное количество результатов.
+        :param highlight: Строки, которыми в snippet выделяются найденные слова.
+        :param rank_window: Сколько последних совпадений ранжировать (None — rank_window индекса).
+        :return: Список словарей, от наиболее релевантных; равные по релевантности — от новых к старым.
+        """
+        rank_window = rank_window or self.rank_window
+        conditions, params = ["documents_fts MATCH ?"], [build_match(query)]
+        for column, value in (("chat_id", chat_id), ("topic_id", topic_id), ("sender_id", sender_id)):
+            if value is not None:
+                conditions.append(f"d.{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("d.date >= ?")
+            params.append(since.isoformat() if isinstance(since, datetime) else since)
+        if until is not None:
+            conditions.append("d.date < ?")
+            params.append(until.isoformat() if isinstance(until, datetime) else until)
+
+        source = "FROM documents_fts CROSS JOIN documents AS d ON d.id = documents_fts.rowid"
+        with self._lock:
+            if rank_window:
+                # Границу окна находит обход совпадений от новых к старым без подсчёта BM25
+                row = self._connection.execute(
+                    f"SELECT documents_fts.rowid {source} WHERE {' AND '.join(conditions)} "
+                    f"ORDER BY documents_fts.rowid DESC LIMIT 1 OFFSET ?", params + [rank_window - 1]).fetchone()
+                if row is not None:
+                    conditions.append("documents_fts.rowid >= ?")
+                    params.append(row[0])
+            rows = self._connection.execute(f"""
+                SELECT d.chat_id, d.topic_id, d.message_id, d.date, d.sender_id, d.text,
+                       snippet(documents_fts, 0, ?, ?, '…', 16) AS snippet, bm25(documents_fts) AS rank
+                {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY rank, d.date DESC
+                LIMIT ?
+            """, [highlight[0], highlight[1]] + params + [limit]).fetchall()
+        return [{
+            "chat_id": chat_id,
+            "topic_id": topic_id or None,
+            "message_id": message_id,
+            "date": date,
+            "sender_id": sender_id,
+            "text": text,
+            "snippet": snippet,
+            "score": round(-rank, 3),
+        } for chat_id, topic_id, message_id, date, sender_id, text, snippet, rank in rows]
+
+    def stats(self):
+        """
+        Возвращает размер индекса.
+        """
+        with self._lock:
+            documents = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            sources = self._connection.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+        return {"documents": documents, "sources": sources, "bytes": os.path.getsize(self.path)}
+
+    def optimize(self):
+        """
+        Сливает сегменты FTS5 в один: ускоряет поиск после больших пополнений индекса.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("INSERT INTO documents_fts (documents_fts) VALUES ('optimize')")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
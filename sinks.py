@@ -0,0 +1,495 @@
+"""
+Хранилища сообщений с пакетной записью: JSONL, MessagePack и SQLite.
+
+Записи копятся в буфере MessageSink и сбрасываются пачками фоновой задачей, блокирующий
+ввод-вывод выполняется в пуле потоков. open_sink выбирает хранилище по расширению файла,
+query_messages читает базу SQLite без загрузки всего архива. Здесь же — атомарная запись
+и чтение JSON-файлов состояния (контрольные точки, снимки, кэш).
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+from metrics import metrics
+from records import CHANNEL_ID_OFFSET, BinaryCodec, JsonCodec
+
+logger = logging.getLogger("example")  # Журнал приложения, настраивается в main.configure_logging
+
+class MessageSink:
+    """
+    Базовый класс хранилища сообщений с пакетной записью.
+
+    Записи копятся в буфере и сбрасываются пачками фоновой задачей:
+    по достижении batch_size или раз в flush_interval секунд. Каждая запись
+    стоит O(пачки), память ограничена размером буфера. Наследники реализуют
+    _write_batch() (выполняется в пуле потоков) и _close_storage().
+    Записанные пачки можно сразу добавлять в полнотекстовый индекс (см. search.SearchIndex).
+
+    :param path: Путь к файлу хранилища.
+    :param batch_size: Количество записей, после которого буфер сбрасывается сразу.
+    :param flush_interval: Максимальное время (сек) между сбросами буфера.
+    :param chat_id: ID чата для записей без поля chat_id.
+    :param topic_id: ID топика для записей без поля topic_id.
+    :param index: SearchIndex, в который добавляются записанные сообщения (None — без индексации).
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0, chat_id=None, topic_id=None, index=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.chat_id = chat_id
+        self.topic_id = topic_id
+        self.index = index
+        self.written = 0  # Количество записей, сброшенных в хранилище
+
+        self._buffer = []
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def start(self):
+        """
+        Запускает фоновую задачу сброса буфера.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+        return self
+
+    def write(self, record):
+        """
+        Добавляет запись в буфер. Сама запись в хранилище выполняется фоновой задачей.
+
+        :param record: MessageRecord или сериализуемый в JSON словарь.
+        """
+        if self._closed:
+            raise RuntimeError(f"Sink {self.path} is closed")
+        self._buffer.append(record)
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def write_many(self, records):
+        """
+        Добавляет в буфер несколько записей.
+
+        :param records: Итерируемый набор записей.
+        """
+        for record in records:
+            self.write(record)
+
+    async def flush(self):
+        """
+        Сбрасывает текущий буфер в хранилище. Блокирующий ввод-вывод выполняется в пуле потоков,
+        чтобы не останавливать цикл событий.
+        """
+        async with self._lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, []
+            loop = asyncio.get_running_loop()
+            size = await loop.run_in_executor(None, self._write_batch, batch)
+            self.written += len(batch)
+            sink = type(self).__name__
+            metrics.inc("sink_records_written_total", len(batch), sink=sink)
+            if size:
+                metrics.inc("sink_bytes_written_total", size, sink=sink)
+            if self.index is not None:
+                # Ошибка индексации не должна терять уже записанные сообщения
+                try:
+                    await loop.run_in_executor(None, self.index.add, batch, self.chat_id, self.topic_id)
+                    metrics.inc("search_indexed_total", len(batch))
+                except Exception as e:
+                    logger.error(f"Failed to index records from {self.path}: {e}")
+
+    async def locate(self, message_id, chat_id=None):
+        """
+        Ищет ранее записанное сообщение в хранилище (для правок и удалений, которых нет в индексе слушателя).
+
+        Файлы JSONL и MessagePack только дописываются и не индексированы: поиск потребовал бы
+        чтения всего файла, поэтому базовая реализация ничего не находит.
+
+        :param message_id: ID сообщения.
+        :param chat_id: ID чата (None — среди личных чатов и обычных групп, где ID сообщений сквозные).
+        :return: Кортеж (chat_id, topic_id) или None, если сообщение не найдено.
+        """
+        return None
+
+    async def close(self):
+        """
+        Останавливает фоновую задачу и сбрасывает оставшиеся записи.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is not None:
+            # Фоновая задача завершается сама, увидев флаг _closed. Отмена через cancel() ненадёжна:
+            # wait_for() теряет её, если событие _wakeup уже установлено.
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        finally:
+            self._close_storage()
+        logger.info(f"Sink {self.path} closed. Records written: {self.written}")
+
+    async def __aenter__(self):
+        return self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _flush_loop(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._closed:
+                break
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush records to {self.path}: {e}")
+
+    def _write_batch(self, batch):
+        """
+        Записывает пачку в хранилище.
+
+        :return: Количество записанных байт (None, если неизвестно).
+        """
+        raise NotImplementedError
+
+    def _close_storage(self):
+        pass
+
+class JsonlSink(MessageSink):
+    """
+    Потоковая запись записей в JSONL-файл (компактный JSON, см. records.JsonCodec).
+
+    Файл только дописывается: правка сообщения записывается новой версией с полем edited,
+    удаление — отметкой с полем deleted. Последние версии сообщений собирает records.merge_records.
+
+    :param path: Путь к файлу (например, "monitored_messages.jsonl").
+    :param batch_size: Количество записей, после которого буфер сбрасывается сразу.
+    :param flush_interval: Максимальное время (сек) между сбросами буфера.
+    :param fsync: Политика fsync: "batch" (после каждого сброса), "rotate" (только при ротации и закрытии), "never".
+    :param max_bytes: Ротация файла по размеру (None — без ротации).
+    :param rotate_daily: Ротация файла при смене суток.
+    :param kwargs: Параметры MessageSink (chat_id, topic_id, index).
+    """
+
+    FSYNC_POLICIES = ("batch", "rotate", "never")
+    codec = JsonCodec()
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0, fsync="batch", max_bytes=None, rotate_daily=False,
+                 **kwargs):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        super().__init__(path, batch_size=batch_size, flush_interval=flush_interval, **kwargs)
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+
+        self._file = None
+        self._day = None
+
+    def _write_batch(self, batch):
+        # Сериализуем всю пачку заранее, чтобы записать её одним вызовом write
+        data = self.codec.encode(batch)
+        self._maybe_rotate(len(data))
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        if self._file.tell() == 0:
+            # Новый файл (в том числе после ротации) начинается с заголовка формата, если он есть
+            data = self.codec.header() + data
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync == "batch":
+            os.fsync(self._file.fileno())
+        return len(data)
+
+    def _close_storage(self):
+        self._close_file(sync=self.fsync != "never")
+
+    def _maybe_rotate(self, incoming):
+        today = datetime.now().date()
+        if self._day is None:
+            self._day = today
+        rotate = False
+        if self.rotate_daily and today != self._day:
+            rotate = True
+        elif self.max_bytes and os.path.exists(self.path):
+            size = self._file.tell() if self._file is not None else os.path.getsize(self.path)
+            rotate = size > 0 and size + incoming > self.max_bytes
+        if not rotate:
+            return
+
+        self._close_file(sync=self.fsync != "never")
+        if os.path.exists(self.path):
+            base, ext = os.path.splitext(self.path)
+            suffix = self._day.isoformat() if self.rotate_daily and today != self._day else datetime.now().strftime("%Y%m%d-%H%M%S")
+            rotated = f"{base}.{suffix}{ext}"
+            counter = 1
+            while os.path.exists(rotated):
+                rotated = f"{base}.{suffix}.{counter}{ext}"
+                counter += 1
+            os.replace(self.path, rotated)
+            logger.info(f"Rotated {self.path} to {rotated}")
+        self._day = today
+
+    def _close_file(self, sync=False):
+        if self._file is None:
+            return
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+class BinarySink(JsonlSink):
+    """
+    Потоковая запись записей в файл MessagePack (см. records.BinaryCodec).
+
+    Дата хранится целым числом, имена полей записаны один раз в заголовке файла, поэтому файл
+    на четверть меньше JSONL на обычных сообщениях и в разы меньше на коротких. Ротация, fsync и индексация —
+    как у JsonlSink.
+    """
+
+    codec = BinaryCodec()
+
+class SqliteSink(MessageSink):
+    """
+    Хранилище сообщений в базе SQLite.
+
+    База работает в режиме WAL, пачки вставляются одним executemany в транзакции.
+    Ключ таблицы — (chat_id, topic_id, message_id), поэтому повторная загрузка тех же
+    сообщений обновляет строки, а не создаёт дубликаты. Индексы по date и sender_id
+    позволяют выбирать сообщения без чтения всего архива (см. query_messages).
+
+    Правка (запись с полем edited) заменяет текст строки; более старая версия, пришедшая позже
+    (например, при догрузке), текст не откатывает. Отметка об удалении (запись с полем deleted)
+    не вставляет строку, а проставляет столбец deleted у существующей. Индекс по message_id
+    позволяет найти сообщение по ID из события удаления (см. locate).
+
+    :param path: Путь к файлу базы (например, "messages.db").
+    :param chat_id: ID чата для записей без поля chat_id (например, из fetch_chat_history).
+    :param topic_id: ID топика для записей без поля topic_id.
+    :param batch_size: Количество записей, после которого буфер сбрасывается сразу.
+    :param flush_interval: Максимальное время (сек) между сбросами буфера.
+    :param index: SearchIndex для записанных сообщений (None — без индексации).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            topic_id INTEGER NOT NULL DEFAULT 0,
+            message_id INTEGER NOT NULL,
+            date TEXT,
+            sender_id INTEGER,
+            text TEXT,
+            reply_to INTEGER,
+            chat_name TEXT,
+            media TEXT,
+            edited TEXT,
+            deleted TEXT,
+            PRIMARY KEY (chat_id, topic_id, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (chat_id, date);
+        CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, date);
+        CREATE INDEX IF NOT EXISTS idx_messages_message ON messages (message_id, chat_id);
+    """
+
+    UPSERT = """
+        INSERT INTO messages (chat_id, topic_id, message_id, date, sender_id, text, reply_to, chat_name, media, edited)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (chat_id, topic_id, message_id) DO UPDATE SET
+            date = excluded.date,
+            sender_id = excluded.sender_id,
+            text = CASE WHEN messages.edited > COALESCE(excluded.edited, '') THEN messages.text ELSE excluded.text END,
+            reply_to = excluded.reply_to,
+            chat_name = COALESCE(excluded.chat_name, messages.chat_name),
+            media = COALESCE(excluded.media, messages.media),
+            edited = CASE WHEN messages.edited > COALESCE(excluded.edited, '') THEN messages.edited ELSE excluded.edited END
+    """
+
+    TOMBSTONE = "UPDATE messages SET deleted = ? WHERE message_id = ? AND chat_id = ?"
+
+    def __init__(self, path, chat_id=None, topic_id=None, batch_size=500, flush_interval=1.0, index=None):
+        super().__init__(path, batch_size=batch_size, flush_interval=flush_interval, chat_id=chat_id, topic_id=topic_id,
+                         index=index)
+        self._connection = None
+        self._reader = None
+
+    @staticmethod
+    def connect(path):
+        """
+        Открывает базу, включает WAL и создаёт схему при необходимости.
+
+        :param path: Путь к файлу базы.
+        :return: sqlite3.Connection.
+        """
+        # Соединение используется из потоков пула, но всегда по одному за раз (под блокировкой MessageSink)
+        connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SqliteSink.SCHEMA)
+        # Базы, созданные до появления вложений и правок, получают недостающие столбцы
+        columns = {row[1] for row in connection.execute("PRAGMA table_info(messages)")}
+        for column in ("media", "edited", "deleted"):
+            if column not in columns:
+                connection.execute(f"ALTER TABLE messages ADD COLUMN {column} TEXT")
+        return connection
+
+    async def locate(self, message_id, chat_id=None):
+        # Поиск по индексу занимает микросекунды, поэтому выполняется прямо в цикле событий через отдельное
+        # соединение для чтения: в режиме WAL оно не ждёт идущего в пуле потоков сброса пачки
+        if self._reader is None:
+            if not os.path.exists(self.path):
+                return None
+            self._reader = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+        if chat_id is None:
+            # ID сообщений в личных чатах и обычных группах сквозные для аккаунта, каналы исключаем
+            row = self._reader.execute(
+                "SELECT chat_id, topic_id FROM messages WHERE message_id = ? AND chat_id > ? LIMIT 1",
+                (message_id, CHANNEL_ID_OFFSET)).fetchone()
+        else:
+            row = self._reader.execute(
+                "SELECT chat_id, topic_id FROM messages WHERE message_id = ? AND chat_id = ? LIMIT 1",
+                (message_id, chat_id)).fetchone()
+        return (row[0], row[1] or None) if row else None
+
+    def _write_batch(self, batch):
+        if self._connection is None:
+            self._connection = self.connect(self.path)
+        rows, tombstones = [], []
+        for record in batch:
+            chat_id = record.get("chat_id", self.chat_id)
+            message_id = record.get("message_id", record.get("id"))
+            if record.get("deleted") is not None:
+                # ID сообщения уникален в пределах чата, топик для отметки не нужен
+                tombstones.append((record["deleted"], message_id, chat_id))
+                continue
+            rows.append((
+                chat_id,
+                record.get("topic_id", self.topic_id) or 0,
+                message_id,
+                record.get("date"),
+                record.get("sender_id"),
+                record.get("text"),
+                record.get("reply_to"),
+                record.get("chat_name"),
+                json.dumps(record["media"], ensure_ascii=False) if record.get("media") else None,
+                record.get("edited"),
+            ))
+        with self._connection:
+            self._connection.executemany(self.UPSERT, rows)
+            if tombstones:
+                self._connection.executemany(self.TOMBSTONE, tombstones)
+
+    def _close_storage(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3")
+
+def open_sink(path, chat_id=None, topic_id=None, **kwargs):
+    """
+    Создаёт хранилище сообщений по расширению файла: SQLite для .db/.sqlite/.sqlite3,
+    MessagePack для .msgpack, иначе JSONL.
+
+    :param path: Путь к файлу хранилища.
+    :param chat_id: ID чата для записей без поля chat_id.
+    :param topic_id: ID топика для записей без поля topic_id.
+    :param kwargs: Параметры конкретного хранилища (batch_size, flush_interval, fsync, index, ...).
+    :return: Экземпляр MessageSink.
+    """
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        kwargs = {key: value for key, value in kwargs.items() if key in ("batch_size", "flush_interval", "index")}
+        return SqliteSink(path, chat_id=chat_id, topic_id=topic_id, **kwargs)
+    if path.lower().endswith(BinaryCodec.extension):
+        return BinarySink(path, chat_id=chat_id, topic_id=topic_id, **kwargs)
+    return JsonlSink(path, chat_id=chat_id, topic_id=topic_id, **kwargs)
+
+def query_messages(path, chat_id=None, topic_id=None, sender_id=None, since=None, until=None, limit=100,
+                   include_deleted=False):
+    """
+    Выбирает сообщения из базы SQLite по индексированным полям.
+
+    :param path: Путь к файлу базы.
+    :param chat_id: ID чата (или None — любой).
+    :param topic_id: ID топика (или None — любой).
+    :param sender_id: ID отправителя (или None — любой).
+    :param since: Начало периода (datetime или ISO-строка).
+    :param until: Конец периода (datetime или ISO-строка).
+    :param limit: Максимальное количество сообщений.
+    :param include_deleted: Включать сообщения, удалённые в Telegram (со столбцом deleted).
+    :return: Список словарей, от новых к старым.
+    :raises FileNotFoundError: Если файла базы нет.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Message database not found: {path}")
+    conditions, params = [], []
+    for column, value in (("chat_id", chat_id), ("topic_id", topic_id), ("sender_id", sender_id)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if since is not None:
+        conditions.append("date >= ?")
+        params.append(since.isoformat() if isinstance(since, datetime) else since)
+    if until is not None:
+        conditions.append("date < ?")
+        params.append(until.isoformat() if isinstance(until, datetime) else until)
+
+    # Только чтение: запрос не создаёт файл и не мигрирует схему базы, которую пишет монитор.
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    connection.row_factory = sqlite3.Row
+    try:
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(messages)")}
+        if not include_deleted and "deleted" in columns:
+            conditions.append("deleted IS NULL")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = connection.execute(f"SELECT * FROM messages {where} ORDER BY date DESC LIMIT ?", params + [limit])
+        return [dict(row, media=json.loads(row["media"]) if "media" in columns and row["media"] else None)
+                for row in rows]
+    finally:
+        connection.close()
+
+def write_json_atomic(path, data):
+    """
+    Атомарно записывает JSON-файл: сначала во временный файл, затем заменяет целевой.
+
+    :param path: Путь к файлу.
+    :param data: Сериализуемые данные.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_json_file(path, default=None):
+    """
+    Загружает JSON-файл, если он существует.
+
+    :param path: Путь к файлу.
+    :param default: Значение, возвращаемое при отсутствии или повреждении файла.
+    :return: Загруженные данные или default.
+    """
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Failed to read {path}: {e}")
+        return default
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+import benchmark
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_benchmark_imports_without_resource_module():
+    # Так выглядит импорт на Windows, где модуля resource нет
+    code = "import sys; sys.modules['resource'] = None; import benchmark; print(benchmark.peak_rss_mb())"
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "None"
+
+def test_peak_rss_is_reported_where_available():
+    assert benchmark.peak_rss_mb() > 0
+
+def test_results_table_without_peak_rss(monkeypatch):
+    printed = []
+    monkeypatch.setattr(benchmark.main.console, "print", printed.append)
+    benchmark.print_results([{"name": "records", "operations": 10, "seconds": 0.1, "throughput": 100.0,
+                              "api_calls": 0, "floods": 0, "peak_rss_mb": None}])
+
+    assert list(printed[0].columns[9].cells) == ["-"]
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import main
+from cache import EntityCache
+from ratelimit import RateLimiter
+
+def chat_info(chat_id, can_send=None, broadcast=False):
+    return {"id": chat_id, "title": f"Chat {chat_id}", "username": None, "forum": False, "broadcast": broadcast,
+            "megagroup": not broadcast, "creator": False, "admin": False, "can_send": can_send}
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+def test_get_counts_hits_and_misses():
+    cache = EntityCache(None)
+    cache.put(-1001, chat_info(-1001))
+
+    assert cache.get(-1001)["title"] == "Chat -1001"
+    assert cache.get(-1002) is None
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+def test_put_stores_username_and_normalized_id():
+    cache = EntityCache(None)
+    cache.put("@Some_Chat", chat_info(-1001))
+
+    assert cache.get("some_chat")["id"] == -1001
+    assert cache.get("-1001")["id"] == -1001
+
+def test_entries_expire_after_ttl(clock):
+    cache = EntityCache(None, ttl=60)
+    cache.put(-1001, chat_info(-1001))
+
+    clock[0] += 59
+    assert -1001 in cache
+    clock[0] += 2
+    assert -1001 not in cache
+    assert cache.get(-1001) is None
+    assert cache.stats()["size"] == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache = EntityCache(None, max_size=2)
+    cache.put(-1001, chat_info(-1001))
+    cache.put(-1002, chat_info(-1002))
+    cache.get(-1001)
+    cache.put(-1003, chat_info(-1003))
+
+    assert -1001 in cache
+    assert -1002 not in cache
+    assert -1003 in cache
+
+def test_invalidate_removes_all_keys_of_chat():
+    cache = EntityCache(None)
+    cache.put("channel", chat_info(-1001))
+    cache.invalidate("channel")
+
+    assert "channel" not in cache
+    assert -1001 not in cache
+
+def test_cache_survives_restart_without_expired_entries(tmp_path, clock):
+    path = str(tmp_path / "entity_cache.json")
+    cache = EntityCache(path, ttl=60)
+    cache.put(-1001, chat_info(-1001))
+    clock[0] += 30
+    cache.put(-1002, chat_info(-1002))
+    cache.save()
+
+    clock[0] += 40
+    restored = EntityCache(path, ttl=60)
+    assert restored.get(-1001) is None
+    assert restored.get(-1002)["title"] == "Chat -1002"
+
+def test_resolve_calls_get_entity_once():
+    class Client:
+        rate_limiter = RateLimiter(rates={"entity": 1000.0})
+        calls = 0
+
+        async def get_entity(self, chat):
+            self.calls += 1
+            return SimpleNamespace(id=1001, title="Forum", username="forum", forum=True, megagroup=True)
+
+    cache = EntityCache(None)
+    client = Client()
+
+    async def run():
+        return [await cache.resolve(client, "@forum") for _ in range(3)]
+
+    infos = asyncio.run(run())
+    assert client.calls == 1
+    assert infos[0]["id"] == -1000000001001
+    assert infos[0]["forum"] is True
+    assert cache.get(-1000000001001) is infos[0]
+
+def test_send_rights_from_banned_rights():
+    assert EntityCache.send_rights(SimpleNamespace(left=True)) is False
+    assert EntityCache.send_rights(SimpleNamespace(broadcast=True)) is None
+    assert EntityCache.send_rights(SimpleNamespace(broadcast=True, creator=True)) is True
+    assert EntityCache.send_rights(SimpleNamespace(megagroup=True)) is None
+    banned = SimpleNamespace(megagroup=True, default_banned_rights=SimpleNamespace(send_messages=True))
+    assert EntityCache.send_rights(banned) is False
+    allowed = SimpleNamespace(megagroup=True, default_banned_rights=SimpleNamespace(send_messages=False))
+    assert EntityCache.send_rights(allowed) is True
+
+class SendClient:
+    def __init__(self, forbidden=False):
+        self.forbidden = forbidden
+        self.sent = []
+        self.rate_limiter = RateLimiter(rates={"entity": 1000.0, "send": 1000.0})
+
+    async def get_entity(self, chat):
+        return SimpleNamespace(id=1001, title="Channel", username=None, broadcast=True)
+
+    async def send_message(self, entity, text):
+        if self.forbidden:
+            raise errors.ChatWriteForbiddenError(request=None)
+        self.sent.append((entity, text))
+
+def test_send_message_safe_caches_channel_right_only_after_send(monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+    client = SendClient()
+
+    assert asyncio.run(main.send_message_safe(client, -1000000001001, "hello")) is True
+    assert [text for _, text in client.sent] == ["hello"]
+    assert main.entity_cache.get(-1000000001001)["can_send"] is True
+
+def test_send_message_safe_remembers_forbidden_channel(monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+    client = SendClient(forbidden=True)
+
+    assert asyncio.run(main.send_message_safe(client, -1000000001001, "hello")) is False
+    assert main.entity_cache.get(-1000000001001)["can_send"] is False
+
+    # Повторная отправка не обращается к Telegram
+    client.forbidden = False
+    assert asyncio.run(main.send_message_safe(client, -1000000001001, "hello")) is False
+    assert client.sent == []
@@ -0,0 +1,122 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from ratelimit import RateLimiter
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def topic(number):
+    return SimpleNamespace(id=number, title=f"Topic {number}", top_message=1000 + number)
+
+class ForumClient:
+    """
+    Клиент с диалогами-форумами: GetForumTopicsRequest отдаёт темы страницами, начиная после offset_topic.
+    """
+
+    def __init__(self, forums, fail_at=None):
+        self.forums = forums  # ID чата -> список ID тем
+        self.fail_at = fail_at
+        self.top_messages = {chat_id: 1 for chat_id in forums}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.rate_limiter = RateLimiter(rates={"dialogs": 1000.0, "topics": 1000.0})
+
+    async def iter_dialogs(self):
+        for chat_id in self.forums:
+            yield SimpleNamespace(name=f"Forum {chat_id}", id=chat_id, entity=SimpleNamespace(forum=True),
+                                  message=SimpleNamespace(id=self.top_messages[chat_id]), date=START)
+        yield SimpleNamespace(name="Group", id=-1, entity=SimpleNamespace(), message=None, date=None)
+
+    async def __call__(self, request):
+        self.requests.append((request.channel, request.offset_topic))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.01)
+            ids = self.forums[request.channel]
+            start = ids.index(request.offset_topic) + 1 if request.offset_topic else 0
+            if self.fail_at is not None and start >= self.fail_at:
+                raise ConnectionError("connection lost")
+            page = [topic(number) for number in ids[start:start + request.limit]]
+            messages = [SimpleNamespace(id=item.top_message, date=START + timedelta(minutes=item.id)) for item in page]
+            return SimpleNamespace(topics=page, messages=messages, count=len(ids))
+        finally:
+            self.active -= 1
+
+def test_load_forum_topics_follows_pages():
+    client = ForumClient({-1001: list(range(250, 0, -1))})
+
+    topics, complete = asyncio.run(main.load_forum_topics(client, -1001))
+
+    assert complete
+    assert [item["id"] for item in topics] == list(range(250, 0, -1))
+    assert client.requests == [(-1001, 0), (-1001, 151), (-1001, 51)]
+
+def test_load_forum_topics_keeps_topics_received_before_error():
+    client = ForumClient({-1001: list(range(250, 0, -1))}, fail_at=200)
+
+    topics, complete = asyncio.run(main.load_forum_topics(client, -1001))
+
+    assert not complete
+    assert len(topics) == 200
+
+@pytest.fixture
+def quiet_console():
+    main.console.quiet = True
+    yield
+    main.console.quiet = False
+
+def test_save_all_chats_fetches_topics_concurrently_and_reuses_snapshot(tmp_path, quiet_console):
+    output = str(tmp_path / "chats.json")
+    client = ForumClient({-1000 - number: [2, 1] for number in range(6)})
+
+    assert asyncio.run(main.save_all_chats(client, output, concurrency=3)) is None
+    assert client.max_active == 3
+    with open(output, encoding="utf-8") as f:
+        chats = {chat["id"]: chat for chat in json.load(f)}
+    assert [item["id"] for item in chats[-1000]["topics"]] == [2, 1]
+    assert chats[-1000]["topics_complete"]
+    assert "topics" not in chats[-1]
+
+    # Повторный запуск: темы запрашиваются только у форума с новым сообщением
+    client.requests.clear()
+    client.top_messages[-1003] = 2
+    client.forums[-1003] = [3, 2, 1]
+    diff = asyncio.run(main.save_all_chats(client, output, concurrency=3))
+
+    assert client.requests == [(-1003, 0)]
+    assert diff["topics"] == {"-1003": {"added": [{"id": 3, "title": "Topic 3"}], "removed": [], "renamed": []}}
+
+def test_diff_chat_snapshots_reports_chat_and_topic_changes():
+    old = [
+        {"id": 1, "name": "Old name"},
+        {"id": 2, "name": "Removed"},
+        {"id": 3, "name": "Forum", "topics": [{"id": 1, "title": "General"}, {"id": 2, "title": "Gone"}]},
+        {"id": 4, "name": "Cached forum", "topics": [{"id": 1, "title": "General"}]},
+    ]
+    new = [
+        {"id": 1, "name": "New name"},
+        {"id": 3, "name": "Forum", "topics": [{"id": 1, "title": "News"}, {"id": 3, "title": "Added"}]},
+        {"id": 4, "name": "Cached forum", "topics": [{"id": 1, "title": "General"}]},
+        {"id": 5, "name": "Added", "topics": [{"id": 1, "title": "General"}]},
+    ]
+
+    diff = main.diff_chat_snapshots(old, new)
+
+    assert diff["added"] == [{"id": 5, "name": "Added"}]
+    assert diff["removed"] == [{"id": 2, "name": "Removed"}]
+    assert diff["renamed"] == [{"id": 1, "old": "Old name", "new": "New name"}]
+    # Темы сравниваются только у чатов, которые есть в обоих снимках, и только при изменениях
+    assert diff["topics"] == {"3": {"added": [{"id": 3, "title": "Added"}], "removed": [{"id": 2, "title": "Gone"}],
+                                    "renamed": [{"id": 1, "old": "General", "new": "News"}]}}
+
+def test_diff_chat_snapshots_of_equal_snapshots_is_empty():
+    chats = [{"id": 1, "name": "Chat", "topics": [{"id": 1, "title": "General"}]}]
+
+    assert main.diff_chat_snapshots(chats, chats) == {"added": [], "removed": [], "renamed": [], "topics": {}}
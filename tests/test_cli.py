@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import cli
+
+def write_jobs(tmp_path, data, name="jobs.json"):
+    path = tmp_path / name
+    path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+def test_parse_jobs_fills_defaults_and_normalizes_options(tmp_path):
+    path = write_jobs(tmp_path, {"continue_on_error": True, "jobs": [
+        {"command": "export", "chats": -1001, "output-dir": "out", "on_error": "abort"},
+        {"command": "index", "paths": "exports"},
+        {"command": "search", "query": "отчёт", "limit": 5},
+    ]})
+
+    jobs, continue_on_error = cli.parse_jobs(cli.build_parser(), path)
+
+    assert continue_on_error
+    export, index, search = jobs
+    assert (export.command, export.chats, export.output_dir, export.on_error) == ("export", [-1001], "out", "abort")
+    # Параметры, не указанные в задании, берутся из значений по умолчанию парсера
+    assert (export.concurrency, export.storage, export.chats_file) == (4, "jsonl", None)
+    assert (index.paths, index.index) == (["exports"], "search.db")
+    assert (search.query, search.limit, search.rank_window) == ("отчёт", 5, None)
+
+def test_parse_jobs_accepts_plain_list(tmp_path):
+    path = write_jobs(tmp_path, [{"command": "list-chats"}])
+
+    jobs, continue_on_error = cli.parse_jobs(cli.build_parser(), path)
+
+    assert not continue_on_error
+    assert (jobs[0].command, jobs[0].output) == ("list-chats", "all_chats.json")
+
+@pytest.mark.parametrize("jobs, error", [
+    ([{"command": "delete"}], "Job 1: unknown command 'delete'"),
+    ([{"command": "list-chats"}, {"command": "run", "job_file": "x.json"}], "Job 2: unknown command 'run'"),
+    ([{"command": "search", "query": "x", "colour": "red"}], "Job 1 'search': unknown options colour"),
+    ([{"command": "index"}], "Job 1 'index': missing paths"),
+    ({"jobs": {"command": "search"}}, "Job file must contain a list of jobs"),
+])
+def test_parse_jobs_rejects_invalid_jobs(tmp_path, jobs, error):
+    path = write_jobs(tmp_path, jobs)
+
+    with pytest.raises(ValueError, match=error):
+        cli.parse_jobs(cli.build_parser(), path)
+
+def test_run_reports_invalid_job_file(tmp_path, capsys):
+    path = write_jobs(tmp_path, [{"command": "delete"}])
+
+    assert cli.run(["run", path]) == 2
+    assert "Invalid job file" in capsys.readouterr().err
+
+def test_run_executes_offline_jobs_in_order(tmp_path, capsys):
+    archive = tmp_path / "-1001.jsonl"
+    archive.write_text(json.dumps({"id": 1, "date": "2024-01-01T00:00:00+00:00", "text": "Отчёт за неделю",
+                                   "sender_id": 7, "reply_to": None}, ensure_ascii=False) + "\n", encoding="utf-8")
+    index = str(tmp_path / "search.db")
+    path = write_jobs(tmp_path, [{"command": "index", "paths": str(archive), "index": index},
+                                 {"command": "search", "query": "отчет", "index": index, "json": True}])
+
+    assert cli.run(["run", path]) == 0
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert [(result["chat_id"], result["message_id"]) for result in results] == [(-1001, 1)]
+    assert cli.main is None
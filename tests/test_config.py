@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SETTINGS = ("API_ID", "API_HASH", "PHONE_NUMBER", "TELEGRAM_PASSWORD", "METRICS_PORT", "METRICS_LOG_INTERVAL",
+            "LOG_ASYNC", "LOG_MAX_BYTES", "LOG_BACKUP_COUNT", "LOG_RATE_LIMIT", "LOG_QUIET",
+            "SESSIONS", "SESSION_MAX_FLOOD_WAIT", "FLOOD_SLEEP_THRESHOLD")
+
+@pytest.fixture
+def config(monkeypatch):
+    for name in SETTINGS:
+        monkeypatch.delenv(name, raising=False)
+        monkeypatch.setattr(main, name, getattr(main, name))
+    # Файл .env не должен подмешиваться в проверки
+    monkeypatch.setattr(main, "load_dotenv", lambda: None)
+    return monkeypatch
+
+def test_import_does_not_need_credentials():
+    env = {name: value for name, value in os.environ.items() if name not in ("API_ID", "API_HASH")}
+    result = subprocess.run([sys.executable, "-c", "import main; print(main.API_ID)"], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "None"
+
+def test_load_config_requires_credentials(config):
+    config.setenv("API_HASH", "hash")
+    with pytest.raises(RuntimeError, match="API_ID"):
+        main.load_config()
+
+def test_load_config_reads_environment(config):
+    config.setenv("API_ID", "12345")
+    config.setenv("API_HASH", "hash")
+    config.setenv("SESSIONS", "main, archive ,")
+    config.setenv("LOG_QUIET", "1")
+    config.setenv("SESSION_MAX_FLOOD_WAIT", "12.5")
+    main.load_config()
+
+    assert (main.API_ID, main.API_HASH) == (12345, "hash")
+    assert main.SESSIONS == ["main", "archive"]
+    assert main.LOG_QUIET is True
+    assert main.LOG_RATE_LIMIT == 0
+    assert main.ClientPool({"main": SimpleNamespace()}).max_flood_wait == 12.5
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+
+from main import RecentMessageIndex, tombstone_record
+from records import MessageRecord, merge_records
+from search import SearchIndex
+from sinks import SqliteSink, query_messages
+
+CHANNEL = -1000000000005
+GROUP = -4005
+
+def test_recent_index_finds_edits_and_channel_deletions():
+    recent = RecentMessageIndex()
+    recent.add(CHANNEL, 10, location=(CHANNEL, 3))
+    recent.add(CHANNEL, 10, version=1704067260, location=(CHANNEL, 3))
+
+    assert recent.get(CHANNEL, 10) == ((CHANNEL, 10), 1704067260, (CHANNEL, 3))
+    assert recent.get(CHANNEL, 11) is None
+    # Удаление без ID чата ищется только среди личных чатов и обычных групп
+    assert recent.get(None, 10) is None
+    assert recent.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+def test_recent_index_resolves_deletions_without_chat_id():
+    recent = RecentMessageIndex()
+    recent.add(GROUP, 7, location=(GROUP, None))
+    recent.add(42, 8, location=None)
+
+    assert recent.get(None, 7) == ((GROUP, 7), 0, (GROUP, None))
+    assert recent.get(None, 8) == ((42, 8), 0, None)
+
+def test_recent_index_evicts_least_recently_used():
+    recent = RecentMessageIndex(max_size=2)
+    recent.add(GROUP, 1)
+    recent.add(GROUP, 2)
+    recent.get(GROUP, 1)
+    recent.add(GROUP, 3)
+
+    assert (GROUP, 1) in recent
+    assert (GROUP, 2) not in recent
+    assert recent.get(None, 2) is None
+    assert len(recent) == 2
+
+def test_tombstone_record():
+    record = tombstone_record(None, 15, deleted=1704067200)
+
+    assert (record.id, record.chat_id, record.deleted) == (15, None, 1704067200)
+    assert record["deleted"] == "2024-01-01T00:00:00+00:00"
+    assert record.received is not None
+
+def listener(message_id, text, edited=None, deleted=None, chat_id=CHANNEL):
+    return {"chat_id": chat_id, "chat_name": "Chat", "message_id": message_id, "date": "2024-01-01T00:00:00+00:00",
+            "text": text, "sender_id": 7, "forum_id": None, "topic_id": None, "edited": edited, "deleted": deleted}
+
+def test_merge_records_keeps_latest_version_and_applies_tombstones():
+    records = [
+        listener(1, "first"),
+        listener(2, "second"),
+        listener(1, "first, edited", edited="2024-01-01T00:05:00+00:00"),
+        listener(2, None, deleted="2024-01-01T00:10:00+00:00"),
+        listener(3, None, deleted="2024-01-01T00:10:00+00:00"),
+        listener(1, "other chat", chat_id=GROUP),
+    ]
+
+    merged = merge_records(records)
+    assert [(item["chat_id"], item["message_id"], item["text"]) for item in merged] == [
+        (CHANNEL, 1, "first, edited"), (GROUP, 1, "other chat")]
+
+    with_deleted = merge_records(records, include_deleted=True)
+    assert [(item["message_id"], item["text"], item["deleted"]) for item in with_deleted] == [
+        (1, "first, edited", None), (2, "second", "2024-01-01T00:10:00+00:00"), (1, "other chat", None)]
+
+def write_sqlite(path, records):
+    async def run():
+        sink = SqliteSink(path)
+        sink.write_many(records)
+        await sink.close()
+    asyncio.run(run())
+
+def test_sqlite_sink_applies_edits_in_version_order(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_sqlite(path, [MessageRecord(1, chat_id=CHANNEL, date=1704067200, text="original")])
+    write_sqlite(path, [MessageRecord(1, chat_id=CHANNEL, date=1704067200, text="edited", edited=1704067500)])
+    # Догрузка истории приносит более старую версию уже после правки
+    write_sqlite(path, [MessageRecord(1, chat_id=CHANNEL, date=1704067200, text="stale", edited=1704067300)])
+
+    [row] = query_messages(path)
+    assert (row["text"], row["edited"]) == ("edited", "2024-01-01T00:05:00+00:00")
+
+def test_sqlite_sink_marks_deleted_messages(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_sqlite(path, [MessageRecord(number, chat_id=CHANNEL, date=1704067200 + number, text=str(number))
+                        for number in (1, 2)])
+    write_sqlite(path, [tombstone_record(CHANNEL, 2, deleted=1704070000)])
+
+    assert [row["message_id"] for row in query_messages(path)] == [1]
+    deleted = query_messages(path, include_deleted=True)
+    assert [(row["message_id"], row["deleted"]) for row in deleted] == [
+        (2, "2024-01-01T00:46:40+00:00"), (1, None)]
+
+def test_sqlite_sink_locates_stored_messages(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_sqlite(path, [MessageRecord(5, chat_id=CHANNEL, topic_id=3, date=0),
+                        MessageRecord(6, chat_id=GROUP, date=0)])
+
+    async def run():
+        sink = SqliteSink(path)
+        try:
+            return (await sink.locate(5, CHANNEL), await sink.locate(6), await sink.locate(5),
+                    await sink.locate(7, CHANNEL))
+        finally:
+            await sink.close()
+
+    assert asyncio.run(run()) == ((CHANNEL, 3), (GROUP, None), None, None)
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.db"))
+    yield index
+    index.close()
+
+def test_search_index_follows_edits_and_deletions(index):
+    index.add([MessageRecord(1, chat_id=CHANNEL, topic_id=3, date=0, text="старый текст"),
+               MessageRecord(2, chat_id=CHANNEL, date=0, text="другой текст")])
+    index.add([MessageRecord(1, chat_id=CHANNEL, topic_id=3, date=0, text="новый текст", edited=60)])
+    # Отметка об удалении не знает топик сообщения
+    index.add([tombstone_record(CHANNEL, 2, deleted=120)])
+
+    assert index.search("старый") == []
+    assert [row["message_id"] for row in index.search("текст")] == [1]
+    assert index.stats()["documents"] == 1
@@ -0,0 +1,109 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import main
+from cache import EntityCache
+from main import ChatFilterIndex, is_monitored_chat, resolve_monitored_chats
+from ratelimit import RateLimiter
+from records import CHANNEL_ID_OFFSET
+
+def chat(number, username=None, title="Chat"):
+    # Супергруппа: нормализованный ID равен CHANNEL_ID_OFFSET - number
+    return SimpleNamespace(id=number, username=username, title=title, megagroup=True)
+
+@pytest.fixture
+def index():
+    return ChatFilterIndex([
+        {"id": CHANNEL_ID_OFFSET - 1},
+        {"id": str(CHANNEL_ID_OFFSET - 2), "topics": [5, 7]},
+        {"username": "@News"},
+        {"title": "Команда", "topics": [3]},
+        {"id": CHANNEL_ID_OFFSET - 4, "username": "team"},
+    ])
+
+def test_id_filter_without_topics_matches_every_topic(index):
+    assert index.match(chat(1), None)
+    assert index.match(chat(1), 42)
+    assert not index.match(chat(9), None)
+
+def test_id_filter_with_topics_matches_only_those_topics(index):
+    assert index.match(chat(2), 5)
+    assert index.match(chat(2), 7)
+    assert not index.match(chat(2), 6)
+    assert not index.match(chat(2), None)
+
+def test_username_filter_ignores_case_and_at_sign(index):
+    assert index.match(chat(10, username="news"), None)
+    assert index.match(chat(11, username="NEWS"), 8)
+    assert not index.match(chat(12, username="news2"), None)
+
+def test_title_filter_with_topics(index):
+    assert index.match(chat(13, title="Команда"), 3)
+    assert not index.match(chat(13, title="Команда"), 4)
+    assert not index.match(chat(13, title="команда"), 3)
+
+def test_compound_filter_requires_every_field(index):
+    assert index.match(chat(4, username="Team"), None)
+    assert not index.match(chat(4, username="other"), None)
+    assert not index.match(chat(5, username="team"), None)
+
+def test_wildcard_filter_wins_over_topic_list():
+    index = ChatFilterIndex([{"id": CHANNEL_ID_OFFSET - 1, "topics": [5]}, {"id": CHANNEL_ID_OFFSET - 1}])
+
+    assert index.match(chat(1), 6)
+
+def test_rebuild_replaces_filters(index):
+    version = index.version
+    index.rebuild([{"username": "other"}])
+
+    assert not index.match(chat(1), None)
+    assert index.match(chat(20, username="other"), None)
+    assert len(index) == 1
+    assert index.version == version + 1
+
+def test_is_monitored_chat_accepts_plain_list():
+    assert is_monitored_chat(chat(1), None, [{"id": CHANNEL_ID_OFFSET - 1}])
+    assert not is_monitored_chat(chat(1), None, [])
+
+class DialogsClient:
+    """
+    Клиент со списком диалогов; get_entity знает только публичные каналы из public.
+    """
+
+    def __init__(self, dialogs, public=()):
+        self.dialogs = dialogs
+        self.public = {entity.username.lower(): entity for entity in public}
+        self.requested = []
+        self.rate_limiter = RateLimiter(rates={"dialogs": 1000.0, "entity": 1000.0})
+
+    async def iter_dialogs(self):
+        for entity in self.dialogs:
+            yield SimpleNamespace(id=CHANNEL_ID_OFFSET - entity.id, name=entity.title, entity=entity)
+
+    async def get_entity(self, chat):
+        self.requested.append(chat)
+        if chat.lower() not in self.public:
+            raise errors.UsernameNotOccupiedError(request=None)
+        return self.public[chat.lower()]
+
+@pytest.fixture
+def fresh_entity_cache(monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+
+def test_resolve_monitored_chats_builds_whitelist(fresh_entity_cache):
+    client = DialogsClient([chat(1, username="News", title="Новости"), chat(2, title="Команда"), chat(3)],
+                           public=[chat(4, username="channel")])
+    filters = [{"id": CHANNEL_ID_OFFSET - 9}, {"username": "@news"}, {"title": "Команда", "topics": [3]},
+               {"username": "channel"}, {"username": "missing"}]
+
+    chat_ids = asyncio.run(resolve_monitored_chats(client, filters))
+
+    assert chat_ids == {CHANNEL_ID_OFFSET - number for number in (9, 1, 2, 4)}
+    # Username из диалогов не запрашиваются через get_entity
+    assert client.requested == ["channel", "missing"]
+
+def test_resolve_monitored_chats_without_fields_allows_any_chat(fresh_entity_cache):
+    assert asyncio.run(resolve_monitored_chats(DialogsClient([]), [{"id": CHANNEL_ID_OFFSET - 1}, {}])) is None
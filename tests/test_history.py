@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from cache import EntityCache
+from ratelimit import RateLimiter
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+class FakeHistory:
+    """
+    Курсор iter_messages: сообщения с ID меньше offset_id от новых к старым,
+    а при reverse — с ID больше min_id (и меньше max_id) от старых к новым.
+    """
+
+    def __init__(self, client, limit, offset_id=0, min_id=0, max_id=0, reverse=False):
+        self.client = client
+        self.limit = limit
+        self.fail_at = client.fail_at
+        ids = [number for number in sorted(client.ids, reverse=not reverse)
+               if number > min_id and (not max_id or number < max_id)
+               and (not offset_id or (number > offset_id if reverse else number < offset_id))]
+        self.pending = ids if limit is None else ids[:limit]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.pending:
+            raise StopAsyncIteration
+        if self.pending[0] == self.fail_at:
+            raise RuntimeError("connection lost")
+        number = self.pending.pop(0)
+        # Переключение задач, как при сетевом запросе: параллельные курсоры чередуются
+        await asyncio.sleep(0)
+        return SimpleNamespace(id=number, date=START + timedelta(minutes=number), sender_id=7, text=f"message {number}",
+                               message=f"message {number}", reply_to=None, edit_date=None, media=None)
+
+class FakeClient:
+    def __init__(self, count, fail_at=None):
+        self.ids = list(range(count, 0, -1))
+        self.fail_at = fail_at
+        self.rate_limiter = RateLimiter(rates={"history": 1000.0, "entity": 1000.0})
+
+    async def get_entity(self, chat):
+        return SimpleNamespace(id=1001, title="Chat", username=None, megagroup=True)
+
+    def iter_messages(self, entity, limit=None, offset_id=0, reply_to=None, min_id=0, max_id=0, reverse=False):
+        return FakeHistory(self, limit, offset_id, min_id, max_id, reverse)
+
+    async def get_messages(self, entity, limit=1, reply_to=None):
+        return [SimpleNamespace(id=number) for number in self.ids[:limit]]
+
+@pytest.fixture(autouse=True)
+def fresh_entity_cache(monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+
+def read_ids(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line)["id"] for line in f]
+
+def test_fetch_chat_history_writes_all_messages(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+
+    fetched = asyncio.run(main.fetch_chat_history(FakeClient(250), -1001001, output_file=output))
+
+    assert fetched == 250
+    assert read_ids(output) == list(range(250, 0, -1))
+    assert not os.path.exists(f"{output}.checkpoint")
+
+def test_fetch_chat_history_resumes_from_checkpoint_and_truncates_tail(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+
+    # Третья пачка (ID 50 и ниже) обрывается: контрольная точка остаётся после второй
+    assert asyncio.run(main.fetch_chat_history(FakeClient(250, fail_at=50), -1001001, output_file=output)) is None
+    with open(f"{output}.checkpoint", encoding="utf-8") as f:
+        checkpoint = json.load(f)
+    assert checkpoint["offset_id"] == 51
+    assert checkpoint["count"] == 200
+    # Незафиксированный хвост: строка, записанная после контрольной точки
+    with open(output, "a", encoding="utf-8") as f:
+        f.write('{"id": 50, "text": "partial')
+
+    fetched = asyncio.run(main.fetch_chat_history(FakeClient(250), -1001001, output_file=output))
+
+    assert fetched == 50
+    assert read_ids(output) == list(range(250, 0, -1))
+    assert not os.path.exists(f"{output}.checkpoint")
+
+def test_fetch_chat_history_ignores_checkpoint_of_another_chat(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+    asyncio.run(main.fetch_chat_history(FakeClient(250, fail_at=50), -1001001, output_file=output))
+
+    fetched = asyncio.run(main.fetch_chat_history(FakeClient(30), -1001002, output_file=output))
+
+    assert fetched == 30
+    assert read_ids(output) == list(range(30, 0, -1))
+
+def test_fetch_chat_history_respects_limit_across_resume(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+    asyncio.run(main.fetch_chat_history(FakeClient(250, fail_at=100), -1001001, output_file=output, limit=180))
+
+    fetched = asyncio.run(main.fetch_chat_history(FakeClient(250), -1001001, output_file=output, limit=180))
+
+    assert fetched == 80
+    assert read_ids(output) == list(range(250, 70, -1))
+
+def test_sync_chat_history_appends_only_new_messages(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+    state = main.SyncState(str(tmp_path / "sync_state.json"))
+
+    assert asyncio.run(main.sync_chat_history(FakeClient(250), -1001001, output, state=state)) == 250
+    assert state.get(-1001001) == {"newest_id": 250, "oldest_id": 1, "count": 250, "complete": True}
+
+    # Появились новые сообщения: догружаются только они, от старых к новым
+    state = main.SyncState(str(tmp_path / "sync_state.json"))
+    assert asyncio.run(main.sync_chat_history(FakeClient(260), -1001001, output, state=state)) == 10
+    assert read_ids(output) == list(range(250, 0, -1)) + list(range(251, 261))
+    assert state.get(-1001001) == {"newest_id": 260, "oldest_id": 1, "count": 260, "complete": True}
+
+    assert asyncio.run(main.sync_chat_history(FakeClient(260), -1001001, output, state=state)) == 0
+
+def test_sync_chat_history_backfills_below_the_oldest_message(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+    state = main.SyncState(str(tmp_path / "sync_state.json"))
+
+    assert asyncio.run(main.sync_chat_history(FakeClient(250), -1001001, output, limit=120, state=state)) == 120
+    assert state.get(-1001001) == {"newest_id": 250, "oldest_id": 131, "count": 120, "complete": False}
+
+    # Без backfill проверяются только новые сообщения
+    assert asyncio.run(main.sync_chat_history(FakeClient(250), -1001001, output, state=state)) == 0
+    assert asyncio.run(main.sync_chat_history(FakeClient(250), -1001001, output, backfill=True, state=state)) == 130
+    assert read_ids(output) == list(range(250, 0, -1))
+    assert state.get(-1001001)["complete"] is True
+
+def test_partitioned_history_is_written_in_ascending_order(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+
+    fetched = asyncio.run(main.fetch_chat_history_partitioned(FakeClient(1000), -1001001, output, partitions=4))
+
+    assert fetched == 1000
+    assert read_ids(output) == list(range(1, 1001))
+    assert not os.path.exists(f"{output}.partitions")
+    assert not any(os.path.exists(f"{output}.part{part}") for part in range(4))
+
+def test_partitioned_history_resumes_failed_partition(tmp_path):
+    output = str(tmp_path / "history.jsonl")
+
+    # Вторая часть (ID 251–500) обрывается на ID 400, первая пачка части уже сохранена
+    assert asyncio.run(main.fetch_chat_history_partitioned(FakeClient(1000, fail_at=400), -1001001, output,
+                                                           partitions=4)) is None
+    with open(f"{output}.partitions", encoding="utf-8") as f:
+        plan = json.load(f)
+    assert plan["ranges"] == [[1, 250], [251, 500], [501, 750], [751, 1000]]
+    assert [progress["last_id"] for progress in plan["progress"]] == [250, 350, 750, 1000]
+    with open(f"{output}.part1", "a", encoding="utf-8") as f:
+        f.write('{"id": 351, "text": "partial')
+
+    fetched = asyncio.run(main.fetch_chat_history_partitioned(FakeClient(1000), -1001001, output, partitions=4))
+
+    assert fetched == 150
+    assert read_ids(output) == list(range(1, 1001))
+    assert not os.path.exists(f"{output}.partitions")
+
+class ExportClient(FakeClient):
+    """
+    Клиент с несколькими чатами одинаковой длины; история чатов из failing обрывается на ID fail_at.
+    """
+
+    def __init__(self, count, failing=(), fail_at=50):
+        super().__init__(count)
+        self.failing = set(failing)
+        self.failing_at = fail_at
+        self.started = []
+
+    async def get_entity(self, chat):
+        # Нормализованный ID супергруппы совпадает с запрошенным (см. normalize_chat_id)
+        return SimpleNamespace(id=main.CHANNEL_ID_OFFSET - chat, title=f"Chat {chat}", username=None, megagroup=True)
+
+    def iter_messages(self, entity, **kwargs):
+        self.started.append(entity)
+        history = super().iter_messages(entity, **kwargs)
+        history.fail_at = self.failing_at if entity in self.failing else None
+        return history
+
+CHATS = [main.CHANNEL_ID_OFFSET - number for number in (1, 2, 3, 4)]
+
+def test_export_chats_continues_after_failure_and_writes_summary(tmp_path):
+    client = ExportClient(120, failing={CHATS[1]})
+    targets = [{"id": chat} for chat in CHATS]
+
+    results = asyncio.run(main.export_chats(client, targets, output_dir=str(tmp_path), concurrency=2))
+
+    assert [result["status"] for result in results] == ["ok", "failed", "ok", "ok"]
+    # При concurrency=2 первыми запускаются два чата, остальные ждут свободного места
+    assert client.started[:2] == CHATS[:2]
+    for chat in (CHATS[0], CHATS[2], CHATS[3]):
+        assert read_ids(tmp_path / f"{chat}.jsonl") == list(range(120, 0, -1))
+    with open(tmp_path / "export_summary.json", encoding="utf-8") as f:
+        summary = json.load(f)
+    assert (summary["chats"], summary["ok"], summary["failed"], summary["skipped"]) == (4, 3, 1, 0)
+    assert summary["messages"] == 360
+
+def test_export_chats_abort_skips_remaining_targets(tmp_path):
+    client = ExportClient(120, failing={CHATS[0]})
+    targets = [{"id": chat} for chat in CHATS]
+
+    results = asyncio.run(main.export_chats(client, targets, output_dir=str(tmp_path), concurrency=1, on_error="abort"))
+
+    assert {result["id"]: result["status"] for result in results} == {
+        CHATS[0]: "failed", CHATS[1]: "skipped", CHATS[2]: "skipped", CHATS[3]: "skipped"}
+    assert client.started == [CHATS[0]]
+
+def test_export_chats_rejects_unknown_policy(tmp_path):
+    with pytest.raises(ValueError):
+        asyncio.run(main.export_chats(ExportClient(1), [], output_dir=str(tmp_path), on_error="retry"))
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from main import IngestQueue
+from records import MessageRecord
+
+def record(number):
+    return MessageRecord(number, chat_id=-1001, date=1704067200 + number, text=f"message {number}",
+                         received=time.monotonic())
+
+async def take(queue, count):
+    items = []
+    for _ in range(count):
+        item = await queue.get()
+        queue.done(item)
+        items.append(item)
+    return items
+
+def test_unknown_overflow_policy_is_rejected():
+    with pytest.raises(ValueError):
+        IngestQueue(overflow="ignore")
+
+def test_block_policy_waits_for_free_slot():
+    async def run():
+        queue = IngestQueue(maxsize=2, overflow="block")
+        await queue.put(record(1))
+        await queue.put(record(2))
+        blocked = asyncio.ensure_future(queue.put(record(3)))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        first = await take(queue, 1)
+        await asyncio.wait_for(blocked, 1.0)
+        rest = await take(queue, 2)
+        return first + rest, queue.stats()
+
+    items, stats = asyncio.run(run())
+    assert [item.id for item in items] == [1, 2, 3]
+    assert stats["dropped"] == 0
+    assert stats["max_depth"] == 2
+
+def test_drop_oldest_policy_keeps_newest_records():
+    async def run():
+        queue = IngestQueue(maxsize=3, overflow="drop-oldest")
+        for number in range(1, 8):
+            await queue.put(record(number))
+        return await take(queue, queue.depth), queue.stats()
+
+    items, stats = asyncio.run(run())
+    assert [item.id for item in items] == [5, 6, 7]
+    assert stats["received"] == 7
+    assert stats["dropped"] == 4
+    assert stats["processed"] == 3
+
+def test_spill_policy_preserves_order_and_fields(tmp_path):
+    spill_file = str(tmp_path / "spill.jsonl")
+
+    async def run():
+        queue = IngestQueue(maxsize=2, overflow="spill", spill_file=spill_file)
+        for number in range(1, 6):
+            await queue.put(record(number))
+        assert queue.depth == 5
+        assert os.path.exists(spill_file)
+        # Новая запись после освобождения места идёт за записями из файла
+        items = await take(queue, 3)
+        await queue.put(record(6))
+        items += await take(queue, queue.depth)
+        stats = queue.stats()
+        queue.close()
+        return items, stats
+
+    items, stats = asyncio.run(run())
+    assert [item.id for item in items] == [1, 2, 3, 4, 5, 6]
+    assert items[3] == record(4)
+    assert items[3].received is not None
+    assert stats["spilled"] == 4
+    assert stats["dropped"] == 0
+    assert not os.path.exists(spill_file)
+
+def test_drain_waits_for_records_in_progress():
+    async def run():
+        queue = IngestQueue(maxsize=10)
+        await queue.put(record(1))
+        item = await queue.get()
+        assert queue.depth == 0
+        assert not await queue.drain(timeout=0.05)
+        queue.done(item)
+        return await queue.drain(timeout=0.05), queue.stats()
+
+    drained, stats = asyncio.run(run())
+    assert drained
+    assert stats["processed"] == 1
+    assert stats["max_lag"] >= stats["last_lag"] >= 0
+
+def test_drop_oldest_policy_reports_evicted_records():
+    evicted = []
+
+    async def run():
+        queue = IngestQueue(maxsize=2, overflow="drop-oldest", on_drop=evicted.append)
+        for number in range(1, 5):
+            await queue.put(record(number))
+        return await take(queue, queue.depth)
+
+    items = asyncio.run(run())
+    assert [item.id for item in evicted] == [1, 2]
+    assert [item.id for item in items] == [3, 4]
+
+def test_drop_oldest_policy_waits_when_asked():
+    async def run():
+        queue = IngestQueue(maxsize=1, overflow="drop-oldest")
+        await queue.put(record(1))
+        waiting = asyncio.ensure_future(queue.put(record(2), wait=True))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        items = await take(queue, 1)
+        await waiting
+        return items + await take(queue, 1), queue.stats()
+
+    items, stats = asyncio.run(run())
+    assert [item.id for item in items] == [1, 2]
+    assert stats["dropped"] == 0
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from cache import EntityCache
+from ratelimit import RateLimiter
+
+CHAT_ID = -1000000000005
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def message(number):
+    return SimpleNamespace(id=number, date=START + timedelta(seconds=number), sender_id=7, text=f"message {number}",
+                           message=f"message {number}", reply_to=None, edit_date=None, media=None)
+
+class FakeClient:
+    """
+    Клиент слушателя: run_until_disconnected присылает пачку событий и ждёт, пока сработает script.
+    """
+
+    def __init__(self, events, script):
+        self.events = events
+        self.script = script
+        self.handlers = []
+        self.builders = []
+        self.fetched = []
+        self.history = []
+        self.backfills = []
+        self.connected = True
+        self.rate_limiter = RateLimiter(rates={"history": 1000.0, "entity": 1000.0})
+        self.chat = SimpleNamespace(id=5, title="Chat", username=None, megagroup=True, broadcast=False, forum=False)
+
+    def add_event_handler(self, handler, event):
+        self.handlers.append(handler)
+        self.builders.append(event)
+
+    def remove_event_handler(self, handler):
+        self.handlers = [item for item in self.handlers if item is not handler]
+
+    async def get_entity(self, chat):
+        return self.chat
+
+    def is_connected(self):
+        return self.connected
+
+    async def iter_messages(self, chat, min_id=0, limit=None, reverse=False):
+        self.backfills.append(min_id)
+        for number in self.history:
+            if number > min_id:
+                yield message(number)
+
+    async def get_messages(self, chat, ids):
+        self.fetched.extend(ids)
+        return [message(number) for number in ids]
+
+    async def run_until_disconnected(self):
+        handler = next(item for item in self.handlers if item.__name__ == "new_message_handler")
+        for number in self.events:
+            await handler(SimpleNamespace(chat_id=CHAT_ID, chat=self.chat, message=message(number)))
+        await self.script(self)
+
+@pytest.fixture(autouse=True)
+def listener_env(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+    main.console.quiet = True
+    yield
+    main.console.quiet = False
+
+async def wait_for_state(path, message_id, timeout=3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while asyncio.get_running_loop().time() < deadline:
+        if main.load_json_file(path, default={}).get(str(CHAT_ID)) == message_id:
+            return
+        await asyncio.sleep(0.02)
+
+def listen(client, output_file, **kwargs):
+    asyncio.run(main.listen_to_messages(client, [{"id": CHAT_ID}], output_file, workers=1, refresh_interval=0.02,
+                                        quiet=True, flush_interval=0.01, **kwargs))
+
+def test_listener_refetches_messages_dropped_by_the_queue():
+    async def script(client):
+        await wait_for_state("messages.jsonl.state", 50)
+
+    client = FakeClient(range(1, 51), script)
+    listen(client, "messages.jsonl", queue_size=5, overflow="drop-oldest")
+
+    with open("messages.jsonl", encoding="utf-8") as f:
+        ids = [json.loads(line)["message_id"] for line in f]
+    assert sorted(ids) == list(range(1, 51))
+    assert sorted(client.fetched) == list(range(1, 46))
+    assert main.load_json_file("messages.jsonl.state") == {str(CHAT_ID): 50}
+    assert not os.path.exists("messages.jsonl.spill")
+
+def test_listener_catches_up_after_reconnect():
+    async def script(client):
+        await wait_for_state("messages.jsonl.state", 3)
+        client.connected = False
+        await asyncio.sleep(0.1)
+        # Пока соединения не было, в чате появились новые сообщения
+        client.history = list(range(1, 7))
+        client.connected = True
+        await wait_for_state("messages.jsonl.state", 6)
+
+    client = FakeClient(range(1, 4), script)
+    listen(client, "messages.jsonl")
+
+    with open("messages.jsonl", encoding="utf-8") as f:
+        ids = [json.loads(line)["message_id"] for line in f]
+    assert ids == [1, 2, 3, 4, 5, 6]
+    assert client.backfills == [3]
+
+def test_listener_registers_new_message_handler_for_whitelisted_chats():
+    async def script(client):
+        await wait_for_state("messages.jsonl.state", 1)
+
+    client = FakeClient([1], script)
+    listen(client, "messages.jsonl")
+
+    new_message = next(builder for builder in client.builders if type(builder) is main.events.NewMessage)
+    assert new_message.chats == [CHAT_ID]
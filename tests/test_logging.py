@@ -0,0 +1,34 @@
+import logging
+
+from main import LogRateLimiter
+
+def log_record(created, level=logging.INFO, lineno=10, msg="chat %s updated", args=(1,)):
+    record = logging.LogRecord("example", level, "main.py", lineno, msg, args, None)
+    record.created = created
+    return record
+
+def test_rate_limiter_suppresses_records_over_limit_and_reports_them():
+    limiter = LogRateLimiter(limit=2)
+
+    assert [limiter.filter(log_record(100.1 + step / 10)) for step in range(5)] == [True, True, False, False, False]
+
+    # Первая запись следующей секунды сообщает, сколько записей было отброшено
+    record = log_record(101.0)
+    assert limiter.filter(record)
+    assert record.getMessage() == "chat 1 updated (3 similar messages suppressed)"
+    assert limiter.filter(log_record(101.5))
+    assert not limiter.filter(log_record(101.9))
+
+def test_rate_limiter_counts_call_sites_separately():
+    limiter = LogRateLimiter(limit=1)
+
+    assert limiter.filter(log_record(100.0, lineno=10))
+    assert limiter.filter(log_record(100.0, lineno=20))
+    assert not limiter.filter(log_record(100.0, lineno=10))
+
+def test_rate_limiter_passes_errors():
+    limiter = LogRateLimiter(limit=1)
+
+    assert all(limiter.filter(log_record(100.0, level=logging.ERROR)) for _ in range(5))
+    assert limiter.filter(log_record(100.0))
+    assert not limiter.filter(log_record(100.0))
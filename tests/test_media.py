@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+from types import SimpleNamespace
+
+from main import MediaDownloader
+from ratelimit import RateLimiter
+
+class MediaClient:
+    """
+    Клиент с содержимым документов по их ID; iter_download отдаёт файл фрагментами по request_size.
+    """
+
+    def __init__(self, contents):
+        self.contents = contents
+        self.downloads = []  # (ID документа, смещение)
+        self.rate_limiter = RateLimiter(rates={"download": 1000.0, "history": 1000.0})
+
+    async def iter_download(self, media, offset=0, request_size=None, file_size=None):
+        self.downloads.append((media.id, offset))
+        data = self.contents[media.id]
+        for start in range(offset, len(data), request_size):
+            await asyncio.sleep(0)
+            yield data[start:start + request_size]
+
+def document_message(document_id, size, kind="document"):
+    return SimpleNamespace(id=document_id, chat_id=-1001, media=None, photo=None,
+                           document=SimpleNamespace(id=document_id), voice=None, audio=None, sticker=None, gif=None,
+                           video=SimpleNamespace() if kind == "video" else None,
+                           file=SimpleNamespace(ext=".bin", size=size, mime_type="application/octet-stream"))
+
+def download(client, directory, messages, **kwargs):
+    async def run():
+        downloader = MediaDownloader(client, directory=directory, concurrency=2, **kwargs)
+        downloader.REQUEST_SIZE = 4
+        downloader.start()
+        records = [downloader.submit(message) for message in messages]
+        await downloader.close(timeout=5)
+        return downloader, records
+
+    return asyncio.run(run())
+
+def read_index(directory):
+    with open(os.path.join(directory, "index.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_same_file_is_stored_once(tmp_path):
+    directory = str(tmp_path / "media")
+    client = MediaClient({1: b"same content", 2: b"same content", 3: b"other"})
+    messages = [document_message(1, 12), document_message(1, 12), document_message(2, 12), document_message(3, 5)]
+
+    downloader, records = download(client, directory, messages)
+
+    assert [record["key"] for record in records] == ["document_1", "document_1", "document_2", "document_3"]
+    # Повтор того же ID не скачивается, а одинаковое содержимое под другим ID заменяется жёсткой ссылкой
+    assert sorted(document_id for document_id, _ in client.downloads) == [1, 2, 3]
+    assert downloader.stats() == {"downloaded": 2, "deduplicated": 2, "skipped": 0, "failed": 0, "pending": 0}
+    assert os.path.samefile(records[0]["path"], records[2]["path"])
+    assert sorted(entry["key"] for entry in read_index(directory)) == ["document_1", "document_2", "document_3"]
+
+    # После перезапуска известные файлы берутся из index.jsonl
+    client.downloads.clear()
+    downloader, _ = download(client, directory, [document_message(3, 5)])
+    assert client.downloads == []
+    assert downloader.stats()["deduplicated"] == 1
+
+def test_partial_file_is_resumed_from_request_boundary(tmp_path):
+    directory = str(tmp_path / "media")
+    os.makedirs(directory)
+    with open(os.path.join(directory, "document_1.bin.part"), "wb") as f:
+        f.write(b"0123456")
+
+    client = MediaClient({1: b"0123456789"})
+    _, records = download(client, directory, [document_message(1, 10)])
+
+    assert client.downloads == [(1, 4)]
+    with open(records[0]["path"], "rb") as f:
+        assert f.read() == b"0123456789"
+    assert not os.path.exists(f"{records[0]['path']}.part")
+
+def test_filtered_media_is_skipped(tmp_path):
+    directory = str(tmp_path / "media")
+    client = MediaClient({1: b"video", 2: b"large document"})
+
+    downloader, records = download(client, directory, [document_message(1, 5, kind="video"), document_message(2, 14)],
+                                   types=["document"], max_size=10)
+
+    assert [(record["skipped"], record["path"]) for record in records] == [("type", None), ("size", None)]
+    assert client.downloads == []
+    assert downloader.stats()["skipped"] == 2
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from metrics import Metrics
+
+def test_render_counters_and_gauges_in_prometheus_format():
+    metrics = Metrics(namespace="test")
+    metrics.inc("messages_total", chat="1")
+    metrics.inc("messages_total", 2, chat="1")
+    metrics.inc("messages_total", chat="2")
+    metrics.set("workers", 4)
+    depth = [3]
+    metrics.register_gauge("queue_depth", lambda: depth[0])
+    depth[0] = 7
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE test_messages_total counter" in lines
+    assert 'test_messages_total{chat="1"} 3' in lines
+    assert 'test_messages_total{chat="2"} 1' in lines
+    assert "test_workers 4" in lines
+    assert "test_queue_depth 7" in lines
+
+    metrics.unregister_gauge("queue_depth")
+    assert "test_queue_depth" not in metrics.render()
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics(namespace="test", buckets=(0.1, 1.0))
+    for seconds in (0.05, 0.5, 0.5, 5.0):
+        metrics.observe("write_seconds", seconds, sink="jsonl")
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE test_write_seconds histogram" in lines
+    assert 'test_write_seconds_bucket{sink="jsonl",le="0.1"} 1' in lines
+    assert 'test_write_seconds_bucket{sink="jsonl",le="1.0"} 3' in lines
+    assert 'test_write_seconds_bucket{sink="jsonl",le="+Inf"} 4' in lines
+    assert 'test_write_seconds_sum{sink="jsonl"} 6.050000' in lines
+    assert 'test_write_seconds_count{sink="jsonl"} 4' in lines
+
+def test_timed_counts_calls_by_status():
+    metrics = Metrics(namespace="test")
+
+    @metrics.timed("job")
+    async def job(fail):
+        if fail:
+            raise RuntimeError("failed")
+        return "done"
+
+    assert asyncio.run(job(False)) == "done"
+    with pytest.raises(RuntimeError):
+        asyncio.run(job(True))
+
+    text = metrics.render()
+    assert 'test_job_total{status="ok"} 1' in text
+    assert 'test_job_total{status="error"} 1' in text
+    assert "test_job_seconds_count 2" in text
+
+def test_failing_gauge_does_not_break_render():
+    metrics = Metrics(namespace="test")
+    metrics.inc("ok_total")
+    metrics.register_gauge("broken", lambda: 1 / 0)
+
+    assert "test_ok_total 1" in metrics.render()
+    assert metrics.summary() == "ok_total=1"
+
+def test_serve_exposes_metrics_over_http():
+    metrics = Metrics(namespace="test")
+    metrics.inc("requests_total")
+
+    async def fetch(path):
+        server = await metrics.serve(port=0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("latin-1"))
+            await writer.drain()
+            response = await reader.read()
+            writer.close()
+            return response.decode("utf-8")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(fetch("/metrics"))
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert response.endswith("test_requests_total 1\n")
+    assert asyncio.run(fetch("/other")).startswith("HTTP/1.1 404 Not Found")
@@ -0,0 +1,129 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import ratelimit
+from main import ClientPool, dispatch
+from ratelimit import RateLimiter, limiter_for
+
+class Session:
+    """
+    Сессия Telegram в памяти: get_entity может завершаться FloodWait или потерей соединения.
+    """
+
+    def __init__(self, name, flood=None, floods=None, drop=False):
+        self.name = name
+        self.flood = flood  # Длительность FloodWait (None — без FloodWait)
+        self.floods = floods  # Сколько раз ответить FloodWait (None — всегда)
+        self.drop = drop
+        self.connected = True
+        self.calls = 0
+
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.connected = True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def get_entity(self, chat):
+        self.calls += 1
+        if self.drop:
+            self.connected = False
+            raise ConnectionError("connection lost")
+        if self.flood is not None and (self.floods is None or self.calls <= self.floods):
+            raise errors.FloodWaitError(request=None, capture=self.flood)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(id=chat, session=self.name)
+
+def resolve(chat):
+    return lambda client: limiter_for(client).call("entity", client.get_entity, chat)
+
+@pytest.fixture(autouse=True)
+def fast_shared_limiter(monkeypatch):
+    monkeypatch.setattr(ratelimit, "rate_limiter", RateLimiter(rates={"entity": 1000.0, "history": 1000.0}))
+
+def test_sessions_get_own_limiters_with_shared_rates():
+    first, second = Session("a"), Session("b")
+    pool = ClientPool({"a": first, "b": second})
+
+    assert pool.primary is first
+    assert limiter_for(first) is not limiter_for(second)
+    assert limiter_for(first).base_rates["entity"] == 1000.0
+
+def test_jobs_are_spread_over_least_loaded_sessions():
+    pool = ClientPool({"a": Session("a"), "b": Session("b")})
+
+    async def run():
+        return await asyncio.gather(*(dispatch(pool, "entity", resolve(chat)) for chat in range(6)))
+
+    sessions = [entity.session for entity in asyncio.run(run())]
+    assert sessions.count("a") == 3
+    assert sessions.count("b") == 3
+
+def test_long_flood_wait_moves_job_to_another_session():
+    flooded, spare = Session("a", flood=120), Session("b")
+    pool = ClientPool({"a": flooded, "b": spare}, max_flood_wait=30)
+
+    async def run():
+        first = await pool.run("entity", resolve(1))
+        # Сессия "a" заблокирована для get_entity, следующие задачи сразу идут на "b"
+        second = await pool.run("entity", resolve(2))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert (first.session, second.session) == ("b", "b")
+    assert flooded.calls == 1
+    assert limiter_for(flooded).blocked("entity") > 30
+    stats = pool.stats()
+    assert stats["a"]["failovers"] == 1
+    assert stats["a"]["healthy"] is True
+
+def test_short_flood_wait_is_waited_out_on_same_session():
+    session = Session("a", flood=0, floods=1)
+    pool = ClientPool({"a": session}, max_flood_wait=30)
+
+    assert asyncio.run(pool.run("entity", resolve(1))).session == "a"
+    assert session.calls == 2
+    assert pool.stats()["a"]["failovers"] == 0
+
+def test_lost_connection_fails_over_and_reconnects():
+    dropped, spare = Session("a", drop=True), Session("b")
+    pool = ClientPool({"a": dropped, "b": spare}, reconnect_delay=0.01)
+
+    async def run():
+        result = await pool.run("entity", resolve(1))
+        unhealthy = pool.stats()["a"]["healthy"]
+        dropped.drop = False
+        await asyncio.sleep(0.05)
+        await pool.close()
+        return result, unhealthy
+
+    result, unhealthy = asyncio.run(run())
+    assert result.session == "b"
+    assert unhealthy is False
+    assert pool.stats()["a"]["healthy"] is True
+
+def test_job_fails_when_every_session_keeps_failing():
+    pool = ClientPool({"a": Session("a"), "b": Session("b")}, max_flood_wait=30)
+
+    async def job(client):
+        raise ratelimit.SessionUnavailable("paused", 120)
+
+    async def run():
+        return await pool.run("entity", job)
+
+    with pytest.raises(ratelimit.SessionUnavailable):
+        asyncio.run(run())
+    assert sum(session["failovers"] for session in pool.stats().values()) == 6
+
+def test_empty_pool_is_rejected():
+    with pytest.raises(ValueError):
+        ClientPool({})
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import pytest
+from telethon import errors
+
+import ratelimit
+from ratelimit import RateLimiter, SessionUnavailable, dispatch, failover_after, limiter_for
+
+def flood(seconds):
+    error = errors.FloodWaitError(request=None, capture=seconds)
+    assert error.seconds == seconds
+    return error
+
+def test_report_flood_halves_rate_and_blocks_bucket():
+    limiter = RateLimiter(rates={"history": 4.0})
+    limiter.report_flood("history", 30)
+
+    stats = limiter.stats()["history"]
+    assert stats["rate"] == 2.0
+    assert stats["floods"] == 1
+    assert stats["flood_wait_seconds"] == 30
+    assert 29 < limiter.blocked("history") <= 30
+    assert limiter.blocked("send") == 0.0
+
+def test_rate_never_drops_below_minimum():
+    limiter = RateLimiter(rates={"history": 0.1})
+    for _ in range(10):
+        limiter.report_flood("history", 1)
+
+    assert limiter.stats()["history"]["rate"] == RateLimiter.MIN_RATE
+
+def test_success_streak_raises_rate_up_to_max_factor():
+    limiter = RateLimiter(rates={"send": 1.0}, max_factor=2.0, increase_after=5)
+    limiter.report_flood("send", 0)
+    assert limiter.stats()["send"]["rate"] == 0.5
+
+    for _ in range(5):
+        limiter.report_success("send")
+    assert limiter.stats()["send"]["rate"] == pytest.approx(0.6)
+
+    for _ in range(500):
+        limiter.report_success("send")
+    assert limiter.stats()["send"]["rate"] == 2.0
+
+def test_call_retries_after_flood_wait():
+    limiter = RateLimiter(rates={"entity": 1000.0})
+    attempts = []
+
+    async def request(value):
+        attempts.append(value)
+        if len(attempts) < 3:
+            raise flood(0)
+        return value * 2
+
+    assert asyncio.run(limiter.call("entity", request, 21)) == 42
+    assert len(attempts) == 3
+    assert limiter.stats()["entity"]["floods"] == 2
+
+def test_call_raises_after_retries_are_exhausted():
+    limiter = RateLimiter(rates={"entity": 1000.0})
+
+    async def request():
+        raise flood(0)
+
+    with pytest.raises(errors.FloodWaitError):
+        asyncio.run(limiter.call("entity", request, retries=2))
+    assert limiter.stats()["entity"]["floods"] == 3
+
+def test_acquire_spaces_requests_by_rate():
+    limiter = RateLimiter(rates={"send": 20.0})
+
+    async def run():
+        started = time.monotonic()
+        for _ in range(25):
+            await limiter.acquire("send")
+        return time.monotonic() - started
+
+    # 20 токенов есть сразу, ещё 5 набираются за 0.25 секунды
+    assert 0.2 <= asyncio.run(run()) < 1.0
+
+def test_iterate_takes_one_token_per_page_and_repeats_flooded_page():
+    limiter = RateLimiter(rates={"history": 1000.0})
+
+    class Pages:
+        limit = 250
+
+        def __init__(self):
+            self.items = list(range(250))
+            self.failed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            if not self.items:
+                raise StopAsyncIteration
+            if len(self.items) == 150 and not self.failed:
+                self.failed = True
+                raise flood(0)
+            return self.items.pop(0)
+
+    async def run():
+        return [item async for item in limiter.iterate("history", Pages())]
+
+    assert asyncio.run(run()) == list(range(250))
+    stats = limiter.stats()["history"]
+    # Три страницы по 100 элементов и один повтор второй страницы
+    assert stats["calls"] == 4
+    assert stats["floods"] == 1
+
+def test_acquire_inside_pool_job_raises_instead_of_long_wait():
+    limiter = RateLimiter(rates={"history": 1000.0})
+    limiter.report_flood("history", 120)
+
+    async def run():
+        token = failover_after.set(30)
+        try:
+            await limiter.acquire("history")
+        finally:
+            failover_after.reset(token)
+
+    with pytest.raises(SessionUnavailable) as info:
+        asyncio.run(run())
+    assert info.value.seconds > 30
+
+def test_limiter_for_prefers_session_limiter(monkeypatch):
+    shared = RateLimiter()
+    monkeypatch.setattr(ratelimit, "rate_limiter", shared)
+    session = type("Session", (), {"rate_limiter": RateLimiter()})()
+
+    assert limiter_for(object()) is shared
+    assert limiter_for(session) is session.rate_limiter
+
+def test_dispatch_runs_job_on_client_or_pool():
+    class Pool:
+        async def run(self, method, job, *args):
+            return ("pool", method, await job("session", *args))
+
+    async def job(client, value):
+        return (client, value)
+
+    assert asyncio.run(dispatch("client", "history", job, 1)) == ("client", 1)
+    assert asyncio.run(dispatch(Pool(), "history", job, 2)) == ("pool", "history", ("session", 2))
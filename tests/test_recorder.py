@@ -0,0 +1,66 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from telethon.tl import types
+
+from main import EventRecorder, read_event_frames, read_recorded_messages, replay_events
+from records import CHANNEL_ID_OFFSET, MessageRecord
+
+DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+def record(number):
+    return MessageRecord(number, chat_id=CHANNEL_ID_OFFSET - 5, date=1704067200 + number, text=f"message {number}",
+                         received=time.monotonic())
+
+def channel_message(number):
+    return types.UpdateNewChannelMessage(
+        message=types.Message(id=number, peer_id=types.PeerChannel(5), date=DATE, message=f"raw {number}"), pts=number,
+        pts_count=1)
+
+def test_recorded_records_and_updates_round_trip(tmp_path):
+    path = str(tmp_path / "events.bin")
+    # Маленький блок: кадры расходятся по нескольким сжатым блокам
+    with EventRecorder(path, block_size=256) as recorder:
+        for number in range(1, 21):
+            recorder.write_record(record(number))
+        recorder.write_update(channel_message(21))
+        recorder.write_update(types.UpdateDeleteChannelMessages(channel_id=5, messages=[3, 4], pts=22, pts_count=2))
+        recorder.write_update(types.UpdateDeleteMessages(messages=[7], pts=23, pts_count=1))
+
+    assert recorder.frames == 23
+    messages = [item for _, item in read_recorded_messages(path)]
+
+    assert messages[:20] == [record(number) for number in range(1, 21)]
+    assert (messages[20].id, messages[20].chat_id, messages[20].text) == (21, CHANNEL_ID_OFFSET - 5, "raw 21")
+    assert [(item.id, item.chat_id) for item in messages[21:]] == [(3, CHANNEL_ID_OFFSET - 5), (4, CHANNEL_ID_OFFSET - 5),
+                                                                   (7, None)]
+    assert all(item.deleted for item in messages[21:])
+
+def test_truncated_block_is_skipped(tmp_path):
+    path = str(tmp_path / "events.bin")
+    with EventRecorder(path, block_size=1 << 16) as recorder:
+        for number in range(1, 4):
+            recorder.write_record(record(number))
+        recorder.flush()
+        recorder.write_record(record(4))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-5])
+
+    assert len(list(read_event_frames(path))) == 3
+
+def test_replay_events_feeds_records_in_order(tmp_path):
+    path = str(tmp_path / "events.bin")
+    with EventRecorder(path) as recorder:
+        for number in range(1, 6):
+            recorder.write_record(record(number))
+    replayed = []
+
+    async def put(item):
+        replayed.append(item)
+
+    assert asyncio.run(replay_events(path, put)) == 5
+    assert [item.id for item in replayed] == [1, 2, 3, 4, 5]
+    assert all(item.received is not None for item in replayed)
@@ -0,0 +1,108 @@
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from records import BinaryCodec, JsonCodec, MessageRecord, pack, read_records, unpack
+
+DATE = datetime(2024, 1, 1, 12, 30, tzinfo=timezone.utc)
+
+def history_record(number, **fields):
+    return MessageRecord(number, date=int(DATE.timestamp()) + number, sender_id=7, text=f"сообщение {number}", **fields)
+
+def listener_record(number, **fields):
+    return MessageRecord(number, chat_id=-1001, topic_id=5, chat_name="Чат", forum_id=-1001,
+                         date=int(DATE.timestamp()) + number, sender_id=7, text=f"сообщение {number}", **fields)
+
+def write(path, codec, records):
+    with open(path, "wb") as f:
+        f.write(codec.header() + codec.encode(records))
+
+def test_from_message_keeps_date_reply_and_edit():
+    message = SimpleNamespace(id=10, date=DATE, sender_id=7, text="**текст**", message="текст",
+                              reply_to=SimpleNamespace(reply_to_msg_id=3, reply_to_top_id=2),
+                              edit_date=datetime(2024, 1, 2, tzinfo=timezone.utc))
+    record = MessageRecord.from_message(message, chat_id=-1001)
+
+    assert record["id"] == 10
+    assert record["date"] == DATE.isoformat()
+    assert record.text == "текст"
+    assert MessageRecord.from_message(message, formatted=True).text == "**текст**"
+    assert (record.reply_to, record.reply_to_top_id) == (3, 2)
+    assert record["edited"] == "2024-01-02T00:00:00+00:00"
+
+def test_from_dict_reads_legacy_keys_and_iso_dates():
+    record = MessageRecord.from_dict({"message_id": 5, "reply_to_msg_id": 4, "date": DATE.isoformat(),
+                                      "text": None, "unknown": 1})
+
+    assert record == MessageRecord(5, reply_to=4, date=int(DATE.timestamp()))
+    assert record.get("message_id") == 5
+    assert record.get("text", "") == ""
+    with pytest.raises(KeyError):
+        record["unknown"]
+
+def test_json_codec_writes_history_layout():
+    line = JsonCodec().encode([history_record(1)]).decode("utf-8")
+
+    assert line.endswith("\n")
+    assert json.loads(line) == {"id": 1, "date": "2024-01-01T12:30:01+00:00", "text": "сообщение 1", "sender_id": 7,
+                                "reply_to": None}
+    assert list(json.loads(line)) == ["id", "date", "text", "sender_id", "reply_to"]
+
+def test_json_codec_writes_listener_layout_with_optional_fields():
+    record = listener_record(2, media={"path": "media/1.jpg"}, edited=int(DATE.timestamp()) + 60)
+    data = json.loads(JsonCodec().encode([record]))
+
+    assert list(data) == ["chat_id", "chat_name", "message_id", "date", "text", "sender_id", "forum_id", "topic_id",
+                          "media", "edited"]
+    assert data["message_id"] == 2
+    assert data["edited"] == "2024-01-01T12:31:00+00:00"
+    assert MessageRecord.from_dict(data) == record
+
+def test_json_codec_passes_dicts_through():
+    assert json.loads(JsonCodec().encode([{"id": 1, "custom": True}])) == {"id": 1, "custom": True}
+
+@pytest.mark.parametrize("value", [
+    None, True, False, 0, 127, 128, 255, 256, 65535, 65536, 2 ** 32, 2 ** 63, -1, -32, -33, -129, -2 ** 31 - 1,
+    1.5, "", "a" * 31, "b" * 32, "в" * 200, "c" * 70000, b"\x00\x01", b"x" * 300,
+    list(range(15)), list(range(16)), {"a": 1}, {str(number): number for number in range(20)},
+    [None, {"nested": ["x", -5]}],
+])
+def test_pack_roundtrip(value):
+    out = bytearray()
+    pack(value, out)
+    assert unpack(bytes(out)) == (value, len(out))
+
+def test_binary_codec_roundtrip_matches_jsonl(tmp_path):
+    records = [history_record(number) for number in range(1, 4)] + [listener_record(4, media={"path": "a.jpg"})]
+    write(tmp_path / "a.msgpack", BinaryCodec(), records)
+    write(tmp_path / "a.jsonl", JsonCodec(), records)
+
+    assert list(read_records(str(tmp_path / "a.msgpack"))) == list(read_records(str(tmp_path / "a.jsonl")))
+    assert [MessageRecord.from_dict(item) for item in read_records(str(tmp_path / "a.msgpack"))] == records
+
+def test_binary_codec_is_smaller_than_jsonl():
+    records = [history_record(number) for number in range(1, 101)]
+
+    assert len(BinaryCodec().encode(records)) < len(JsonCodec().encode(records)) * 0.8
+
+def test_binary_scan_resumes_from_offset_and_skips_torn_tail(tmp_path):
+    path = tmp_path / "a.msgpack"
+    codec = BinaryCodec()
+    write(path, codec, [history_record(1), history_record(2)])
+    offsets = [offset for _, offset in codec.scan(str(path))]
+    with open(path, "ab") as f:
+        f.write(codec.encode([history_record(3)])[:-3])
+
+    assert [item["id"] for item, _ in codec.scan(str(path), offsets[0])] == [2]
+    assert [item["id"] for item, _ in codec.scan(str(path), chunk_size=7)] == [1, 2]
+
+def test_binary_scan_reads_concatenated_files(tmp_path):
+    path = tmp_path / "a.msgpack"
+    codec = BinaryCodec()
+    with open(path, "wb") as f:
+        for number in (1, 2):
+            f.write(codec.header() + codec.encode([history_record(number)]))
+
+    assert [item["id"] for item in read_records(str(path))] == [1, 2]
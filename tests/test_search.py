@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from search import SearchIndex, build_match
+
+@pytest.mark.parametrize("query, expected", [
+    ("привет мир", '"привет" "мир"'),
+    ('"добрый вечер"', '"добрый вечер"'),
+    ('"незакрытая фраза', '"незакрытая фраза"'),
+    ("сообщ*", '"сообщ"*'),
+    ("кот OR пёс", '"кот" OR "пес"'),
+    ("OR кот OR OR пёс OR", '"кот" OR "пес"'),
+    ("ЁЖ", '"ЕЖ"'),
+])
+def test_build_match(query, expected):
+    assert build_match(query) == expected
+
+def test_build_match_quotes_fts5_syntax():
+    # Операторы и скобки FTS5 из запроса становятся обычными словами
+    assert build_match("NEAR(a b) AND -x") == '"NEAR a" "b" "AND" "x"'
+
+@pytest.mark.parametrize("query", ["", "   ", "*** ()", "OR"])
+def test_build_match_rejects_empty_query(query):
+    with pytest.raises(ValueError):
+        build_match(query)
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "search.db"))
+    yield index
+    index.close()
+
+def history(number, text, sender_id=7):
+    return {"id": number, "date": f"2024-01-{number:02d}T00:00:00+00:00", "text": text, "sender_id": sender_id,
+            "reply_to": None}
+
+def test_search_finds_words_phrases_and_prefixes(index):
+    index.add([history(1, "Добрый вечер, коллеги"), history(2, "Вечер добрый"), history(3, "Отчёт за неделю")],
+              chat_id=-1001)
+
+    assert {row["message_id"] for row in index.search("вечер добрый")} == {1, 2}
+    assert [row["message_id"] for row in index.search('"добрый вечер"')] == [1]
+    assert [row["message_id"] for row in index.search("отч*")] == [3]
+    assert [row["message_id"] for row in index.search("отчет")] == [3]
+    assert index.search("вечер", highlight=("<", ">"))[0]["snippet"].count("<") == 1
+
+def test_search_filters(index):
+    index.add([history(1, "новости", sender_id=1), history(2, "новости", sender_id=2)], chat_id=-1001)
+    index.add([history(3, "новости", sender_id=1)], chat_id=-1002, topic_id=5)
+
+    assert {row["message_id"] for row in index.search("новости", chat_id=-1001)} == {1, 2}
+    assert [row["message_id"] for row in index.search("новости", topic_id=5)] == [3]
+    assert {row["message_id"] for row in index.search("новости", sender_id=1)} == {1, 3}
+    assert [row["message_id"] for row in index.search("новости", since="2024-01-02", until="2024-01-03")] == [2]
+
+def test_readding_message_replaces_its_text(index):
+    index.add([history(1, "старый текст")], chat_id=-1001)
+    index.add([history(1, "новый текст")], chat_id=-1001)
+
+    assert index.search("старый") == []
+    assert [row["text"] for row in index.search("текст")] == ["новый текст"]
+    assert index.stats()["documents"] == 1
+
+def test_index_archive_resumes_from_stored_offset(index, tmp_path):
+    archive = tmp_path / "-1001_5.jsonl"
+    with open(archive, "w", encoding="utf-8") as f:
+        for number in (1, 2):
+            f.write(json.dumps(history(number, f"запись {number}"), ensure_ascii=False) + "\n")
+
+    assert index.index_archive(str(archive)) == 2
+    with open(archive, "a", encoding="utf-8") as f:
+        f.write(json.dumps(history(3, "запись 3"), ensure_ascii=False) + "\n")
+        f.write('{"id": 4, "text": "недописан')
+
+    assert index.index_archive(str(archive)) == 1
+    results = index.search("запись")
+    assert sorted(row["message_id"] for row in results) == [1, 2, 3]
+    assert {(row["chat_id"], row["topic_id"]) for row in results} == {(-1001, 5)}
+
+def test_search_ranks_all_matches_unless_window_is_set(index):
+    # Самое релевантное совпадение добавлено первым, дальше — десять упоминаний вскользь
+    index.add([history(1, "отчёт отчёт отчёт")] +
+              [history(number, f"длинное сообщение номер {number}, где отчёт упомянут один раз") for number in range(2, 12)],
+              chat_id=-1001)
+
+    assert index.search("отчёт", limit=1)[0]["message_id"] == 1
+    windowed = index.search("отчёт", limit=20, rank_window=5)
+    assert sorted(result["message_id"] for result in windowed) == [7, 8, 9, 10, 11]
@@ -0,0 +1,111 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+
+import main
+from cache import EntityCache
+from ratelimit import RateLimiter
+from records import CHANNEL_ID_OFFSET
+
+def group(number, **rights):
+    return SimpleNamespace(id=number, title=f"Group {number}", username=None, megagroup=True, **rights)
+
+class SendClient:
+    """
+    Клиент рассылки: get_entity принимает и один чат, и список; отправка в чаты из forbidden запрещена,
+    а в чаты из flaky первая попытка обрывается ConnectionError.
+    """
+
+    def __init__(self, entities, forbidden=(), flaky=(), allowed=True):
+        self.entities = entities  # Ключ EntityCache -> объект чата
+        self.forbidden = set(forbidden)
+        self.flaky = set(flaky)
+        self.allowed = allowed
+        self.lookups = []
+        self.permission_checks = []
+        self.sent = []
+        self.active = 0
+        self.max_active = 0
+        self.rate_limiter = RateLimiter(rates={"entity": 1000.0, "send": 1000.0})
+
+    async def get_entity(self, chat):
+        self.lookups.append(chat)
+        chats = chat if isinstance(chat, list) else [chat]
+        for item in chats:
+            if item not in self.entities:
+                raise ValueError(f"No user has {item} as username")
+        entities = [self.entities[item] for item in chats]
+        return entities if isinstance(chat, list) else entities[0]
+
+    async def get_permissions(self, chat_id):
+        self.permission_checks.append(chat_id)
+        return SimpleNamespace(send_messages=self.allowed)
+
+    async def send_message(self, chat_id, text):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.01)
+            if chat_id in self.forbidden:
+                raise errors.ChatWriteForbiddenError(request=None)
+            if chat_id in self.flaky:
+                self.flaky.discard(chat_id)
+                raise ConnectionError("connection lost")
+            self.sent.append((chat_id, text))
+            return SimpleNamespace(id=len(self.sent))
+        finally:
+            self.active -= 1
+
+@pytest.fixture(autouse=True)
+def send_env(monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(None))
+    main.console.quiet = True
+    yield
+    main.console.quiet = False
+
+def chat_id(number):
+    return CHANNEL_ID_OFFSET - number
+
+def test_bulk_send_reports_every_chat(tmp_path):
+    entities = {chat_id(number): group(number, admin_rights=True) for number in (1, 4, 5)}
+    entities[chat_id(2)] = group(2, banned_rights=SimpleNamespace(send_messages=True))
+    entities[chat_id(3)] = group(3)
+    entities["alias"] = entities[chat_id(1)]
+    client = SendClient(entities, forbidden={chat_id(4)}, flaky={chat_id(5)})
+    report = str(tmp_path / "report.json")
+
+    results = asyncio.run(main.send_messages_bulk(client, [str(chat_id(number)) for number in range(1, 6)] +
+                                                  ["@Alias", "missing", chat_id(1)], "hello", retries=1,
+                                                  report_file=report))
+
+    statuses = {result["chat"]: (result["status"], result["attempts"]) for result in results}
+    assert statuses == {chat_id(1): ("sent", 1), chat_id(2): ("forbidden", 0), chat_id(3): ("sent", 1),
+                        chat_id(4): ("forbidden", 1), chat_id(5): ("sent", 2), "alias": ("duplicate", 0),
+                        "missing": ("not_found", 0)}
+    assert sorted(client.sent) == [(chat_id(number), "hello") for number in (5, 3, 1)]
+    # Права запрашиваются только там, где их нельзя определить по объекту чата
+    assert client.permission_checks == [chat_id(3)]
+    with open(report, encoding="utf-8") as f:
+        summary = json.load(f)
+    assert (summary["chats"], summary["sent"], summary["forbidden"], summary["not_found"], summary["duplicate"]) == \
+        (7, 3, 2, 1, 1)
+    # Запрет, полученный при отправке, запоминается в кэше
+    assert main.entity_cache.get(chat_id(4))["can_send"] is False
+
+def test_bulk_send_uses_cached_targets_and_limits_concurrency():
+    entities = {chat_id(number): group(number, admin_rights=True) for number in range(1, 21)}
+    client = SendClient(entities)
+    chats = [chat_id(number) for number in range(1, 21)]
+
+    asyncio.run(main.send_messages_bulk(client, chats, "first", concurrency=4))
+    lookups = len(client.lookups)
+    results = asyncio.run(main.send_messages_bulk(client, chats, "second", concurrency=4))
+
+    assert lookups == 1
+    assert len(client.lookups) == lookups
+    assert client.max_active == 4
+    assert all(result["status"] == "sent" for result in results)
+    assert len(client.sent) == 40
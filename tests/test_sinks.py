@@ -0,0 +1,91 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from records import MessageRecord
+from sinks import JsonlSink, SqliteSink, open_sink, query_messages
+
+def write_records(sink, records, flush_each=False):
+    async def run():
+        for record in records:
+            sink.write(record)
+            if flush_each:
+                await sink.flush()
+        await sink.close()
+    asyncio.run(run())
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_jsonl_sink_writes_history_records(tmp_path):
+    path = tmp_path / "history.jsonl"
+    sink = JsonlSink(str(path), batch_size=10, fsync="never")
+    write_records(sink, [MessageRecord(number, date=1704067200 + number, sender_id=7, text=f"message {number}")
+                         for number in range(1, 26)])
+
+    lines = read_lines(path)
+    assert [line["id"] for line in lines] == list(range(1, 26))
+    assert lines[0] == {"id": 1, "date": "2024-01-01T00:00:01+00:00", "text": "message 1", "sender_id": 7,
+                        "reply_to": None}
+    assert sink.written == 25
+
+def test_jsonl_sink_rotates_by_size(tmp_path):
+    path = tmp_path / "messages.jsonl"
+    sink = JsonlSink(str(path), fsync="never", max_bytes=300)
+    write_records(sink, [MessageRecord(number, date=1704067200, text="x" * 20) for number in range(1, 31)],
+                  flush_each=True)
+
+    files = sorted(tmp_path.glob("messages*.jsonl"))
+    assert len(files) > 1
+    assert all(file.stat().st_size <= 300 for file in files)
+    ids = [line["id"] for file in files for line in read_lines(file)]
+    assert sorted(ids) == list(range(1, 31))
+
+def test_jsonl_sink_appends_to_existing_file(tmp_path):
+    path = tmp_path / "messages.jsonl"
+    write_records(JsonlSink(str(path)), [MessageRecord(1, date=0)])
+    write_records(JsonlSink(str(path)), [MessageRecord(2, date=0)])
+
+    assert [line["id"] for line in read_lines(path)] == [1, 2]
+
+def test_open_sink_selects_backend_by_extension(tmp_path):
+    assert type(open_sink(str(tmp_path / "a.jsonl"))).__name__ == "JsonlSink"
+    assert type(open_sink(str(tmp_path / "a.msgpack"))).__name__ == "BinarySink"
+    assert type(open_sink(str(tmp_path / "a.db"), fsync="batch")).__name__ == "SqliteSink"
+
+def test_sqlite_sink_upserts_repeated_messages(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_records(SqliteSink(path, chat_id=-1001), [MessageRecord(1, date=0, sender_id=7, text="first"),
+                                                    MessageRecord(2, date=60, sender_id=8, text="second")])
+    write_records(SqliteSink(path, chat_id=-1001), [MessageRecord(1, date=0, sender_id=7, text="first again")])
+
+    rows = query_messages(path)
+    assert [(row["chat_id"], row["message_id"], row["text"]) for row in rows] == [
+        (-1001, 2, "second"), (-1001, 1, "first again")]
+
+def test_sqlite_sink_keeps_topics_apart(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_records(SqliteSink(path, chat_id=-1001, topic_id=5), [MessageRecord(1, date=0, text="in topic")])
+    write_records(SqliteSink(path, chat_id=-1001), [MessageRecord(1, date=0, text="outside")])
+
+    assert [row["text"] for row in query_messages(path, topic_id=5)] == ["in topic"]
+    assert len(query_messages(path, chat_id=-1001)) == 2
+
+def test_query_messages_filters_by_sender_and_date(tmp_path):
+    path = str(tmp_path / "messages.db")
+    write_records(SqliteSink(path, chat_id=-1001), [MessageRecord(number, date=1704067200 + number * 3600,
+                                                                  sender_id=number % 2, text=str(number))
+                                                    for number in range(1, 11)])
+
+    since = datetime(2024, 1, 1, 4, tzinfo=timezone.utc)
+    rows = query_messages(path, sender_id=1, since=since, limit=2)
+    assert [row["message_id"] for row in rows] == [9, 7]
+
+def test_query_messages_requires_existing_database(tmp_path):
+    path = tmp_path / "missing.db"
+    with pytest.raises(FileNotFoundError, match="Message database not found"):
+        query_messages(str(path))
+    assert not path.exists()